@@ -0,0 +1,294 @@
+#!/usr/bin/python
+#complexBench.py
+'''
+Benchmarks for complexDissect.py, on synthetic data.
+
+Generates inputs in the formats complexDissect reads - the eggNOG ID
+conversion and NOG membership files, ecoli.txt, and complex files in
+long and short format - at a chosen scale, so no downloads are needed.
+Then runs each stage of the analysis in its own process and records
+its run time and peak memory use:
+	complex_parse	Loading the short and long complex files
+	eggnog_parse	Parsing the eggNOG ID conversion and NOG membership files
+	map_build	Building the map store from scratch
+	set_comparison	Comparing the experimental and model complex sets
+	matrix_output	Writing the component and complex conservation matrices
+
+Results are compared against a saved baseline, and any stage slower or
+larger than the baseline by more than the tolerance is reported as a
+regression (with an exit status of 1).
+
+Usage:
+complexBench.py --scale 4	Generate data at 4x the default size and compare to the baseline
+complexBench.py --save	Save this run as the new baseline
+'''
+import argparse, gzip, json, multiprocessing, os, random, resource, shutil, sys, time
+from datetime import date
+
+import complexDissect
+
+##Options
+ecoli_taxid = "511145"	#The E. coli K-12 taxid, as used by eggNOG
+base_sizes = {"ecoli_proteins": 4000,	#Proteins in ecoli.txt, with b-numbers
+			"taxa": 200,	#Other taxa with proteins in eggNOG
+			"taxon_proteins": 100,	#Proteins per other taxon
+			"nogs": 3000,	#NOGs per membership file
+			"complexes": 500}	#Complexes per complex set
+max_ecoli_proteins = 9999	#b-numbers have four digits, so ecoli.txt can't hold more proteins at any scale
+min_seconds = 0.1	#Stages faster than this are too noisy to flag as slower
+stage_names = ["complex_parse", "eggnog_parse", "map_build", "set_comparison", "matrix_output"]
+
+##Functions
+def scaledSizes(scale):
+	#Returns the sizes of the synthetic data at a scale.
+	sizes = dict((size_name, int(base_sizes[size_name] * scale)) for size_name in base_sizes)
+	sizes["ecoli_proteins"] = min(sizes["ecoli_proteins"], max_ecoli_proteins)
+	return sizes
+
+def ecoliProtein(i):
+	#Returns the b-number, JW code, gene name and Uniprot ID of E. coli protein i.
+	return ["b%04d" % i, "JW%04d" % i, "gen%d" % i, "P%05d" % i]
+
+def writeEcoliIDs(filename, sizes):
+	#Writes an ecoli.txt with a header, the ID table and a footer, as from Uniprot.
+	#Every seventh protein has no JW code, as happens in the real file.
+	with open(filename, "w+b") as ecoli_file:
+		ecoli_file.write("UniProt ecoli header\nRelease: synthetic\n\n")
+		ecoli_file.write("b-number JW gene AC\n________ __\n")
+		for i in range(1, sizes["ecoli_proteins"] +1):
+			bcode, jwcode, gene, upid = ecoliProtein(i)
+			if i % 7 == 0:
+				ecoli_file.write("%s\t%s\t%s\t%s_ECOLI\n" % (bcode, gene, upid, gene.upper()))
+			else:
+				ecoli_file.write("%s\t%s\t%s\t%s\t%s_ECOLI\n" % (bcode, jwcode, gene, upid, gene.upper()))
+		ecoli_file.write("\n-----\nfooter\n")
+
+def otherProteins(sizes):
+	#Returns the taxid and protein name of every protein in the other taxa.
+	return [[str(100000 + taxon), "g%d" % j] for taxon in range(sizes["taxa"])
+			for j in range(sizes["taxon_proteins"])]
+
+def writeConversionFile(filename, sizes):
+	#Writes a compressed eggNOG ID conversion file.
+	#Each protein gets a Uniprot ID row and a row of another ID type.
+	conversion_file = gzip.open(filename, "wb")
+	for i in range(1, sizes["ecoli_proteins"] +1):
+		bcode, jwcode, gene, upid = ecoliProtein(i)
+		conversion_file.write("%s\t%s\t%s\tUniProt_AC\n" % (ecoli_taxid, bcode, upid))
+		conversion_file.write("%s\t%s\t%s\tBLAST_KEGG_NAME\n" % (ecoli_taxid, bcode, gene))
+	for taxid, protein_name in otherProteins(sizes):
+		conversion_file.write("%s\t%s\tQ%s%s\tUniProt_AC\n" % (taxid, protein_name, taxid, protein_name))
+	conversion_file.close()
+
+def writeMemberFile(filename, level, sizes, seed):
+	#Writes a compressed NOG membership file for a level (e.g. "NOG").
+	#Some E. coli proteins end up in more than one NOG, as in eggNOG.
+	randomizer = random.Random(seed)
+	other_proteins = [taxid + "." + protein_name for taxid, protein_name in otherProteins(sizes)]
+	member_file = gzip.open(filename, "wb")
+	for k in range(sizes["nogs"]):
+		members = set()
+		for i in range(randomizer.randint(1, 8)):
+			members.add("%s.b%04d" % (ecoli_taxid, randomizer.randint(1, sizes["ecoli_proteins"])))
+		for i in range(randomizer.randint(1, 60)):
+			members.add(randomizer.choice(other_proteins))
+		members = sorted(members)
+		member_file.write("%s\t%s%06d\t%s\t%s\tS\t%s\n" % (level, level[:3].upper(), k, len(members),
+							len(set(member.split(".")[0] for member in members)), ",".join(members)))
+	member_file.close()
+
+def randomComplexes(sizes, seed):
+	#Returns a dict of synthetic complexes, with b-numbers as members.
+	randomizer = random.Random(seed)
+	complexes = {}
+	for k in range(sizes["complexes"]):
+		members = set(randomizer.randint(1, sizes["ecoli_proteins"]) for i in range(randomizer.randint(2, 12)))
+		complexes[str(k +1)] = ["b%04d" % member for member in sorted(members)]
+	return complexes
+
+def writeLongComplexes(filename, complexes):
+	#Writes complexes in long format: one complex member per line.
+	with open(filename, "w+b") as complex_file:
+		complex_file.write("ProteinID\tComplexMembership\n")
+		for complex_name in sorted(complexes, key=int):
+			for member in complexes[complex_name]:
+				complex_file.write(member + "\t" + complex_name + "\n")
+
+def writeShortComplexes(filename, complexes):
+	#Writes complexes in short format: one complex per line.
+	with open(filename, "w+b") as complex_file:
+		complex_file.write("CplxID\tComplex_members\n")
+		for complex_name in sorted(complexes, key=int):
+			complex_file.write(complex_name + "\t" + "\t".join(complexes[complex_name]) + "\n")
+
+def generateData(data_dir, scale, seed):
+	#Writes a full set of synthetic inputs to data_dir, replacing any already there.
+	#The same scale and seed always give the same files.
+	sizes = scaledSizes(scale)
+	print("Generating synthetic data at scale %s in %s..." % (scale, data_dir))
+	if os.path.isdir(data_dir):
+		shutil.rmtree(data_dir)
+	os.makedirs(data_dir)
+	writeEcoliIDs(os.path.join(data_dir, "ecoli.txt"), sizes)
+	writeConversionFile(os.path.join(data_dir, "eggnog4.protein_id_conversion.tsv.gz"), sizes)
+	writeMemberFile(os.path.join(data_dir, "NOG.members.tsv.gz"), "NOG", sizes, seed +1)
+	writeMemberFile(os.path.join(data_dir, "bactNOG.members.tsv.gz"), "bactNOG", sizes, seed +2)
+	exp_complexes = randomComplexes(sizes, seed +3)
+	writeLongComplexes(os.path.join(data_dir, "complexes_exp.txt"), exp_complexes)
+	writeShortComplexes(os.path.join(data_dir, "complexes_short.txt"), exp_complexes)
+	writeLongComplexes(os.path.join(data_dir, "complexes_model.txt"), randomComplexes(sizes, seed +4))
+	with open(os.path.join(data_dir, "bench_data.json"), "w") as stamp_file:
+		json.dump({"scale": scale, "seed": seed, "sizes": sizes}, stamp_file, sort_keys=True)
+
+def dataMatches(data_dir, scale, seed):
+	#Checks whether data_dir holds synthetic data for this scale and seed.
+	stamp_filename = os.path.join(data_dir, "bench_data.json")
+	if not os.path.isfile(stamp_filename):
+		return False
+	with open(stamp_filename) as stamp_file:
+		stamp = json.load(stamp_file)
+	return stamp["scale"] == scale and stamp["seed"] == seed and stamp.get("sizes") == scaledSizes(scale)
+
+def removeMapFiles():
+	#Removes map stores and saved build stages, so the maps are built from scratch.
+	for filename in os.listdir("."):
+		if filename.startswith("eggnog_maps_") or filename.startswith("eggnog_stage_"):
+			os.remove(filename)
+
+def runComplexParse(jobs):
+	complexDissect.loadComplexes("complexes_short.txt", "short")
+	complexDissect.loadComplexes("complexes_exp.txt", "exp")
+	complexDissect.loadComplexes("complexes_model.txt", "model")
+
+def runEggnogParse(jobs):
+	protein_index = complexDissect.HashIndex(complexDissect.readIDConversion("eggnog4.protein_id_conversion.tsv.gz", jobs)[1])
+	for filename in ["NOG.members.tsv.gz", "bactNOG.members.tsv.gz"]:
+		complexDissect.readNOGMembers(filename, protein_index, jobs)
+
+def runMapBuild(jobs):
+	removeMapFiles()
+	complexDissect.get_eggnog_maps(jobs)
+
+def runSetComparison(jobs):
+	complexDissect.compareSets("complexes_exp.txt", "exp", "complexes_model.txt", "model", "ecoli")
+
+def runMatrixOutput(jobs):
+	ecoli_ids, locus_index = complexDissect.getEcoliIDs()
+	complexDissect.compareSpecies("complexes_exp.txt", "exp", ecoli_ids, jobs, locus_index=locus_index)
+
+stage_functions = {"complex_parse": runComplexParse, "eggnog_parse": runEggnogParse,
+				"map_build": runMapBuild, "set_comparison": runSetComparison,
+				"matrix_output": runMatrixOutput}
+
+def stageProcess(stage_name, data_dir, jobs, results):
+	#Runs one stage in data_dir, with its output going to a log file,
+	#and puts its run time and peak memory use on the results queue.
+	os.chdir(data_dir)
+	complexDissect.result_cache_size = 0	#Time the comparisons, not cached results from earlier runs
+	log_file = open("bench_%s.log" % stage_name, "w")
+	sys.stdout.flush()
+	os.dup2(log_file.fileno(), sys.stdout.fileno())
+	start_time = time.time()
+	stage_functions[stage_name](jobs)
+	elapsed = time.time() - start_time
+	sys.stdout.flush()
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	results.put({"seconds": round(elapsed, 3), "peak_rss_mb": round(peak_rss / 1024.0, 1)})
+
+def runStage(stage_name, data_dir, jobs):
+	#Runs one stage in a fresh process, so its peak memory use is its own.
+	#Returns a dict of its run time in seconds and peak RSS in MB.
+	results = multiprocessing.Queue()
+	stage_process = multiprocessing.Process(target=stageProcess, args=(stage_name, data_dir, jobs, results))
+	stage_process.start()
+	stage_process.join()
+	if stage_process.exitcode != 0:
+		sys.exit("Stage %s failed. See %s for its output."
+				% (stage_name, os.path.join(data_dir, "bench_%s.log" % stage_name)))
+	return results.get()
+
+def runBenchmarks(data_dir, jobs, repeats):
+	#Runs every stage in order, repeats times, keeping the best time and
+	#the lowest peak memory use for each.
+	#The map build comes before the matrix output, which uses its store.
+	#Returns a dict of results with stage names as keys.
+	stage_results = {}
+	for stage_name in stage_names:
+		for i in range(repeats):
+			this_result = runStage(stage_name, data_dir, jobs)
+			if stage_name not in stage_results:
+				stage_results[stage_name] = this_result
+			else:
+				for measure in this_result:
+					stage_results[stage_name][measure] = min(stage_results[stage_name][measure], this_result[measure])
+		print("%-16s%10.3f s%10.1f MB" % (stage_name, stage_results[stage_name]["seconds"],
+										stage_results[stage_name]["peak_rss_mb"]))
+	return stage_results
+
+def compareToBaseline(stage_results, baseline_results, tolerance):
+	#Reports the change in each measure from the baseline.
+	#Returns the list of stages and measures which got worse by more than tolerance.
+	regressions = []
+	for stage_name in stage_names:
+		if stage_name not in baseline_results:
+			continue
+		for measure in ["seconds", "peak_rss_mb"]:
+			old_value = baseline_results[stage_name][measure]
+			new_value = stage_results[stage_name][measure]
+			if old_value <= 0:
+				continue
+			change = new_value / old_value - 1
+			flag = ""
+			if change > tolerance and not (measure == "seconds" and new_value < min_seconds):
+				flag = "  REGRESSION"
+				regressions.append(stage_name + " " + measure)
+			print("%-16s%-12s%10s ->%10s  %+6.1f%%%s" % (stage_name, measure, old_value, new_value,
+															change * 100, flag))
+	return regressions
+
+##Main
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Benchmarks complexDissect.py on synthetic data.")
+	parser.add_argument("--scale", type=float, default=1.0,
+						help="size of the synthetic data, as a multiple of the default size")
+	parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic data")
+	parser.add_argument("--data-dir", default="bench_data", help="where to write the synthetic data")
+	parser.add_argument("--jobs", type=int, default=1, help="processes to use for parsing")
+	parser.add_argument("--repeats", type=int, default=1,
+						help="times to run each stage; the best result is kept")
+	parser.add_argument("--baseline", default="complexBench_baseline.json",
+						help="file of saved baseline results")
+	parser.add_argument("--save", action="store_true", help="save this run as the baseline for its scale")
+	parser.add_argument("--tolerance", type=float, default=0.3,
+						help="fractional increase over the baseline counted as a regression")
+	parser.add_argument("--regenerate", action="store_true", help="generate the data even if present")
+	args = parser.parse_args()
+
+	data_dir = os.path.abspath(args.data_dir)
+	if args.regenerate or not dataMatches(data_dir, args.scale, args.seed):
+		generateData(data_dir, args.scale, args.seed)
+
+	print("Running stages at scale %s with %s job(s):" % (args.scale, args.jobs))
+	stage_results = runBenchmarks(data_dir, args.jobs, args.repeats)
+
+	baseline = {}
+	if os.path.isfile(args.baseline):
+		with open(args.baseline) as baseline_file:
+			baseline = json.load(baseline_file)
+	scale_key = "scale_%s_jobs_%s" % (args.scale, args.jobs)	#Only like runs are compared
+
+	if args.save:
+		baseline[scale_key] = {"date": date.today().isoformat(), "python": sys.version.split()[0],
+								"stages": stage_results}
+		with open(args.baseline, "w") as baseline_file:
+			json.dump(baseline, baseline_file, indent=1, sort_keys=True)
+		print("Saved baseline for %s to %s." % (scale_key, args.baseline))
+	elif scale_key in baseline:
+		print("\nChanges from the baseline of %s:" % baseline[scale_key]["date"])
+		regressions = compareToBaseline(stage_results, baseline[scale_key]["stages"], args.tolerance)
+		if len(regressions) >0:
+			sys.exit("%s regression(s) beyond %s%%: %s" % (len(regressions), int(args.tolerance * 100),
+															", ".join(regressions)))
+		print("No regressions.")
+	else:
+		print("No baseline for %s in %s. Use --save to record one." % (scale_key, args.baseline))
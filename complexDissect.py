@@ -43,7 +43,13 @@ So if the data looks like this (e.g., Hu et al 2009, table S7):
 CplxID	Complex_members
 1	b1234	b1235	b1236
 
-then it can be converted into "long" format.
+then it can be read directly. The layout of each file is detected
+from its header and first lines when it is loaded, unless given with
+--layout, and files may be gzipped. Long files may have more columns
+(e.g. a score), but only the first two are used. Files which fit either
+layout need --layout; so do short files where every complex has a
+single member and the header doesn't name the columns, as they look long.
+Repeated lines or members are only counted once.
 
 OUTPUT:
 A file indicating, for each "experimental" complex, conservation
@@ -68,53 +74,1179 @@ IN PROGRESS: Enabling broad cross-genome complex conservation prediction.
 3. Combine components into their respective complexes.
 	Produce a matrix of complexes vs. taxids, where values are 
 	each (components present/components in model complex).
-4. Use output to produce tree and heatmap. This happens outside the
-	software. Model on Caufield et al. 2015 PLoS Comp Bio.
+4. Use output to produce tree and heatmap. With --cluster, the trees
+	and the matrices in tree order are produced here; the heatmap is
+	still drawn outside the software. Model on Caufield et al. 2015 PLoS Comp Bio.
 
 '''
-import glob, gzip, os, re, requests, sys, urllib2
-from collections import Counter
+import argparse, atexit, base64, BaseHTTPServer, binascii, bisect, fcntl, functools, glob, gzip, hashlib, heapq, httplib, io, itertools, json, marshal, mmap, multiprocessing, os, pickle, random, re, requests, resource, SocketServer, struct, sys, threading, time, urllib2, urlparse, weakref, zipfile, zlib
+from array import array
+from collections import Counter, deque
 from datetime import date
 
 ##Options
+eggnog_url = "http://eggnogdb.embl.de/download/latest/"	#Where the eggNOG files get downloaded from
+uniprot_docs_url = "http://www.uniprot.org/docs/"	#Where ecoli.txt gets downloaded from
+download_retries = 3	#Times an interrupted download is resumed before giving up
+build_manifest_filename = "eggnog_maps_manifest.json"	#Records what each map store was built from
+map_store_magic = "CDMAP001"	#First bytes of every binary map store file
+map_store_header = "<8s3I9Q"	#Magic, then counts of UPIDs, OGs and taxids, then section offsets
+conversion_cache_version = 1	#Change this when the format of parsed ID conversion tables changes
+build_stage_version = 3	#Change this when the format of saved map build stages changes
+parse_block_size = 4194304	#Bytes of decompressed eggNOG text parsed at a time
+eggnog_levels = ["NOG", "bactNOG"]	#eggNOG levels merged into the map store; later levels win for proteins in several
+eggnog_level_names = ["NOG", "acidNOG", "aciNOG", "acoNOG", "actNOG", "agaNOG", "agarNOG", "apiNOG", "aproNOG",
+			"aquNOG", "arNOG", "arcNOG", "artNOG", "arthNOG", "ascNOG", "aveNOG", "bacNOG", "bactNOG",
+			"bacteNOG", "basNOG", "bctoNOG", "biNOG", "bproNOG", "braNOG", "carNOG", "chaNOG",
+			"chlNOG", "chlaNOG", "chloNOG", "chlorNOG", "chloroNOG", "chorNOG", "chrNOG", "cloNOG",
+			"cocNOG", "creNOG", "cryNOG", "cyaNOG", "cytNOG", "debNOG", "defNOG", "dehNOG", "deiNOG",
+			"delNOG", "dipNOG", "dotNOG", "dproNOG", "droNOG", "eproNOG", "eryNOG", "euNOG", "eurNOG",
+			"euroNOG", "eurotNOG", "fiNOG", "firmNOG", "flaNOG", "fuNOG", "fusoNOG", "gproNOG",
+			"haeNOG", "halNOG", "homNOG", "hymNOG", "hypNOG", "inNOG", "kinNOG", "lepNOG", "lilNOG",
+			"maNOG", "magNOG", "meNOG", "metNOG", "methNOG", "methaNOG", "necNOG", "negNOG", "nemNOG",
+			"onyNOG", "opiNOG", "perNOG", "plaNOG", "pleNOG", "poaNOG", "prNOG", "proNOG", "rhaNOG",
+			"roNOG", "sacNOG", "saccNOG", "sorNOG", "sordNOG", "sphNOG", "spiNOG", "spriNOG", "strNOG",
+			"synNOG", "tenNOG", "thaNOG", "theNOG", "therNOG", "thermNOG", "treNOG", "veNOG", "verNOG",
+			"verrNOG", "virNOG"]	#Levels which can be given with --levels (those of eggNOG 4.5); add any newer ones here
+query_reload_interval = 5	#Seconds between checks for a rebuilt map store when serving queries
+matrix_npz = False	#Also write the conservation matrices as NumPy .npz files (set with --npz)
+complex_layout = None	#"long" or "short" layout of every complex file (set with --layout); None detects it per file
+result_cache_dir = None	#Directory keeping per-complex results between runs (set with --cache-dir); None turns caching off
+result_cache_filename = "complex_results_cache.dat"	#The results file within result_cache_dir
+result_cache_version = 1	#Change this when the format of cached results changes
+result_cache_size = 100	#MB of cached results to keep, dropping the least recently used; 0 turns caching off
+cluster_block_size = 2048	#Items counted against at once when clustering; each block takes about 2 bytes per item per column
 
 ##Classes
 class ProteinComplex():
 	name = "defaultname"
 
+class TaxidMatrix():
+	#Presence of OGs across taxids.
+	#OGs are rows and taxids are columns, both indexed by integers.
+	#Each row is packed into a single integer with one bit per taxid column,
+	#and its set columns are also kept as a sorted list (the sparse form).
+	#Columns are numbered in the order taxids are first seen.
+	
+	def __init__(self, og_list, og_to_taxid):
+		self.ogs = []	#Row labels
+		self.og_index = {}	#OGs are keys, row numbers are values
+		self.taxids = []	#Column labels
+		self.taxid_index = {}	#Taxids are keys, column numbers are values
+		self.rows = []	#Packed bit rows
+		self.row_columns = []	#Column numbers present in each row
+		for og in og_list:
+			if og in og_to_taxid:
+				self.addRow(og, og_to_taxid[og])
+			else:	#OGs without any taxids (e.g. combined OGs) get an empty row
+				self.addRow(og, [])
+	
+	def addRow(self, og, taxids):
+		packed_row = 0
+		for taxid in taxids:
+			if taxid not in self.taxid_index:
+				self.taxid_index[taxid] = len(self.taxids)
+				self.taxids.append(taxid)
+			packed_row = packed_row | (1 << self.taxid_index[taxid])
+		self.og_index[og] = len(self.ogs)
+		self.ogs.append(og)
+		self.rows.append(packed_row)
+		self.row_columns.append(sorted(set(self.taxid_index[taxid] for taxid in taxids)))
+		return self.og_index[og]
+	
+	def presence(self, og):
+		#Returns the row for this OG as a list of 0 or 1 for each column.
+		packed_row = self.rows[self.og_index[og]]
+		return [(packed_row >> column) & 1 for column in range(len(self.taxids))]
+	
+	def columnCounts(self, row_numbers):
+		#Sparse product of one membership row (the row numbers of the
+		#OGs in a complex, repeated as often as they occur) with the
+		#presence matrix: the number of members present in each column.
+		counts = [0] * len(self.taxids)
+		for row_number in row_numbers:
+			for column in self.row_columns[row_number]:
+				counts[column] = counts[column] +1
+		return counts
+	
+	def product(self, membership):
+		#membership is a list of membership rows, one per complex.
+		#Returns the complex x taxid matrix of member counts.
+		return [self.columnCounts(row_numbers) for row_numbers in membership]
+
+	def rollUp(self, column_groups):
+		#Returns a TaxidMatrix with the same rows, whose columns are groups
+		#of these columns (e.g. the clade each taxid is in). column_groups
+		#has the label of each column's group, or None to leave it out.
+		#A row is present in a group if it is present in any of its columns.
+		rolled = TaxidMatrix([], {})
+		for og, columns in zip(self.ogs, self.row_columns):
+			rolled.addRow(og, [column_groups[column] for column in columns
+								if column_groups[column] is not None])
+		return rolled
+
+class Taxonomy():
+	#The NCBI taxonomy tree, from a nodes.dmp file.
+	#Taxids are numbers, so the tree is held in arrays indexed by taxid.
+	#The tree is numbered in the order of a depth-first (Euler) tour:
+	#each taxid gets an interval from its entry to its exit, and the
+	#taxids within a clade are exactly those entered inside its interval.
+	#So the clade a taxid is in, at any rank, is found by a binary search
+	#over the entries of the clades at that rank.
+
+	def __init__(self, filename):
+		self.rank_names = [""]	#Rank codes are indexes; 0 means the taxid isn't in the tree
+		rank_codes = {}
+		taxids = array("i")
+		parents = array("i")
+		taxid_ranks = array("B")
+		timer = run_report.stage("load taxonomy", os.path.getsize(filename))
+		with open(filename, "rb") as nodes_file:
+			for lines in readLineBlocks(nodes_file, 100000):
+				for line in lines:
+					fields = line.rstrip("\t|\n").split("\t|\t")	#taxid, parent taxid, rank, then details we don't use
+					rank = fields[2]
+					if rank not in rank_codes:
+						rank_codes[rank] = len(self.rank_names)
+						self.rank_names.append(rank)
+					taxids.append(int(fields[0]))
+					parents.append(int(fields[1]))
+					taxid_ranks.append(rank_codes[rank])
+				timer.advance(len(lines), nodes_file.tell())
+		self.size = max(taxids) +1
+		self.ranks = array("B", [0]) * self.size
+		self.entries = array("i", [-1]) * self.size	#-1 for taxids not in the tree
+		self.exits = array("i", [-1]) * self.size
+		roots = []	#Root taxids are their own parents
+		parent_taxids = array("i")
+		child_taxids = array("i")
+		for i, taxid in enumerate(taxids):
+			self.ranks[taxid] = taxid_ranks[i]
+			if parents[i] == taxid:
+				roots.append(taxid)
+			else:
+				parent_taxids.append(parents[i])
+				child_taxids.append(taxid)
+		children = groupCodes(parent_taxids, child_taxids, self.size)
+		position = 0
+		for root in roots:
+			self.entries[root] = position
+			position = position +1
+			stack = [[root, children.starts[root]]]	#Taxids being toured and their next child
+			while stack:
+				taxid, next_child = stack[-1]
+				if next_child < children.ends[taxid]:
+					stack[-1][1] = next_child +1
+					child = children.values[next_child]
+					self.entries[child] = position
+					position = position +1
+					stack.append([child, children.starts[child]])
+				else:
+					self.exits[taxid] = position
+					stack.pop()
+		self.clade_index = {}	#Ranks are keys, sorted entries and clades at that rank are values
+		timer.finish()
+
+	def cladeIndex(self, rank):
+		#The clades at a rank, as a sorted list of their entries and a
+		#list of the clade taxids, in the same order.
+		if rank not in self.clade_index:
+			rank_code = -1
+			if rank in self.rank_names:
+				rank_code = self.rank_names.index(rank)
+			clades = sorted((self.entries[taxid], taxid) for taxid, taxid_rank in enumerate(self.ranks)
+							if taxid_rank == rank_code and self.entries[taxid] >= 0)
+			self.clade_index[rank] = ([entry for entry, taxid in clades], [taxid for entry, taxid in clades])
+		return self.clade_index[rank]
+
+	def cladeOf(self, taxid, rank):
+		#Returns the taxid (as a string) of the clade at this rank which
+		#contains taxid, or None if taxid isn't in the tree or isn't
+		#within any clade at that rank. Clades of one rank don't nest.
+		if not taxid.isdigit() or int(taxid) >= self.size:
+			return None
+		entry = self.entries[int(taxid)]
+		if entry < 0:
+			return None
+		clade_entries, clades = self.cladeIndex(rank)
+		i = bisect.bisect_right(clade_entries, entry) -1
+		if i < 0 or entry >= self.exits[clades[i]]:
+			return None
+		return str(clades[i])
+
+class IdentifierTable():
+	#Interns identifiers (Uniprot IDs, eggNOG protein IDs, OGs or taxids):
+	#each distinct string gets a dense integer code, in the order first seen,
+	#so everything else can refer to it with a number in an array.
+	#The strings are packed end to end into one byte array, with an array
+	#of offsets, instead of being kept as separate string objects.
+	#Lookups by string go through a dict index, which is only built when
+	#it is needed and is dropped once no more lookups will be done, 
+	#leaving just the packed strings. Tables too big for a dict index are
+	#searched with a HashIndex instead.
+	
+	def __init__(self, blob=None, offsets=None):
+		self.blob = blob or bytearray()	#All identifiers, concatenated
+		self.offsets = offsets or array("l", [0])	#Where each identifier starts and ends in blob
+		self.codes = None	#Index: identifiers are keys, codes are values
+	
+	def __len__(self):
+		return len(self.offsets) -1
+	
+	def __getitem__(self, code):
+		return str(self.blob[self.offsets[code]:self.offsets[code +1]])
+	
+	def __iter__(self):
+		offsets = iter(self.offsets)
+		start = next(offsets)
+		for end in offsets:
+			yield str(self.blob[start:end])
+			start = end
+	
+	def index(self):
+		#Builds the index, if it isn't there already.
+		if self.codes is None:
+			self.codes = {}
+			for code, string in enumerate(self):
+				self.codes.setdefault(string, code)	#The first code, as find() would give
+	
+	def dropIndex(self):
+		self.codes = None
+	
+	def append(self, string):
+		#Gives an identifier a new code without checking if it has one already.
+		#For identifiers which are unique anyway, or where duplicates are
+		#sorted out later; it saves building the index.
+		code = len(self.offsets) -1
+		self.blob.extend(string)
+		self.offsets.append(len(self.blob))
+		if self.codes is not None:
+			self.codes.setdefault(string, code)
+		return code
+	
+	def appendAll(self, strings):
+		#append() for a list of identifiers at once. Returns the first one's code.
+		first_code = len(self.offsets) -1
+		offsets = self.offsets
+		position = len(self.blob)
+		for string in strings:
+			position = position + len(string)
+			offsets.append(position)
+		self.blob.extend("".join(strings))
+		if self.codes is not None:
+			for code, string in enumerate(strings, first_code):
+				self.codes.setdefault(string, code)
+		return first_code
+	
+	def codeAll(self, strings):
+		#code() for a list of identifiers at once. Returns an array of their codes.
+		if self.codes is None:
+			self.index()
+		codes = self.codes
+		string_codes = array("i", [codes.get(string, -1) for string in strings])
+		if -1 in string_codes:
+			next_code = len(self.offsets) -1
+			new_strings = []
+			for position, string in enumerate(strings):
+				if string_codes[position] < 0:
+					code = codes.get(string)
+					if code is None:	#Not even earlier in this list
+						code = next_code
+						codes[string] = code
+						next_code = next_code +1
+						new_strings.append(string)
+					string_codes[position] = code
+			self.codes = None	#appendAll would index them again
+			self.appendAll(new_strings)
+			self.codes = codes
+		return string_codes
+	
+	def code(self, string):
+		#Returns the code for an identifier, giving it a new one if it is new.
+		if self.codes is None:
+			self.index()
+		code = self.codes.get(string)
+		if code is None:
+			code = len(self.offsets) -1
+			self.codes[string] = code
+			self.blob.extend(string)
+			self.offsets.append(len(self.blob))
+		return code
+	
+	def find(self, string):
+		#Returns the code for an identifier or -1 if it hasn't been seen.
+		if self.codes is None:
+			self.index()
+		return self.codes.get(string, -1)
+
+class HashIndex():
+	#Finds the codes of identifiers in an IdentifierTable too big to index
+	#with a dict (e.g. every eggNOG protein with a Uniprot ID).
+	#Codes are grouped into buckets by the top 16 bits of their identifier's
+	#hash, with a counting sort, and sorted by hash within each bucket, so
+	#an identifier is found by a binary search over its bucket. The index 
+	#is only arrays and the table's packed strings, about 16 bytes per
+	#identifier against over 100 for a dict, but each lookup takes about
+	#five times as long.
+	#Matches are checked against the strings, so hash collisions are harmless.
+	#Hashes are only the same within one run (and the processes it forks),
+	#so the index is never saved.
+
+	def __init__(self, table):
+		self.table = table
+		hashes = array("l", (hash(string) for string in table))	#In code order
+		self.bucket_shift = 8 * hashes.itemsize - 16
+		buckets = array("i", [0]) * len(table)
+		for code, string_hash in enumerate(hashes):
+			buckets[code] = (string_hash >> self.bucket_shift) & 0xFFFF
+		grouped = groupCodes(buckets, array("i", xrange(len(table))), 65536)
+		del buckets
+		self.starts = grouped.starts	#Where each bucket starts and ends in codes and hashes
+		self.ends = grouped.ends
+		self.codes = grouped.values	#Codes, by bucket and then by hash
+		for bucket in xrange(65536):
+			start = self.starts[bucket]
+			end = self.ends[bucket]
+			if end - start > 1:
+				self.codes[start:end] = array("i", sorted(self.codes[start:end], key=hashes.__getitem__))
+		self.hashes = array("l", (hashes[code] for code in self.codes))	#The hash for each code
+
+	def find(self, string):
+		#Returns the codes of an identifier as a list, which is empty if it
+		#isn't in the table. An identifier added more than once has all of its codes.
+		string_hash = hash(string)
+		bucket = (string_hash >> self.bucket_shift) & 0xFFFF
+		hashes = self.hashes
+		end = self.ends[bucket]
+		position = bisect.bisect_left(hashes, string_hash, self.starts[bucket], end)
+		codes = []
+		while position < end and hashes[position] == string_hash:
+			code = self.codes[position]
+			if self.table[code] == string:
+				codes.append(code)
+			position = position +1
+		return codes
+
+class CodeRanges():
+	#Lists of integer codes, one list for each key code (e.g. the taxids
+	#of each OG, or the OGs each protein is in), stored as ranges of a 
+	#single array. Keys without a list get an empty range.
+	
+	def __init__(self, starts=None, ends=None, values=None):
+		self.starts = starts or array("i")	#Where each key's list starts in values
+		self.ends = ends or array("i")	#Where each key's list ends in values
+		self.values = values or array("i")
+	
+	def __len__(self):
+		return len(self.starts)
+	
+	def set(self, key, codes):
+		#Sets the list for a key, replacing any list it already had.
+		if key >= len(self.starts):
+			padding = array("i", [0]) * (key +1 - len(self.starts))
+			self.starts.extend(padding)
+			self.ends.extend(padding)
+		self.starts[key] = len(self.values)
+		self.values.extend(codes)
+		self.ends[key] = len(self.values)
+	
+	def update(self, other, value_codes, key_codes=None):
+		#Sets the list for each key with a non-empty list in other, another
+		#CodeRanges, replacing any list it already had. Values are mapped 
+		#through value_codes, and keys through key_codes if given.
+		offset = len(self.values)
+		other_values = other.values
+		self.values.extend(array("i", [value_codes[value] for value in other_values]))
+		if len(other) == 0:
+			return
+		key_count = len(other)
+		if key_codes is not None:
+			key_count = max(key_codes) +1
+		if key_count > len(self.starts):
+			padding = array("i", [0]) * (key_count - len(self.starts))
+			self.starts.extend(padding)
+			self.ends.extend(padding)
+		starts = self.starts
+		ends = self.ends
+		other_starts = other.starts
+		other_ends = other.ends
+		for other_key in range(len(other)):
+			start = other_starts[other_key]
+			end = other_ends[other_key]
+			if end > start:
+				key = other_key
+				if key_codes is not None:
+					key = key_codes[other_key]
+				starts[key] = start + offset
+				ends[key] = end + offset
+	
+	def get(self, key):
+		#Returns the list for a key as an array, empty if it has none.
+		if key >= len(self.starts):
+			return self.values[0:0]
+		return self.values[self.starts[key]:self.ends[key]]
+
+class BlockReader():
+	#Reads a gzipped file in blocks of whole lines. Block k is the lines
+	#starting within the k-th parse_block_size bytes of the decompressed
+	#text, so every process can read the blocks it is given by itself, 
+	#without any lines being passed between them. Blocks are read going
+	#forward, inflating the file in this process and only keeping the text
+	#from the block being looked for on.
+	
+	def __init__(self, filename):
+		self.filename = filename
+		self.infile = open(filename, "rb")
+		self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)	#16 for the gzip header
+		self.text = ""	#Decompressed text kept so far
+		self.text_start = 0	#Where self.text starts in the decompressed file
+		self.keep_from = 0	#Text before this is dropped when inflating more
+		self.next_block = 0
+		self.ended = False
+	
+	def inflate(self):
+		#Decompresses the next chunk of the file onto the text kept.
+		dropped = min(self.keep_from - self.text_start, len(self.text))
+		if dropped > 0:
+			self.text = self.text[dropped:]
+			self.text_start = self.text_start + dropped
+		chunk = self.infile.read(1048576)
+		if not chunk:
+			self.text = self.text + self.decompressor.flush()
+			self.ended = True
+			return
+		text = self.decompressor.decompress(chunk)
+		while self.decompressor.unused_data:	#Another gzip member follows, as gzip.open allows
+			unused_data = self.decompressor.unused_data
+			self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			text = text + self.decompressor.decompress(unused_data)
+		self.text = self.text + text
+	
+	def lineStart(self, position):
+		#Returns the position of the first line starting at or after position,
+		#or the end of the file if there is none.
+		if position == 0:
+			return 0
+		while True:
+			newline = self.text.find("\n", position -1 - self.text_start)
+			if newline >= 0:
+				return self.text_start + newline +1
+			if self.ended:
+				return max(position, self.text_start + len(self.text))
+			self.inflate()
+	
+	def block(self, number):
+		#Returns the lines of a block (at or after the last one read), 
+		#without their line endings, or None if the file ends before it.
+		self.keep_from = max(number * parse_block_size -1, 0)
+		start = self.lineStart(number * parse_block_size)
+		self.keep_from = start
+		while start >= self.text_start + len(self.text) and not self.ended:	#To tell if the file ends here
+			self.inflate()
+		end = start	#Empty if a long line runs over the whole block
+		if start < (number +1) * parse_block_size:
+			end = self.lineStart((number +1) * parse_block_size)
+		self.next_block = number +1
+		if start >= self.text_start + len(self.text) and self.ended:
+			return None
+		lines = self.text[start - self.text_start:end - self.text_start].split("\n")
+		if lines[-1] == "":	#After the last line ending
+			lines.pop()
+		return lines
+	
+	def compressedPosition(self):
+		#Returns how far into the compressed file this has read.
+		return self.infile.tell()
+	
+	def close(self):
+		self.infile.close()
+
+class StringTable():
+	#A sorted table of strings within a map store.
+	#Stored as (count + 1) 32-bit offsets followed by the concatenated strings,
+	#so any string can be read, or found by binary search, without
+	#reading the rest of the table.
+	
+	def __init__(self, data, offsets_start, blob_start, count):
+		self.data = data
+		self.offsets_start = offsets_start
+		self.blob_start = blob_start
+		self.count = count
+	
+	def __len__(self):
+		return self.count
+	
+	def __getitem__(self, i):
+		start, end = struct.unpack_from("<2I", self.data, self.offsets_start + 4 * i)
+		return self.data[self.blob_start + start:self.blob_start + end]
+	
+	def find(self, key):
+		#Returns the position of key in the table or -1 if it isn't there.
+		low = 0
+		high = self.count
+		while low < high:
+			middle = (low + high) // 2
+			if self[middle] < key:
+				low = middle +1
+			else:
+				high = middle
+		if low < self.count and self[low] == key:
+			return low
+		return -1
+
+class MapView():
+	#Read-only, dict-style access to one of the lookups in a map store,
+	#given by the name of its method. Only a weak reference to the store
+	#is kept, so the store and its views don't form a reference cycle, and
+	#the store is freed (unmapping and closing its file) as soon as nothing
+	#else uses it. Views are only used through their store.
+	
+	def __init__(self, store, lookup_name):
+		self.store = weakref.ref(store)
+		self.lookup_name = lookup_name
+	
+	def lookup(self, key):
+		return getattr(self.store(), self.lookup_name)(key)
+	
+	def __contains__(self, key):
+		return self.lookup(key) is not None
+	
+	def __getitem__(self, key):
+		value = self.lookup(key)
+		if value is None:
+			raise KeyError(key)
+		return value
+	
+	def get(self, key, default=None):
+		value = self.lookup(key)
+		if value is None:
+			return default
+		return value
+
+class MapStore():
+	#A binary eggNOG map file, as written by writeMapStore, opened with mmap.
+	#Only the pages touched by each lookup get read from disk.
+	#uniprot_to_og and og_to_taxid can be used like the dicts they replace.
+	
+	def __init__(self, filename):
+		self.filename = filename
+		self.map_file = open(filename, "rb")
+		self.data = mmap.mmap(self.map_file.fileno(), 0, access=mmap.ACCESS_READ)
+		header = struct.unpack_from(map_store_header, self.data, 0)
+		if header[0] != map_store_magic:
+			self.close()
+			raise ValueError("%s is not a map store file." % filename)
+		upid_count, og_count, taxid_count = header[1:4]
+		sections = header[4:]
+		self.upids = StringTable(self.data, sections[0], sections[1], upid_count)
+		self.upid_ogs_start = sections[2]	#OG number for each UPID
+		self.ogs = StringTable(self.data, sections[3], sections[4], og_count)
+		self.og_taxid_offsets_start = sections[5]	#Where each OG's taxids start and end
+		self.og_taxids_start = sections[6]	#Taxid numbers for all OGs, in order
+		self.taxids = StringTable(self.data, sections[7], sections[8], taxid_count)
+		self.uniprot_to_og = MapView(self, "ogFor")
+		self.og_to_taxid = MapView(self, "taxidsFor")
+	
+	def ogFor(self, upid):
+		#Returns the OG for a Uniprot ID, or None if it isn't mapped.
+		position = self.upids.find(upid)
+		if position < 0:
+			return None
+		og_number = struct.unpack_from("<I", self.data, self.upid_ogs_start + 4 * position)[0]
+		return self.ogs[og_number]
+	
+	def taxidsFor(self, og):
+		#Returns the taxids an OG has members in, in their original order,
+		#or None if the OG isn't in the store.
+		og_number = self.ogs.find(og)
+		if og_number < 0:
+			return None
+		start, end = struct.unpack_from("<2I", self.data, self.og_taxid_offsets_start + 4 * og_number)
+		if start == end:	#OGs only seen in the UPID map have no taxids
+			return None
+		taxid_numbers = struct.unpack_from("<%sI" % (end - start), self.data, self.og_taxids_start + 4 * start)
+		return [self.taxids[taxid_number] for taxid_number in taxid_numbers]
+	
+	def snapshot(self):
+		#Returns the name this store has in every build (its file name 
+		#without the date), and an identifier for this build of it.
+		store_name = os.path.basename(self.filename)
+		return store_name[:-len("????-??-??.bin")], "%s %s %r" % tuple([store_name] + sourceStamp(self.filename))
+	
+	def close(self):
+		self.data.close()
+		self.map_file.close()
+
+class RunReport():
+	#Collects the timings of each stage of a run, to be written as a 
+	#JSON run report. Stages are timed with StageTimers from stage().
+	#If progress is on, a progress bar is drawn on stderr for each stage.
+	
+	def __init__(self):
+		self.start_time = time.time()
+		self.stages = []	#A dict for each finished stage
+		self.progress = False
+	
+	def stage(self, name, total=None):
+		#Starts timing a stage. total is how far the stage has to go,
+		#in whatever units its progress is given (e.g. bytes of a file).
+		return StageTimer(self, name, total)
+	
+	def write(self, filename):
+		#Writes the report, with the totals for the whole run, as JSON.
+		run = {"started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.start_time)),
+				"wall_seconds": round(time.time() - self.start_time, 3),
+				"peak_rss_mb": peakMemory(),
+				"cache_hits": sum(stage["cache_hits"] for stage in self.stages),
+				"stages": self.stages}
+		with open(filename, "w") as report_file:
+			json.dump(run, report_file, indent=1, sort_keys=True)
+		return filename
+
+class StageTimer():
+	#Times one stage of a run and counts the rows it processes and any
+	#cached results it reuses. finish() adds it to its RunReport.
+	
+	def __init__(self, report, name, total=None):
+		self.report = report
+		self.name = name
+		self.total = total
+		self.position = 0	#Progress towards total
+		self.rows = 0
+		self.cache_hits = 0
+		self.start_time = time.time()
+		self.last_drawn = 0	#When the progress bar was last drawn
+	
+	def advance(self, rows, position=None):
+		#Counts rows as processed. position is the progress towards total,
+		#if it isn't counted in rows.
+		self.rows = self.rows + rows
+		if position is None:
+			self.position = self.position + rows
+		else:
+			self.position = position
+		if self.report.progress and time.time() - self.last_drawn > 0.5:
+			self.drawProgress()
+	
+	def hit(self):
+		#Counts a cached result as reused.
+		self.cache_hits = self.cache_hits +1
+	
+	def drawProgress(self):
+		self.last_drawn = time.time()
+		elapsed = self.last_drawn - self.start_time
+		if self.total:
+			fraction = min(float(self.position) / self.total, 1.0)
+			eta = "--:--"
+			if fraction > 0:
+				eta = "%02d:%02d" % divmod(int(elapsed / fraction - elapsed), 60)
+			bar = "#" * int(fraction * 30)
+			sys.stderr.write("\r%-24s [%-30s] %5.1f%% ETA %s " % (self.name[:24], bar, fraction * 100, eta))
+		else:
+			sys.stderr.write("\r%-24s %s rows, %ds " % (self.name[:24], self.rows, elapsed))
+		sys.stderr.flush()
+	
+	def finish(self):
+		#Stops timing the stage and records it in the report.
+		#Returns the record, as a dict.
+		elapsed = time.time() - self.start_time
+		if self.report.progress:
+			self.drawProgress()
+			sys.stderr.write("\n")
+		rate = 0
+		if elapsed > 0:
+			rate = self.rows / elapsed
+		record = {"stage": self.name, "wall_seconds": round(elapsed, 3), "rows": self.rows,
+				"rows_per_second": round(rate, 1), "peak_rss_mb": peakMemory(),
+				"cache_hits": self.cache_hits}
+		self.report.stages.append(record)
+		return record
+
+class MatrixWriter():
+	#Writes a labelled matrix (e.g. a conservation matrix) as tab-separated
+	#text: a header of column labels, then a row label and the cells of each row.
+	#Each row is formatted whole, with one format string, and rows are
+	#buffered and written a block at a time.
+	#If npz_filename is given, the same matrix is also written as a NumPy
+	#.npz archive (see writeNpz), with typecode as its array type.
+	#Rows may have more than one label: label_names then has a header for
+	#each label column (the first is usually empty). In the .npz, the 
+	#first labels are the rows array and the others are arrays named after
+	#their headers, in lower case.
+
+	def __init__(self, filename, column_labels, cell_format, typecode, npz_filename=None, block_rows=1000,
+				label_names=None):
+		self.filename = filename
+		self.column_labels = column_labels
+		self.row_format = "\t".join([cell_format] * len(column_labels))
+		self.npz_filename = npz_filename
+		self.block_rows = block_rows
+		self.label_names = label_names or [""]
+		self.row_labels = [[] for label_name in self.label_names]	#Each label column, for the .npz
+		self.values = array(typecode)	#All the cells, row by row, for the .npz
+		self.lines = []	#Rows not yet written
+		self.matrix_file = open(filename, "w+b")
+		self.matrix_file.write("\t".join(self.label_names) + "\t" + "\t".join(column_labels) + "\n")
+
+	def addRow(self, label, row):
+		#label is the row label, or a list of them with label_names.
+		#row is a sequence of numbers, one for each column.
+		labels = label
+		if len(self.label_names) == 1:
+			labels = [label]
+		self.lines.append("\t".join(labels) + "\t" + self.row_format % tuple(row) + "\n")
+		if len(self.lines) >= self.block_rows:
+			self.flush()
+		if self.npz_filename is not None:
+			for label_column, row_label in zip(self.row_labels, labels):
+				label_column.append(row_label)
+			self.values.extend(row)
+
+	def flush(self):
+		self.matrix_file.write("".join(self.lines))
+		del self.lines[:]
+
+	def close(self):
+		#Finishes writing. Returns the names of the files written.
+		self.flush()
+		self.matrix_file.close()
+		if self.npz_filename is None:
+			return [self.filename]
+		shape = (len(self.row_labels[0]), len(self.column_labels))
+		arrays = [("matrix", npyArray(self.values, shape)), ("rows", npyLabels(self.row_labels[0])),
+				("columns", npyLabels(self.column_labels))]
+		for label_name, label_column in zip(self.label_names[1:], self.row_labels[1:]):
+			arrays.append((label_name.lower(), npyLabels(label_column)))
+		writeNpz(self.npz_filename, arrays)
+		return [self.filename, self.npz_filename]
+
+class ResultCache():
+	#Per-complex results, kept between runs in a file written with marshal.
+	#Each result is found by a hash of everything it depends on (see
+	#resultKey), so only new or changed complexes need computing again.
+	#Results computed with a map store are dropped once that store gets
+	#rebuilt. Beyond max_bytes, the least recently used results are dropped.
+	#Saving merges in results saved meanwhile by other processes, such as
+	#batch workers.
+	#The cache file is kept in a directory of its own, which is locked
+	#while saving, so no lock file is left behind.
+	
+	def __init__(self, directory, max_bytes):
+		self.directory = directory
+		self.filename = os.path.join(directory, result_cache_filename)
+		self.max_bytes = max_bytes
+		self.entries = {}	#Keys are keys, values are [group, snapshot, last used, size, result]
+		self.snapshots = {}	#Map store groups in use are keys, their current snapshots are values
+		self.session_time = time.time()	#Last use time of every result used here
+		self.changed = False
+		self.read_stamp = None	#The stamp of the cache file when it was read
+		if os.path.isfile(self.filename):
+			self.read_stamp = sourceStamp(self.filename)
+			self.entries = self.read()
+	
+	def read(self):
+		#Returns the entries in the cache file, or none if it can't be read.
+		try:
+			with open(self.filename, "rb") as cache_file:
+				cached = marshal.load(cache_file)
+			if cached["version"] == result_cache_version:
+				return cached["entries"]
+		except (EOFError, KeyError, TypeError, ValueError):
+			pass	#Unreadable caches just get rebuilt
+		return {}
+	
+	def get(self, key):
+		#Returns the result for key, or None if it isn't cached.
+		entry = self.entries.get(key)
+		if entry is None:
+			return None
+		entry[2] = self.session_time
+		self.changed = True
+		return entry[4]
+	
+	def put(self, key, result, group=None, snapshot=None):
+		#Caches a result. If it was computed with a map store, group and
+		#snapshot are from that store's snapshot().
+		entry = [group, snapshot, self.session_time, 0, result]
+		entry[3] = len(key) + len(marshal.dumps(entry))	#Its size in the cache file
+		self.entries[key] = entry
+		self.changed = True
+	
+	def useSnapshot(self, group, snapshot):
+		#Records the snapshot of a map store group in use, dropping the
+		#results computed with any other build of it.
+		self.snapshots[group] = snapshot
+		self.dropStale(self.entries)
+	
+	def dropStale(self, entries):
+		stale_keys = [key for key in entries if entries[key][0] in self.snapshots 
+						and entries[key][1] != self.snapshots[entries[key][0]]]
+		for key in stale_keys:
+			del entries[key]
+		if len(stale_keys) >0:
+			self.changed = True
+	
+	def save(self):
+		#Writes the cache, if anything changed, under a temporary name,
+		#then renames it into place. Locking the cache directory keeps 
+		#other processes from saving at the same time.
+		if not self.changed:
+			return
+		try:
+			os.makedirs(self.directory)
+		except OSError:
+			if not os.path.isdir(self.directory):
+				raise
+		lock_descriptor = os.open(self.directory, os.O_RDONLY)
+		try:
+			fcntl.flock(lock_descriptor, fcntl.LOCK_EX)	#Released when closed
+			if os.path.isfile(self.filename) and sourceStamp(self.filename) != self.read_stamp:
+				saved_entries = self.read()	#Saved by another process since
+				self.dropStale(saved_entries)
+				for key in saved_entries:
+					if key not in self.entries or saved_entries[key][2] > self.entries[key][2]:
+						self.entries[key] = saved_entries[key]
+			total_size = sum(entry[3] for entry in self.entries.values())
+			if total_size > self.max_bytes:
+				for key in sorted(self.entries, key=lambda key: self.entries[key][2]):
+					total_size = total_size - self.entries[key][3]
+					del self.entries[key]
+					if total_size <= self.max_bytes:
+						break
+			temp_filename = self.filename + ".tmp"
+			with open(temp_filename, "wb") as cache_file:
+				marshal.dump({"version": result_cache_version, "entries": self.entries}, cache_file)
+			os.rename(temp_filename, self.filename)
+			self.read_stamp = sourceStamp(self.filename)
+			self.changed = False
+		finally:
+			os.close(lock_descriptor)
+
+class QueryService():
+	#Keeps complex sets and a map store loaded to answer queries about
+	#single complexes (see serveQueries). Used by many request threads.
+	#The map store is swapped for a new one when it gets rebuilt on disk:
+	#requests keep using the store they started with, and a replaced
+	#store is closed when the last request using it lets go of it.
+
+	def __init__(self, batch_jobs, id_conversion, locus_index, target_name=None, taxonomy=None):
+		self.complexes = {}	#Set names are keys, loaded complexes are values
+		self.unified = {}	#Experimental set names are keys, complexes with Uniprot components are values
+		self.models = {}	#Experimental set names are keys, lists of their model set names are values
+		self.model_indexes = {}	#Model set names are keys, inverted indexes of their complexes are values
+		for batch_job in batch_jobs:
+			for filename, name in [batch_job[0:2], batch_job[2:4]]:
+				if filename is not None and name not in self.complexes:
+					print("Loading %s as %s." % (filename, name))
+					self.complexes[name] = loadComplexes(filename, name)
+			exp_name, model_name = batch_job[1], batch_job[3]
+			if exp_name not in self.unified:
+				self.unified[exp_name] = unifyComplexes(self.complexes[exp_name], id_conversion, locus_index)[0]
+				self.models[exp_name] = []
+			if model_name is not None and model_name not in self.models[exp_name]:
+				self.models[exp_name].append(model_name)
+				if model_name not in self.model_indexes:
+					self.model_indexes[model_name] = indexComplexes(self.complexes[model_name])
+		self.target_name = target_name
+		self.store_arguments = [1, None, None]	#jobs, Uniprot IDs and taxids for building level shards
+		self.store_filter = "all"	#The filterKey of those Uniprot IDs and taxids
+		self.taxonomy = taxonomy
+		self.map_store = None
+		self.store_stamp = None	#Name, inode and modification time of the open store
+		self.reload_lock = threading.Lock()
+		self.level_lock = threading.Lock()	#Held while a level shard is looked for
+		self.level_builds = {}	#Levels whose shards are being built are keys, Events set when done are values
+		self.build_lock = threading.Lock()	#Held while a shard is built
+		self.reloads = 0
+		self.requests = 0
+		self.requests_lock = threading.Lock()	#Request threads count themselves in turn
+
+	def countRequest(self):
+		with self.requests_lock:
+			self.requests = self.requests +1
+
+	def reload(self):
+		#Opens the current map store on disk if it isn't the one already open.
+		#Returns True if a new store was opened.
+		with self.reload_lock:
+			store_filename = mapStoreFilename(self.target_name)
+			if store_filename is None:
+				return False
+			try:
+				store_stat = os.stat(store_filename)
+			except OSError:	#Replaced since it was found
+				return False
+			store_stamp = [store_filename, store_stat.st_ino, store_stat.st_mtime]
+			if store_stamp == self.store_stamp:
+				return False
+			store_entry = readBuildManifest().get(mapStorePattern(self.target_name)[0], {})
+			if self.map_store is not None and store_entry.get("filter", "all") != self.store_filter:
+				return False	#Rebuilt for other targets by another run; the open store still has ours
+			self.map_store = MapStore(store_filename)
+			self.store_stamp = store_stamp
+			self.reloads = self.reloads +1
+			print("Opened map store %s." % store_filename)
+			return True
+
+	def watch(self):
+		#Checks for a rebuilt map store every query_reload_interval seconds.
+		#Runs in its own thread.
+		while True:
+			time.sleep(query_reload_interval)
+			try:
+				self.reload()
+			except (IOError, OSError, ValueError) as e:
+				print("Couldn't reload the map store: %s" % e)
+
+	def status(self):
+		return {"store": self.store_stamp[0], "reloads": self.reloads, "requests": self.requests,
+				"sets": dict((name, len(self.complexes[name])) for name in self.complexes)}
+
+	def complexProfile(self, set_name, complex_name, score="jaccard", rank=None, levels=None):
+		#Answers a query about one complex. complex_name may leave out the
+		#set name prefix. With levels, gives the conservation at each of 
+		#those eggNOG levels instead of with the merged store.
+		#Returns a dict (see serveQueries), or None if there is no such complex.
+		if set_name not in self.complexes:
+			return None
+		if complex_name not in self.complexes[set_name]:
+			complex_name = set_name + "_" + complex_name
+		if complex_name not in self.complexes[set_name]:
+			return None
+		map_store = self.map_store	#Stays open for this request, even if the store is reloaded
+		members = self.complexes[set_name][complex_name]
+		profile = {"set": set_name, "complex": complex_name, "size": len(members), "members": members}
+
+		matches = {}	#Model set names are keys, best matches are values
+		score_column = {"jaccard": 0, "overlap": 1, "matching": 2}[score]
+		these_members = set(members)
+		for model_name in self.models.get(set_name, []):
+			model_complexes = self.complexes[model_name]
+			shared_counts = Counter()
+			for complex_member in these_members:
+				if complex_member in self.model_indexes[model_name]:
+					shared_counts.update(self.model_indexes[model_name][complex_member])
+			best_match = None
+			for model_complex in sorted(shared_counts):
+				scores = matchScores(shared_counts[model_complex], len(these_members),
+									len(set(model_complexes[model_complex])))
+				if best_match is None or scores[score_column] > best_match["scores"][score_column]:
+					best_match = {"complex": model_complex, "shared": shared_counts[model_complex],
+								"scores": scores}
+			if best_match is not None:
+				best_match.update(zip(["jaccard", "overlap", "matching"], best_match.pop("scores")))
+			matches[model_name] = best_match
+		profile["best_matches"] = matches
+
+		if set_name in self.unified:
+			components = self.unified[set_name][complex_name]
+			profile["components"] = components
+			if levels:	#One shard open at a time
+				profile["levels"] = {}
+				for level in levels:
+					level_store = self.levelStore(level)
+					profile["levels"][level] = self.conservation(components, level_store, rank)
+					level_store.close()
+			else:
+				profile.update(self.conservation(components, map_store, rank))
+		return profile
+
+	def conservation(self, components, map_store, rank=None):
+		#The components without an OG in map_store, and the fraction of the
+		#components present in each taxid (and in each clade at rank, with
+		#a taxonomy), as a dict.
+		taxid_counts = Counter()	#Taxids are keys, components present are values
+		clade_counts = Counter()	#The same for clades
+		unmapped = []
+		for component in components:
+			og = map_store.uniprot_to_og.get(component)
+			if og is None:
+				unmapped.append(component)
+				continue
+			taxids = set(map_store.og_to_taxid.get(og, []))
+			taxid_counts.update(taxids)
+			if rank is not None and self.taxonomy is not None:
+				clades = set(self.taxonomy.cladeOf(taxid, rank) for taxid in taxids)
+				clades.discard(None)
+				clade_counts.update(clades)
+		cplx_size = float(len(components))
+		conservation = {"unmapped": unmapped, 
+						"conservation": dict((taxid, taxid_counts[taxid] / cplx_size) for taxid in taxid_counts)}
+		if rank is not None and self.taxonomy is not None:
+			conservation[rank + "_conservation"] = dict((clade, clade_counts[clade] / cplx_size)
+														for clade in clade_counts)
+		return conservation
+
+	def levelStore(self, level):
+		#Opens the map store's shard for an eggNOG level, building it first
+		#if it isn't on disk or its sources have changed. So shards only get
+		#built when a query asks for their level.
+		#A shard is built outside level_lock, so requests for levels already
+		#built don't wait for it; requests for the same level wait for its
+		#Event. Builds still run one at a time, as they share the build 
+		#manifest and saved stages.
+		store_key = mapStorePattern(self.target_name, level)[0]
+		while True:
+			with self.level_lock:
+				store_filename = mapStoreFilename(self.target_name, level)
+				if store_filename is not None and not mapsOutdated(store_key, level, self.store_filter):
+					break
+				building = self.level_builds.get(level)
+				builder = building is None	#Whether this request builds the shard
+				if builder:
+					building = threading.Event()
+					self.level_builds[level] = building
+			if not builder:
+				building.wait()
+				continue	#Look again, in case the build failed
+			try:
+				with self.build_lock:
+					print("Building the map store for the %s level." % level)
+					get_eggnog_maps(self.store_arguments[0], self.store_arguments[1], self.store_arguments[2],
+									self.target_name, level)
+			finally:
+				with self.level_lock:
+					del self.level_builds[level]
+				building.set()
+		return MapStore(store_filename)
+
+class QueryServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+	#An HTTP server handling each request in its own thread.
+	daemon_threads = True
+	allow_reuse_address = True
+
+class QueryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	#Answers HTTP requests with JSON from the server's QueryService.
+
+	def do_GET(self):
+		service = self.server.service
+		service.countRequest()
+		url = urlparse.urlparse(self.path)
+		query = dict(urlparse.parse_qsl(url.query))
+		if url.path == "/status":
+			self.sendJSON(200, service.status())
+		elif url.path == "/sets":
+			self.sendJSON(200, dict((name, {"complexes": sorted(service.complexes[name]),
+											"models": service.models.get(name, [])})
+									for name in service.complexes))
+		elif url.path == "/complex":
+			if "set" not in query or "name" not in query:
+				self.sendJSON(400, {"error": "Queries need a set and a complex name."})
+				return
+			if query.get("score", "jaccard") not in ["jaccard", "overlap", "matching"]:
+				self.sendJSON(400, {"error": "Unknown score %s." % query["score"]})
+				return
+			levels = None
+			if query.get("levels"):
+				levels = query["levels"].split(",")
+				if len(unknownLevels(levels)) >0:
+					self.sendJSON(400, {"error": "Unknown eggNOG level(s): %s." % ", ".join(unknownLevels(levels))})
+					return
+			try:
+				profile = service.complexProfile(query["set"], query["name"], query.get("score", "jaccard"),
+												query.get("rank"), levels)
+			except (IOError, OSError, SystemExit) as e:	#e.g. a level's files couldn't be downloaded
+				self.sendJSON(503, {"error": "Couldn't open the map store: %s" % e})
+				return
+			if profile is None:
+				self.sendJSON(404, {"error": "No complex %s in set %s." % (query["name"], query["set"])})
+			else:
+				self.sendJSON(200, profile)
+		else:
+			self.sendJSON(404, {"error": "Unknown path %s." % url.path})
+
+	def do_POST(self):
+		service = self.server.service
+		service.countRequest()
+		if urlparse.urlparse(self.path).path == "/reload":
+			reloaded = service.reload()
+			self.sendJSON(200, {"reloaded": reloaded, "store": service.store_stamp[0]})
+		else:
+			self.sendJSON(404, {"error": "Unknown path %s." % self.path})
+
+	def sendJSON(self, status, content):
+		body = json.dumps(content, sort_keys=True)
+		self.send_response(status)
+		self.send_header("Content-Type", "application/json")
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		self.wfile.write(body)
+
+run_report = RunReport()	#Stages of this run; written out with --report
+result_caches = {}	#The ResultCache of this process, once loaded
+
 ##Functions
+def peakMemory():
+	#Returns the peak resident memory of this process so far, in MB.
+	#Linux gives ru_maxrss in kB, Mac OS in bytes.
+	peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == "darwin":
+		peak_rss = peak_rss / 1024
+	return round(peak_rss / 1024.0, 1)
+
+def npyBytes(descr, shape, data):
+	#Returns data (the raw bytes of an array, in C order) in NumPy's
+	#.npy format (version 1.0), so numpy.load() can read it.
+	header = "{'descr': '%s', 'fortran_order': False, 'shape': (%s), }" % (descr,
+				"".join("%d, " % length for length in shape))
+	header = header + " " * (63 - (10 + len(header)) % 64) + "\n"	#Pad so the data is 64-byte aligned
+	return "\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header + data
+
+def npyArray(values, shape):
+	#An array of numbers, as .npy. Only unsigned bytes and doubles are used.
+	byte_order = "<"
+	if sys.byteorder == "big":
+		byte_order = ">"
+	descr = {"B": "|u1", "d": byte_order + "f8"}[values.typecode]
+	return npyBytes(descr, shape, values.tostring())
+
+def npyLabels(labels):
+	#A list of labels, as a .npy array of fixed-length unicode strings.
+	labels = [label.decode("utf-8", "replace") for label in labels]
+	width = max([len(label) for label in labels] + [1])
+	data = "".join(label.ljust(width, u"\0").encode("utf-32-le") for label in labels)
+	return npyBytes("<U%d" % width, (len(labels),), data)
+
+def writeNpz(filename, arrays):
+	#Writes a compressed .npz archive, as numpy.savez_compressed would:
+	#arrays is a list of (name, .npy bytes) pairs.
+	with zipfile.ZipFile(filename, "w", zipfile.ZIP_DEFLATED) as npz_file:
+		for name, npy_data in arrays:
+			npz_file.writestr(name + ".npy", npy_data)
+	return filename
+
 def getEcoliIDs():
-	baseURL = "http://www.uniprot.org/docs/"
+	#Loads the E. coli ID conversion file, downloading it if needed.
+	#Returns a dictionary with UniprotAC's as keys and [bcode, jwcode]
+	#as values, and its inverted index from indexLocusIDs.
 	convfilename = "ecoli.txt"
-	convfilepath = baseURL + convfilename
+	convfilepath = uniprot_docs_url + convfilename
 	if os.path.isfile(convfilename): 
 		print("Found E. coli ID conversion file on disk: %s" % convfilename)
-		id_file = open(convfilename)
 	else:
-		print("Downloading E. coli ID mapping file from %s" % convfilepath)
-		response = urllib2.urlopen(convfilepath)
-		id_file = open(os.path.basename(convfilename), "w+b") #Start local file
-		chunk = 10240
-		while 1:
-			data = (response.read(chunk)) #Read 10 Kb at a time
-			id_file.write(data)
-			if not data:
-				print("\n%s file download complete." % convfilename)
-				break
-			sys.stdout.write(".")
-			
-	id_file.seek(0)
+		print("Downloading E. coli ID mapping file.")
+		try:
+			fetchFile(convfilepath, convfilename)
+		except IOError as e:
+			sys.exit(str(e))
+	ecoli_ids, locus_index = loadConversionTable(convfilename, parseEcoliIDs)
+	print("Mapped E. coli IDs.")
+	return ecoli_ids, locus_index
+
+def parseEcoliIDs(id_file):
+	#Parses the E. coli ID conversion file from Uniprot.
+	#The table starts at the first line beginning with a b-number
+	#and ends at the next empty line.
+	#Returns a dictionary with UniprotAC's as keys and [bcode, jwcode] as values.
 	capturing = 0	#Don't want the header so we iterate past it
-	first_id = "b0001" #For E. coli, this should be the first identifier
 	ecoli_ids = {}	#UniprotAC IDs are keys, bcode and jwcode are values
 	for line in id_file:
-		if first_id in line:
+		if capturing == 0 and re.match(r"\s*b[0-9]{4}", line):
 			capturing = 1
 		if capturing == 1 and not line.strip():	#That is, if we hit an empty line
 			break
 		if capturing == 1:
 			line_content = (line.rstrip()).split()
-			#print(line_content)
 			bcode = line_content[0][:5]
 			if line_content[1][:2] == "JW":
 				jwcode = line_content[1]
@@ -124,29 +1256,351 @@ def getEcoliIDs():
 				uniprotac = line_content[2]
 			gene_ids = [bcode, jwcode]
 			ecoli_ids[uniprotac] = gene_ids
-		
-	print("Mapped E. coli IDs.")
-	id_file.close()
 	return ecoli_ids
+
+def parseIDTable(id_file):
+	#Parses a general ID conversion table, for any organism: tab-separated
+	#lines of a UniprotAC followed by that protein's other IDs (e.g. locus
+	#tags or gene names). Empty lines and lines starting with # are skipped.
+	#Returns a dictionary with UniprotAC's as keys and lists of other IDs as values.
+	id_conversion = {}	#UniprotAC IDs are keys, other IDs are values
+	for line in id_file:
+		if not line.strip() or line.startswith("#"):
+			continue
+		line_content = (line.rstrip("\r\n")).split("\t")
+		other_ids = [identifier for identifier in line_content[1:] if identifier]
+		if line_content[0] in id_conversion:
+			id_conversion[line_content[0]].extend(other_ids)
+		else:
+			id_conversion[line_content[0]] = other_ids
+	return id_conversion
+
+def loadConversionTable(filename, parse_function):
+	#Loads a locus ID to Uniprot ID conversion table for any organism.
+	#parse_function takes the open table file and returns a dictionary with
+	#UniprotAC's as keys and lists of that organism's other IDs as values.
+	#The parsed table is cached next to the file, in filename + ".cache",
+	#keyed by the file's size, modification time and SHA-1 hash, so a new 
+	#Uniprot release of the table replaces the cached copy automatically.
+	#Returns the conversion dictionary and its inverted index from indexLocusIDs.
+	cache_filename = filename + ".cache"
+	timer = run_report.stage("load " + filename)
+	file_hash = hashlib.sha1()
+	with open(filename, "rb") as table_file:
+		for data in iter(lambda: table_file.read(1048576), ""):
+			file_hash.update(data)
+	file_stat = os.stat(filename)
+	cache_key = [conversion_cache_version, file_stat.st_size, file_stat.st_mtime, 
+				file_hash.hexdigest()]
+	if os.path.isfile(cache_filename):
+		try:
+			with open(cache_filename, "rb") as cache_file:
+				cached = pickle.load(cache_file)
+			if cached["key"] == cache_key:
+				print("Using cached ID conversion table %s." % cache_filename)
+				timer.hit()
+				timer.advance(len(cached["id_conversion"]))
+				timer.finish()
+				return cached["id_conversion"], cached["locus_index"]
+		except (EOFError, KeyError, TypeError, ValueError, pickle.UnpicklingError):
+			pass	#Unreadable caches just get rebuilt
+	with open(filename) as table_file:
+		id_conversion = parse_function(table_file)
+	locus_index = indexLocusIDs(id_conversion)
+	temp_filename = cache_filename + ".tmp"
+	with open(temp_filename, "wb") as cache_file:
+		pickle.dump({"key": cache_key, "id_conversion": id_conversion,
+					"locus_index": locus_index}, cache_file, 2)
+	os.rename(temp_filename, cache_filename)
+	timer.advance(len(id_conversion))
+	timer.finish()
+	return id_conversion, locus_index
+
+def indexLocusIDs(id_conversion):
+	#Inverts an ID conversion dictionary (UniprotAC's as keys, lists of
+	#other IDs as values, e.g. from getEcoliIDs).
+	#Returns a dictionary with each of the other IDs as keys and lists of 
+	#their UniprotAC's as values. "NA" placeholders are skipped.
+	locus_index = {}
+	for identifier in id_conversion:
+		for locus_id in id_conversion[identifier]:
+			if locus_id == "NA":
+				continue
+			if locus_id in locus_index:
+				locus_index[locus_id].append(identifier)
+			else:
+				locus_index[locus_id] = [identifier]
+	return locus_index
 	
-def convertToLong(filename):
-	#Converts short complex files (one complex per line)
-	#to long form (one complex member per line)
-	complex_members = {} #Complex names are keys, members are values
-	with open(filename) as shortfile:
-		shortfile.readline()	#skip the header
-		for line in shortfile:
-			line_content = (line.rstrip()).split()
-			complex_members[line_content[0]] = line_content[1:]
-			
-	long_file_name = filename[0:-4] + "_long.txt"
-	with open(long_file_name, "w+b") as longfile:
-		longfile.write("ProteinID\tComplexMembership\n")
-		for complex_name in complex_members:
-			for complex_member in complex_members[complex_name]:
-				longfile.write(complex_member + "\t" + complex_name + "\n")
-	return(long_file_name)
+def indexComplexes(complexes):
+	#Builds an inverted index for a dict of complexes.
+	#complexes has complex names as keys and collections of members as values.
+	#Returns a dict with protein IDs as keys and sets of the
+	#names of the complexes containing them as values.
+	complex_index = {}
+	for complex_name in complexes:
+		for complex_member in complexes[complex_name]:
+			if complex_member in complex_index:
+				complex_index[complex_member].add(complex_name)
+			else:
+				complex_index[complex_member] = set([complex_name])
+	return complex_index
 	
+def groupCodes(keys, values, key_count):
+	#Groups pairs of integer codes (keys[i], values[i]) by key, keeping the
+	#order of the values for each key, with a counting sort over the arrays.
+	#Returns a CodeRanges with key_count keys.
+	grouped = CodeRanges(array("i", [0]) * key_count, array("i", [0]) * key_count, 
+						array("i", [0]) * len(values))
+	for key in keys:
+		grouped.ends[key] = grouped.ends[key] +1
+	position = 0
+	for key, key_size in enumerate(grouped.ends):
+		grouped.starts[key] = position
+		grouped.ends[key] = position
+		position = position + key_size
+	for i, key in enumerate(keys):
+		grouped.values[grouped.ends[key]] = values[i]
+		grouped.ends[key] = grouped.ends[key] +1
+	return grouped
+
+def sortCodes(codes, key, chunk_size=262144):
+	#Sorts integer codes, given in increasing order, by key(code). Codes with
+	#the same key stay in increasing order.
+	#The keys of every code are never held at once: chunks of codes are
+	#sorted one at a time and then merged, working out each key again.
+	#Returns an iterator over (key, code) tuples, in order.
+	chunks = []	#Sorted chunks, as arrays of codes
+	codes = iter(codes)
+	while True:
+		chunk = array("i", itertools.islice(codes, chunk_size))
+		if len(chunk) == 0:
+			break
+		chunks.append(array("i", sorted(chunk, key=key)))
+	return heapq.merge(*[((key(code), code) for code in chunk) for chunk in chunks])
+
+def internMaps(upid_to_og, og_taxid_map):
+	#Converts a Uniprot ID to OG dict and an OG to taxid list dict
+	#into the interned tables taken by writeMapStore.
+	upids = IdentifierTable()
+	ogs = IdentifierTable()
+	taxids = IdentifierTable()
+	upid_ogs = array("i")
+	og_taxids = CodeRanges()
+	for upid in upid_to_og:
+		upids.append(upid)
+		upid_ogs.append(ogs.code(upid_to_og[upid]))
+	for og in og_taxid_map:
+		og_taxids.set(ogs.code(og), [taxids.code(taxid) for taxid in og_taxid_map[og]])
+	return upids, upid_ogs, ogs, og_taxids, taxids
+
+def writeMapStore(filename, upids, upid_ogs, ogs, og_taxids, taxids):
+	#Writes the Uniprot ID to OG map and the OG to taxid map
+	#as a single binary file, to be opened with MapStore.
+	#Takes the interned tables: IdentifierTables of UPIDs, OGs and taxids,
+	#an array of the OG code for each UPID code (-1 if it has none), and
+	#a CodeRanges of the taxid codes for each OG code (see internMaps).
+	#A UPID may be in its table more than once; the last code for it is used.
+	#Layout: a header, then string tables of UPIDs, OGs and taxids
+	#(each sorted), the OG number for each UPID, and an offset-indexed
+	#array of taxid numbers for each OG.
+	#The file is written under a temporary name and then renamed,
+	#so a partly-written store is never picked up.
+	
+	def uint_array(values):
+		this_array = array("I", values)
+		if this_array.itemsize != 4:
+			this_array = array("L", values)
+		if sys.byteorder == "big":
+			this_array.byteswap()
+		return this_array
+	
+	def string_table(table, codes):	#The identifiers for codes, in that order
+		offsets = array("l", [0])
+		blob = bytearray()
+		for code in codes:
+			blob.extend(table.blob[table.offsets[code]:table.offsets[code +1]])
+			offsets.append(len(blob))
+		return [uint_array(offsets), str(blob)]
+	
+	def sorted_codes(table, codes):	#Codes in the order of their identifiers
+		return array("i", (code for string, code in sortCodes(codes, table.__getitem__)))
+	
+	def numbering(codes, code_count):	#Position of each code in the sorted order
+		numbers = array("i", [-1]) * code_count
+		for number, code in enumerate(codes):
+			numbers[code] = number
+		return numbers
+	
+	upid_order = array("i")
+	previous_upid = None
+	for upid, upid_code in sortCodes(xrange(len(upids)), upids.__getitem__):	#Later codes come last
+		if upid == previous_upid:
+			upid_order[-1] = upid_code
+		else:
+			upid_order.append(upid_code)
+		previous_upid = upid
+	upid_order = array("i", (upid_code for upid_code in upid_order if upid_ogs[upid_code] >= 0))
+	og_order = sorted_codes(ogs, xrange(len(ogs)))
+	og_numbers = numbering(og_order, len(ogs))
+	used_taxids = set()
+	for og in range(len(og_taxids)):
+		used_taxids.update(og_taxids.get(og))
+	taxid_order = sorted_codes(taxids, sorted(used_taxids))
+	taxid_numbers = numbering(taxid_order, len(taxids))
+	
+	upid_og_numbers = uint_array(og_numbers[upid_ogs[upid]] for upid in upid_order)
+	og_taxid_offsets = array("i", [0])
+	og_taxid_numbers = array("i")
+	for og in og_order:
+		og_taxid_numbers.extend(taxid_numbers[taxid] for taxid in og_taxids.get(og))
+		og_taxid_offsets.append(len(og_taxid_numbers))
+	
+	sections = (string_table(upids, upid_order) + [upid_og_numbers] + string_table(ogs, og_order) + 
+				[uint_array(og_taxid_offsets), uint_array(og_taxid_numbers)] + 
+				string_table(taxids, taxid_order))
+	header_size = struct.calcsize(map_store_header)
+	header_size = header_size + (-header_size % 4)
+	section_starts = []
+	position = header_size
+	for section in sections:
+		section_starts.append(position)
+		if isinstance(section, str):
+			section_size = len(section)
+		else:
+			section_size = len(section) * 4
+		position = position + section_size + (-section_size % 4)	#Keep each section aligned
+	
+	temp_filename = filename + ".tmp"
+	with open(temp_filename, "w+b") as store_file:
+		header = struct.pack(map_store_header, map_store_magic, len(upid_order), len(og_order),
+							len(taxid_order), *section_starts)
+		store_file.write(header + "\0" * (header_size - len(header)))
+		for section in sections:
+			if isinstance(section, str):
+				store_file.write(section + "\0" * (-len(section) % 4))
+			else:
+				section.tofile(store_file)
+	os.rename(temp_filename, filename)
+	return filename
+
+def readTextMaps(map_filename, taxon_filename):
+	#Loads the older text versions of the map files,
+	#uniprot_og_maps_*.txt and og_to_taxid_*.txt, as dicts.
+	uniprot_to_og = {}
+	og_to_taxid = {}
+	print("Loading map file %s..." % map_filename)
+	with open(map_filename) as id_map_file:
+		linecount = 0
+		for line in id_map_file:
+			linecount = linecount +1
+			if linecount % 10000 == 0:
+				sys.stdout.write(".")
+			line_content = (line.rstrip()).split("\t")
+			uniprot_to_og[line_content[0]] = line_content[1]
+	print("\nLoading OG vs taxon file %s..." % taxon_filename)
+	with open(taxon_filename) as taxon_file:
+		linecount = 0
+		for line in taxon_file:
+			linecount = linecount +1
+			if linecount % 10000 == 0:
+				sys.stdout.write(".")
+			line_content = (line.rstrip()).split("\t")
+			these_taxids = line_content[1].split(" ")
+			og_to_taxid[line_content[0]] = these_taxids
+	return uniprot_to_og, og_to_taxid
+
+def loadComplexes(filename, name, layout=None):
+	#Loads a complex file, in either layout, as a dict (see readComplexMembers).
+	#The layout is complex_layout unless given.
+	#Complex names (the set name, then the complex identifier) are keys, lists of members are values.
+	if layout is None:
+		layout = complex_layout
+	complexes = {}
+	timer = run_report.stage("load " + filename)
+	for memberships in readComplexMembers(filename, layout):
+		for complex_id, complex_member in memberships:
+			complex_name = name + "_" + complex_id
+			if complex_name in complexes:
+				complexes[complex_name].append(complex_member)
+			else:
+				complexes[complex_name] = [complex_member]
+		timer.advance(len(memberships))
+	timer.finish()
+	return complexes
+
+def readComplexMembers(filename, layout=None, block_size=100000):
+	#Streams the memberships in a complex file, in "long" layout (one 
+	#complex member per line) or "short" layout (one complex per line).
+	#See the top of this file for both. The layout is detected from the
+	#header and the first block of lines unless given (see complexLayout).
+	#Long files only use their first two columns, so may have more.
+	#Gzipped files are read without decompressing them to disk.
+	#Skips the header, empty lines and repeated memberships, so
+	#duplicate lines don't count twice.
+	#Yields lists of (complex identifier, member) pairs, one for each
+	#block_size lines. Only one block is held at a time, along with
+	#the members seen so far for each complex.
+	with open(filename, "rb") as test_file:
+		gzipped = test_file.read(2) == "\x1f\x8b"
+	if gzipped:
+		complex_file = openCompressed(filename)
+	else:
+		complex_file = open(filename, "rb")
+	seen_members = {}	#Complex identifiers are keys, sets of their members are values
+	with complex_file:
+		header = complex_file.readline()
+		for lines in readLineBlocks(complex_file, block_size):
+			if layout is None:
+				layout = complexLayout(header, lines)
+				if layout is None:
+					sys.exit("Can't tell whether %s is a long or a short complex file. "
+							"Please give its layout with --layout long or --layout short." % filename)
+			memberships = []
+			for line in lines:
+				line_content = line.split()
+				if len(line_content) < 2:
+					continue
+				if layout == "long":
+					line_memberships = [(line_content[1], line_content[0])]
+				else:
+					line_memberships = [(line_content[0], complex_member) for complex_member in line_content[1:]]
+				for complex_id, complex_member in line_memberships:
+					if complex_id not in seen_members:
+						seen_members[complex_id] = set()
+					if complex_member not in seen_members[complex_id]:
+						seen_members[complex_id].add(complex_member)
+						memberships.append((complex_id, complex_member))
+			yield memberships
+
+def complexLayout(header, lines):
+	#Works out the layout of a complex file from its header and first lines.
+	#A header starting with a protein column (e.g. ProteinID) means long,
+	#and one starting with a complex column (e.g. CplxID) means short.
+	#Otherwise, lines with no more than two fields are long. Wider lines 
+	#are long if the complexes in the second column repeat and the proteins
+	#in the first column do too, and short if the complexes in the first
+	#column don't repeat and the proteins in the second column don't either.
+	#Returns "long", "short", or None if the lines fit either layout.
+	#(Short files where every complex has a single member look long.)
+	header_fields = header.lower().split()
+	if len(header_fields) > 0:
+		if "complex" in header_fields[0] or "cplx" in header_fields[0]:
+			return "short"
+		if "protein" in header_fields[0]:
+			return "long"
+	rows = set(tuple(line.split()) for line in lines)	#Repeated lines only count once
+	rows = [row for row in rows if len(row) >= 2]
+	if all(len(row) <= 2 for row in rows):
+		return "long"
+	first_repeats = len(set(row[0] for row in rows)) < len(rows)
+	second_repeats = len(set(row[1] for row in rows)) < len(rows)
+	if first_repeats and second_repeats:
+		return "long"
+	if not first_repeats and not second_repeats:
+		return "short"
+	return None
+
 def compareSets(filename1, name1, filename2, name2, mode):
 	#filename1 is the "experimental" file
 	#filename2 is the model file
@@ -154,49 +1608,50 @@ def compareSets(filename1, name1, filename2, name2, mode):
 	#be very similar or even just integers.
 	#Mode determines if we need to convert interactor IDs.
 	
-	exp_complexes = {} #Complex names are keys, members are values
-	model_complexes = {} #Complex names are keys, members are values
-	exp_conservation = {}	#Complex names are keys, conservation values are values
-	
 	#Load the files and store as dicts
-	with open(filename1) as file1:
-		file1.readline()	#skip the header
-		for line in file1:
-			line_content = (line.rstrip()).split()
-			complex_name = name1 + "_" + line_content[1]
-			if complex_name in exp_complexes:
-				exp_complexes[complex_name].append(line_content[0])
-			else:
-				exp_complexes[complex_name] = [line_content[0]]
-	with open(filename2) as file2:
-		file2.readline()	#skip the header
-		for line in file2:
-			line_content = (line.rstrip()).split()
-			complex_name = name2 + "_" + line_content[1]
-			if complex_name in model_complexes:
-				model_complexes[complex_name].append(line_content[0])
-			else:
-				model_complexes[complex_name] = [line_content[0]]
+	exp_complexes = loadComplexes(filename1, name1)
+	model_complexes = loadComplexes(filename2, name2)
+	return compareComplexSets(exp_complexes, name1, model_complexes, name2)
+
+def compareComplexSets(exp_complexes, name1, model_complexes, name2):
+	#Compares loaded complex sets, as from loadComplexes, and writes the output file.
+	#exp_complexes is the "experimental" set and model_complexes is the model set.
+	#Results for complexes compared with the same model set before are
+	#reused from the ResultCache.
+	
+	model_complexes = dict((complex_name, set(model_complexes[complex_name])) 
+							for complex_name in model_complexes)	#Complex names are keys, sets of members are values
+	exp_conservation = {}	#Complex names are keys, conservation values are values
+	model_index = indexComplexes(model_complexes)	#Protein IDs are keys, sets of model complexes are values
+	timer = run_report.stage("compare %s vs %s" % (name1, name2), len(exp_complexes))
+	cache = resultCache()
+	if cache is not None:
+		model_key = complexSetKey(model_complexes)
 	
 	#Now compare the exp. complexes to the model
 	for complex_name in exp_complexes:	#For each complex in the experimental set
+		timer.advance(1)
+		if cache is not None:
+			result_key = resultKey("compared", model_key, exp_complexes[complex_name])
+			cached = cache.get(result_key)
+			if cached is not None:
+				exp_conservation[complex_name] = cached
+				timer.hit()
+				continue
 		exp_conservation[complex_name] = [0,0]	#No conservation by default
 		any_conserved = 0 #Coverage of this complex across the whole model set
 		for complex_member in exp_complexes[complex_name]:	#For each complex member
-			members_counted = []	#List of members already found, so we don't double-count
-			for model_complex in model_complexes:	#Search across all model complexes
-				complex_con = 0	#The maximum coverage of any model complex
-				con_members_conserved = 0
-				if complex_member in model_complexes[model_complex]:	#If the complex member is in the model set
-					con_members_conserved = con_members_conserved +1	#Increment its conservation by one
-					if complex_member not in members_counted:
-						any_conserved = any_conserved +1
-					members_counted.append(complex_member)
-					complex_con = float(con_members_conserved)/len(model_complexes[model_complex])
-					if complex_con > exp_conservation[complex_name][0]:	#Set maximum complex conservation to the largest value
-						exp_conservation[complex_name][0] = complex_con
+			if complex_member not in model_index:	#Not in any model complex
+				continue
+			any_conserved = any_conserved +1
+			for model_complex in model_index[complex_member]:	#Only the model complexes containing this member
+				complex_con = 1.0/len(model_complexes[model_complex])	#The coverage of this model complex
+				if complex_con > exp_conservation[complex_name][0]:	#Set maximum complex conservation to the largest value
+					exp_conservation[complex_name][0] = complex_con
 		any_coverage = float(any_conserved)/len(exp_complexes[complex_name])
 		exp_conservation[complex_name][1] = any_coverage
+		if cache is not None:
+			cache.put(result_key, exp_conservation[complex_name])
 	
 	#Output for each exp. complex:
 	#maximum conservation in a single complex
@@ -208,438 +1663,1938 @@ def compareSets(filename1, name1, filename2, name2, mode):
 			compared_file.write("%s\t%5.4f\t%5.4f\n" % (complex_name,
 								exp_conservation[complex_name][0],
 								exp_conservation[complex_name][1]))
+	if cache is not None:
+		cache.save()
+	timer.finish()
 	
 	return compared_file_name
 	
-def compareSpecies(filename1, name1, id_conversion):
-	#filename1 is the "experimental" file
-	#name1 is the short name of the set
-	#id_conversion is a dictionary with UniprotAC's as keys
-	#and values of two types. For E. coli those types are bcode and
-	#JW-code, in that order.
+def overlapComplexSets(exp_complexes, name1, model_complexes, name2, top_k=5, score="jaccard"):
+	#Compares every experimental complex to every model complex, as
+	#loaded by loadComplexes, and writes the best matches for each.
+	#Shared members come from a sparse product of the experimental complexes
+	#with the model protein index, so only overlapping pairs are ever visited.
+	#Scores for each pair are the Jaccard index, the overlap coefficient
+	#(shared / size of the smaller complex) and the matching ratio
+	#(shared squared / product of sizes). Matches are ranked by score,
+	#one of "jaccard", "overlap" or "matching".
+	#top_k is the number of matches to write per complex; 0 writes all overlapping pairs.
+	#Complexes without any overlap get one row with NA as the match.
+	#Returns the name of the output file.
+	score_columns = {"jaccard": 0, "overlap": 1, "matching": 2}
+	score_column = score_columns[score]
+	model_complexes = dict((complex_name, set(model_complexes[complex_name])) 
+							for complex_name in model_complexes)
+	model_index = indexComplexes(model_complexes)	#Protein IDs are keys, sets of model complexes are values
 	
-	#This method requires the eggNOG map files and downloads them if needed
+	overlap_file_name = "overlap_complexes_" + name1 + "_vs_" + name2 + ".txt"
+	timer = run_report.stage("overlap %s vs %s" % (name1, name2), len(exp_complexes))
+	with open(overlap_file_name, "w+b") as overlap_file:
+		overlap_file.write(name1 + "_Complex\tRank\t" + name2 + "_Complex\tShared\tJaccard\tOverlap\tMatchingRatio\n")
+		for complex_name in exp_complexes:
+			timer.advance(1)
+			these_members = set(exp_complexes[complex_name])
+			shared_counts = Counter()	#Model complexes are keys, shared members are values
+			for complex_member in these_members:
+				if complex_member in model_index:
+					shared_counts.update(model_index[complex_member])
+			matches = []
+			for model_complex in shared_counts:
+				shared = shared_counts[model_complex]
+				scores = matchScores(shared, len(these_members), len(model_complexes[model_complex]))
+				matches.append((-scores[score_column], model_complex, shared, scores))
+			matches.sort()
+			if top_k > 0:
+				matches = matches[:top_k]
+			if len(matches) == 0:
+				overlap_file.write("%s\t1\tNA\t0\t%5.4f\t%5.4f\t%5.4f\n" % (complex_name, 0, 0, 0))
+			rank = 0
+			for match in matches:
+				rank = rank +1
+				overlap_file.write("%s\t%s\t%s\t%s\t%5.4f\t%5.4f\t%5.4f\n" % 
+									(complex_name, rank, match[1], match[2], 
+									match[3][0], match[3][1], match[3][2]))
+	timer.finish()
+	return overlap_file_name
+
+def matchScores(shared, size1, size2):
+	#Scores two overlapping complexes of size1 and size2 members with shared
+	#members in common. Returns the Jaccard index, overlap coefficient and
+	#matching ratio, in that order (see overlapComplexSets).
+	return [float(shared) / (size1 + size2 - shared),
+			float(shared) / min(size1, size2),
+			float(shared * shared) / (size1 * size2)]
+
+def resultCache():
+	#Returns the ResultCache, loading it the first time it is needed.
+	#Returns None if caching is off.
+	if result_cache_dir is None or result_cache_size <= 0:
+		return None
+	if "results" not in result_caches:
+		result_caches["results"] = ResultCache(result_cache_dir, result_cache_size * 1048576)
+	return result_caches["results"]
+
+def resultKey(kind, source_key, members):
+	#Returns the key of a cached per-complex result: a hash of the kind of
+	#result, a key for what it was computed with (e.g. a map store snapshot)
+	#and the complex's members, in any order.
+	key_hash = hashlib.sha1()
+	key_hash.update("%s\n%s\n" % (kind, source_key))
+	key_hash.update("\t".join(sorted(members)))
+	return key_hash.digest()
+
+def complexSetKey(complexes):
+	#Returns a key for the content of a complex set, leaving out the
+	#complex names and the order of complexes and members.
+	set_hash = hashlib.sha1()
+	for members in sorted("\t".join(sorted(complexes[complex_name])) for complex_name in complexes):
+		set_hash.update(members + "\n")
+	return set_hash.hexdigest()
+
+def fetchFile(fileURL, filename, expected_md5=None):
+	#Downloads a file to disk, one Mb at a time.
+	#Data goes to filename + ".part" until the download is complete, so a
+	#partial file is never mistaken for a whole one. An interrupted download
+	#is resumed with an HTTP Range request, on retry or on the next run.
+	#Before the file is renamed into place, its size must match the size
+	#reported by the server and its MD5 checksum must match expected_md5 or
+	#the server's Content-MD5 header, if either is available. Gzipped files
+	#must also read through to the end with their CRC intact.
+	#The checksum of the verified file is kept in filename + ".md5", so 
+	#checkFile can tell later if it has changed on disk.
+	partial_filename = filename + ".part"
+	timer = run_report.stage("download " + filename)
+	attempt = 0
+	while True:
+		attempt = attempt +1
+		try:
+			server_md5 = fetchPart(fileURL, partial_filename, timer)
+			break
+		except (IOError, httplib.HTTPException) as e:
+			if attempt > download_retries or (isinstance(e, urllib2.HTTPError) and e.code < 500):
+				raise IOError("Download of %s failed: %s" % (fileURL, e))
+			print("\nDownload of %s was interrupted (%s). Resuming..." % (fileURL, e))
 	
-	def get_eggnog_maps(): 
-		#Download and unzip the eggNOG ID conversion file 
-		#Filters file to just Uniprot IDs; the resulting file is the map file.
-		#One Uniprot ID may correspond to multiple OGs - e.g. COG1234,COG3810,COG9313. 
-		#these cases are considered OGs in their own right as this may indicate a pattern of conserved sequences on its own 
-		baseURL = "http://eggnogdb.embl.de/download/latest/"
-		convfilename = "eggnog4.protein_id_conversion.tsv.gz "	#File contains ALL database identifiers and corresponding proteins
-		
-		convfilepath = baseURL + convfilename
-		outfilepath = convfilename[0:-3]
-		have_mapping_file = 0
-		if os.path.isfile(convfilename): 
-			print("Found compressed ID conversion file on disk: %s" % convfilename)
-			decompress_convfile = 1
-			have_mapping_file = 1
-		if os.path.isfile(outfilepath): 
-			print("Found ID conversion file on disk: %s" % outfilepath)
-			decompress_convfile = 0
-			have_mapping_file = 1
-		if have_mapping_file == 0:
-			print("Downloading latest ID mapping file - this file is ~400 Mb compressed so this may take some time.")
-			print("Downloading from %s" % convfilepath)
-			response = urllib2.urlopen(convfilepath)
-			compressed_file = open(os.path.basename(convfilename), "w+b") #Start local compressed file
-			chunk = 1048576
-			while 1:
-				data = (response.read(chunk)) #Read one Mb at a time
-				compressed_file.write(data)
-				if not data:
-					print("\n%s file download complete." % convfilename)
-					compressed_file.close()
-					break
-				sys.stdout.write(".")
-			decompress_convfile = 1
-			
-		if decompress_convfile == 1:
-			print("Decompressing map file. Lines written, in millions:")
-			#Done in chunks since it's a large file
-			with gzip.open(convfilename) as infile: #Open that compressed file, read and write to uncompressed file
-				outfile = open(outfilepath, "w+b")
-				linecount = 0
-				for line in infile:
-					outfile.write(line)
-					linecount = linecount +1
-					if linecount % 100000 == 0:
-							sys.stdout.write(".")
-					if linecount % 1000000 == 0:
-							sys.stdout.write(str(linecount/1000000))
-				infile.close()
-			newconvfilename = outfilepath
-			outfile.close()
-		
-		#Download and decompress member NOG files (2 of them)
-		nogURL = baseURL + "data/NOG/"
-		nogfilename = "NOG.members.tsv.gz"
-		bactnogURL = baseURL + "data/bactNOG/"
-		bactnogfilename = "bactNOG.members.tsv.gz" 
-		all_nog_locations = [[nogURL, nogfilename], [bactnogURL, bactnogfilename]]
-		
-		for location in all_nog_locations:
-			baseURL = location[0]
-			memberfilename = location[1]
-			memberfilepath = baseURL + memberfilename
-			outfilepath = memberfilename[0:-3]
-			if os.path.isfile(memberfilename): 
-				print("\nFound compressed NOG membership file on disk: %s" % memberfilename)
-				decompress_memberfile = 1
-			if os.path.isfile(outfilepath): 
-				print("\nFound NOG membership file on disk: %s" % outfilepath)
-				decompress_memberfile = 0
-			else:
-				print("\nDownloading NOG membership file - this may take some time.")
-				print("Downloading from %s" % memberfilepath)
-				response = urllib2.urlopen(memberfilepath)
-				compressed_file = open(os.path.basename(memberfilename), "w+b") #Start local compressed file
-				chunk = 1048576
-				while 1:
-					data = (response.read(chunk)) #Read one Mb at a time
-					compressed_file.write(data)
-					if not data:
-						print("\n%s file download complete." % memberfilename)
-						compressed_file.close()
-						break
-					sys.stdout.write(".")
-				decompress_memberfile = 1
-				
-			if decompress_memberfile == 1:
-				print("Decompressing NOG membership file %s" % memberfilename)
-				#Done in chunks since it's a large file
-				with gzip.open(memberfilename) as infile: #Open that compressed file, read and write to uncompressed file
-					outfile = open(outfilepath, "w+b")
-					linecount = 0
-					for line in infile:
-						outfile.write(line)
-						linecount = linecount +1
-						if linecount % 100000 == 0:
-							sys.stdout.write(".")
-						if linecount % 1000000 == 0:
-							sys.stdout.write(str(linecount/1000000))
-					infile.close()
-				outfile.close()
-				
-		#Clean up by removing compressed files
-		
-		all_compressed_files = [convfilename, nogfilename, bactnogfilename]
-		for filename in all_compressed_files:
-			if os.path.isfile(filename):
-				print("\nRemoving compressed file: %s" % filename)
-				os.remove(filename)
-		
-		#Load and filter the ID conversion file as dictionary
-		print("Parsing ID conversion file. Lines read, in millions:")
-		with open(convfilename[0:-3]) as infile:
-			id_dict = {}	#Dictionary of eggNOG protein IDs with database IDs as keys
-			#Gets filtered down to relevant database IDs (i.e., Uniprot IDs)
-			linecount = 0
-			for line in infile:
-				linecount = linecount +1
-				line_raw = ((line.rstrip()).split("\t"))	#Protein IDs are split for some reason; merge them
-				one_id_set = [line_raw[0] + "." + line_raw[1], line_raw[2], line_raw[3]]
-				if "UniProt_AC" in one_id_set[2]:
-					id_dict[one_id_set[1]] = one_id_set[0]
-				if linecount % 100000 == 0:
-					sys.stdout.write(".")
-				if linecount % 1000000 == 0:
-					sys.stdout.write(str(linecount/1000000))
-			infile.close()
-	
-		#Use filtered ID conversion input to map to NOG members
-		print("\nReading NOG membership files.")
-		all_nog_filenames = [nogfilename[0:-3], bactnogfilename[0:-3]]
-		nog_members = {}	#Dictionary of NOG ids with protein IDs as keys (need to split entries for each)
-		nog_count = 0
-		og_taxid_map = {} #OG ids are keys, all taxids they have members in are values
-		for filename in all_nog_filenames:
-			temp_nog_members = {}	#We will have duplicates within each set but don't want to lose the information.
-			print("Reading from %s" % filename)
-			with open(filename) as infile:
-				for line in infile:
-					nog_count = nog_count +1
-					line_raw = ((line.rstrip()).split("\t"))
-					nog_id = line_raw[1]
-					line_members = line_raw[5].split(",")
-					og_taxid_map[nog_id] = []
-					for protein_id in line_members:			#The same protein could be in more than one OG at the same level
-						taxid = (protein_id.split("."))[0]
-						if taxid not in og_taxid_map[nog_id]:
-							og_taxid_map[nog_id].append(taxid)
-						if protein_id in temp_nog_members:
-							temp_nog_members[protein_id] = temp_nog_members[protein_id] + "," + nog_id
-						else:
-							temp_nog_members[protein_id] = nog_id
-				infile.close()
-			nog_members.update(temp_nog_members)
-		
-		upids_length = str(len(id_dict))
-		nogs_length = str(nog_count)
-		proteins_length = str(len(nog_members))
-		
-		print("Mapping %s Uniprot IDs to %s NOGs through %s eggNOG protein IDs:" % (upids_length, nogs_length, proteins_length))
-		upid_to_NOG = {}	#Conversion dictionary. Values are OGs, keys are UPIDs.
-		mapped_count = 0	#upids mapped to nogs.
-		for upid in id_dict:
-			if id_dict[upid] in nog_members:
-				upid_to_NOG[upid] = nog_members[id_dict[upid]]
-				mapped_count = mapped_count +1
-				if mapped_count % 100000 == 0:
-					sys.stdout.write(".")
-				if mapped_count % 1000000 == 0:
-					sys.stdout.write(str(mapped_count/1000000))
-			
-		#Use this mapping to build map file, named "uniprot_og_maps_*.txt"
-		print("Writing map file.")
-		nowstring = (date.today()).isoformat()
-		mapfilename = "uniprot_og_maps_" + nowstring + ".txt"
-		mapfile = open(mapfilename, "w+b")
-		for mapping in upid_to_NOG:
-			mapfile.write(mapping + "\t" + upid_to_NOG[mapping] + "\n")	#Each line is a uniprot ID and an OG id
-		mapfile.close()
-		
-		#Use the taxids to build a map file for OGs to each taxid they have a member in, named "og_to_taxid_*.txt"
-		print("Writing taxonomy matrix file.")
-		taxonfilename = "og_to_taxid_" + nowstring + ".txt"
-		taxonfile = open(taxonfilename, "w+b")
-		for mapping in og_taxid_map:
-			taxonfile.write(mapping + "\t" + " ".join(og_taxid_map[mapping]) + "\n")	#Each line is an OG then a list of taxids 
-			#Taxids separated by space
-		taxonfile.close()
+	file_md5 = md5File(partial_filename)
+	if expected_md5 is None:
+		expected_md5 = server_md5
+	if expected_md5 is not None and file_md5 != expected_md5.lower():
+		os.remove(partial_filename)
+		raise IOError("Checksum of %s does not match; the download was discarded." % filename)
+	if filename.endswith(".gz") and not gzipComplete(partial_filename):
+		os.remove(partial_filename)
+		raise IOError("%s is truncated or corrupt; the download was discarded." % filename)
+	with open(filename + ".md5", "w") as md5_file:
+		md5_file.write(file_md5 + "\n")
+	os.rename(partial_filename, filename)
+	if os.path.isfile(partial_filename + ".validator"):
+		os.remove(partial_filename + ".validator")
+	timer.finish()
+	print("\n%s file download complete." % filename)
+	return filename
+
+def fetchPart(fileURL, partial_filename, timer=None):
+	#Downloads the rest of a file into partial_filename, 
+	#starting from whatever is already there.
+	#The server's ETag (or Last-Modified date) for the file is kept in
+	#partial_filename + ".validator" and sent with If-Range on resuming,
+	#so if the file has changed on the server since, the server sends
+	#all of the new file instead of the rest of the old one.
+	#Bytes downloaded are counted as rows of timer, a StageTimer, if given.
+	#Raises IOError if the download ends early.
+	#Returns the MD5 checksum from the server's Content-MD5 header, if it sent
+	#one for the whole file, as hex digits. Otherwise returns None.
+	validator_filename = partial_filename + ".validator"
+	offset = 0
+	if os.path.isfile(partial_filename):
+		offset = os.path.getsize(partial_filename)
+	request = urllib2.Request(fileURL)
+	if offset > 0:
+		request.add_header("Range", "bytes=%s-" % offset)
+		if os.path.isfile(validator_filename):
+			with open(validator_filename) as validator_file:
+				request.add_header("If-Range", validator_file.read().strip())
+	try:
+		response = urllib2.urlopen(request)
+	except urllib2.HTTPError as e:
+		if e.code == 416 and offset > 0:	#Nothing left to send from offset
+			content_range = e.info().getheader("Content-Range")	#e.g. bytes */200
+			if content_range and content_range.split("/")[-1] == str(offset):	#The partial file is complete
+				return None
+			print("The partial download of %s doesn't match the file on the server. Starting over." % fileURL)
+			os.remove(partial_filename)
+			return fetchPart(fileURL, partial_filename, timer)
+		raise
+	headers = response.info()
+	total_size = None
+	server_md5 = None
+	if offset > 0 and response.getcode() == 206:
+		print("Resuming download of %s from %s bytes." % (fileURL, offset))
+		write_mode = "ab"
+		content_range = headers.getheader("Content-Range")	#e.g. bytes 100-199/200
+		if content_range and not content_range.endswith("/*"):
+			total_size = int(content_range.split("/")[-1])
+	else:
+		if offset > 0:
+			print("The file at %s has changed, or can't be resumed. Starting over." % fileURL)
+		print("Downloading from %s" % fileURL)
+		write_mode = "wb"	#The server sent the whole file, so start over
+		if headers.getheader("Content-Length"):
+			total_size = int(headers.getheader("Content-Length"))
+		if headers.getheader("Content-MD5"):
+			server_md5 = binascii.hexlify(base64.b64decode(headers.getheader("Content-MD5")))
+		validator = headers.getheader("ETag") or headers.getheader("Last-Modified")
+		if validator:
+			with open(validator_filename, "w") as validator_file:
+				validator_file.write(validator + "\n")
+		elif os.path.isfile(validator_filename):
+			os.remove(validator_filename)
+	with open(partial_filename, write_mode) as partial_file:
+		chunk = 1048576
+		while 1:
+			data = (response.read(chunk)) #Read one Mb at a time
+			if not data:
+				break
+			partial_file.write(data)
+			sys.stdout.write(".")
+			if timer is not None:
+				timer.total = total_size
+				timer.advance(len(data), partial_file.tell())
+	if total_size is not None and os.path.getsize(partial_filename) != total_size:
+		raise IOError("got %s of %s bytes" % (os.path.getsize(partial_filename), total_size))
+	return server_md5
+
+def fetchFiles(locations):
+	#Downloads several files at once, one thread per file, with fetchFile.
+	#locations is a list of [URL, filename] pairs.
+	#Exits if any of the downloads fail.
+	errors = []
+	def fetch_one(location):
+		try:
+			fetchFile(location[0], location[1])
+		except IOError as e:
+			errors.append(str(e))
+	threads = [threading.Thread(target=fetch_one, args=(location,)) for location in locations]
+	for thread in threads:
+		thread.start()
+	for thread in threads:
+		thread.join()
+	if len(errors) >0:
+		sys.exit("\n".join(errors))
+
+def md5File(filename):
+	#Returns the MD5 checksum of a file as hex digits.
+	file_hash = hashlib.md5()
+	with open(filename, "rb") as this_file:
+		for data in iter(lambda: this_file.read(1048576), ""):
+			file_hash.update(data)
+	return file_hash.hexdigest()
+
+def checkFile(filename):
+	#Verifies a downloaded file against the checksum saved by fetchFile.
+	#Files without a saved checksum are assumed to be fine.
+	#Returns False if the file doesn't match.
+	if not os.path.isfile(filename + ".md5"):
+		return True
+	with open(filename + ".md5") as md5_file:
+		expected_md5 = md5_file.read().strip()
+	return md5File(filename) == expected_md5
+
+def gzipComplete(filename):
+	#Reads a gzip file through to the end, which checks its CRC and length.
+	#Returns False if it is truncated or corrupt.
+	try:
+		with gzip.open(filename, "rb") as gzip_file:
+			while gzip_file.read(1048576):
+				pass
+	except (IOError, EOFError, struct.error, zlib.error):
+		return False
+	return True
+
+def openCompressed(filename):
+	#Opens a gzip file for streaming, line by line, without decompressing it to disk.
+	return io.BufferedReader(gzip.open(filename))
+
+def readLineBlocks(infile, block_size):
+	#Splits an open file into lists of block_size lines.
+	block = []
+	for line in infile:
+		block.append(line)
+		if len(block) == block_size:
+			yield block
+			block = []
+	if block:
+		yield block
+
+def mapBlocks(function, blocks, pool):
+	#Applies function to each block, across the pool if there is one.
+	#Results are yielded in the order of the blocks, and only a few blocks
+	#per process are held in memory at once.
+	if pool is None:
+		for block in blocks:
+			yield function(block)
+		return
+	pending = deque()
+	max_pending = 2 * multiprocessing.cpu_count()
+	for block in blocks:
+		pending.append(pool.apply_async(function, (block,)))
+		if len(pending) >= max_pending:
+			yield pending.popleft().get()
+	while pending:
+		yield pending.popleft().get()
+
+parse_state = {}	#Row filters and the BlockReader of this process, for parsing eggNOG files
+
+def startParsing(filters):
+	#Sets the row filters for parseBlock in this process: keyword arguments
+	#for the parsing function, such as upids. Also the initializer of each
+	#parsing worker, so the filters are sent to each one once rather than
+	#with every block.
+	parse_state["filters"] = filters
+	parse_state["reader"] = None
+
+def parseBlock(parse_lines, filename, number):
+	#Reads a block of a compressed eggNOG file (see BlockReader) and parses
+	#its lines with parse_lines and the filters from startParsing.
+	#Returns [parse_lines' result, the count of lines, how far into the
+	#compressed file this has read], or None if the file ends before it.
+	reader = parse_state["reader"]
+	if reader is None or reader.filename != filename or number < reader.next_block:
+		if reader is not None:
+			reader.close()
+		reader = BlockReader(filename)
+		parse_state["reader"] = reader
+	lines = reader.block(number)
+	if lines is None:
+		return None
+	return [parse_lines(lines, **parse_state["filters"]), len(lines), reader.compressedPosition()]
+
+def parseBlocks(parse_lines, filename, jobs, filters):
+	#Parses a compressed eggNOG file a block at a time, across jobs
+	#processes if there is more than one. Each process decompresses the 
+	#file and reads its blocks itself, so only block numbers and parsed
+	#blocks are passed around.
+	#Yields parseBlock's result for each block, in file order.
+	pool = None
+	if jobs > 1:
+		pool = multiprocessing.Pool(jobs, startParsing, (filters,))
+	else:
+		startParsing(filters)
+	try:
+		for parsed_block in mapBlocks(functools.partial(parseBlock, parse_lines, filename), itertools.count(), pool):
+			if parsed_block is None:
+				break
+			yield parsed_block
+	finally:
+		if pool is not None:
+			pool.close()	#Blocks asked for past the end of the file are quickly done
+			pool.join()
+		elif parse_state["reader"] is not None:
+			parse_state["reader"].close()
+			parse_state["reader"] = None
+
+def parseIDConversionLines(lines, upids=None, taxids=None):
+	#Parses lines from the eggNOG ID conversion file, keeping only the rows for Uniprot IDs.
+	#If upids or taxids are provided, only those Uniprot IDs or taxids are kept.
+	#Returns the Uniprot IDs and the eggNOG protein IDs of the rows kept, in
+	#file order, as two strings of IDs separated by newlines (so they pass 
+	#quickly between processes), or two empty strings if none are kept.
+	row_upids = []
+	row_proteins = []
+	for line in lines:
+		line_raw = ((line.rstrip()).split("\t"))
+		if "UniProt_AC" in line_raw[3]:
+			if upids is not None and line_raw[2] not in upids:
+				continue
+			if taxids is not None and line_raw[0] not in taxids:
+				continue
+			row_upids.append(line_raw[2])
+			row_proteins.append(line_raw[0] + "." + line_raw[1])	#Protein IDs are split for some reason; merge them
+	return "\n".join(row_upids), "\n".join(row_proteins)
+
+def parseNOGMemberLines(lines, protein_index, protein_ids=None):
+	#Parses lines from a NOG membership file.
+	#protein_index is a HashIndex of the eggNOG proteins with a Uniprot ID
+	#(see readNOGMembers); only their memberships are kept, by their codes.
+	#If protein_ids are provided, only the NOGs with one of those eggNOG 
+	#proteins as a member are kept.
+	#Each kept NOG still gets all of its taxids.
+	#Returns the NOGs kept in a form which passes quickly between processes:
+	#their NOG ids and the taxids they have members in (each taxid once, in
+	#order of appearance) as strings separated by newlines, then arrays of 
+	#the positions in those taxids of each NOG's taxids (in order of 
+	#appearance), of how many taxids and member proteins each NOG has, and 
+	#of the codes of those proteins.
+	nog_ids = []
+	block_taxids = {}	#Taxids are keys, their positions are values
+	taxid_positions = array("i")
+	taxid_counts = array("i")
+	member_counts = array("i")
+	member_codes = array("i")
+	for line in lines:
+		line_raw = ((line.rstrip()).split("\t"))
+		line_members = line_raw[5].split(",")
+		if protein_ids is not None and protein_ids.isdisjoint(line_members):
+			continue
+		nog_ids.append(line_raw[1])
+		nog_taxids = []	#In order of appearance
+		seen_taxids = set()
+		for protein_id in line_members:			#The same protein could be in more than one OG at the same level
+			taxid = (protein_id.split("."))[0]
+			if taxid not in seen_taxids:
+				seen_taxids.add(taxid)
+				nog_taxids.append(block_taxids.setdefault(taxid, len(block_taxids)))
+		taxid_positions.extend(nog_taxids)
+		taxid_counts.append(len(nog_taxids))
+		#Proteins without a Uniprot ID can't be mapped to
+		kept_codes = []
+		for protein_id in line_members:
+			kept_codes.extend(protein_index.find(protein_id))
+		member_counts.append(len(kept_codes))
+		member_codes.extend(kept_codes)
+	taxid_order = sorted(block_taxids, key=block_taxids.get)
+	return "\n".join(nog_ids), "\n".join(taxid_order), taxid_positions, taxid_counts, member_counts, member_codes
+
+def readIDConversion(filename, jobs=1, upids=None, taxids=None):
+	#Streams the compressed eggNOG ID conversion file.
+	#Blocks of lines are parsed across jobs processes (see parseBlocks).
+	#upids and taxids restrict the rows kept, as in parseIDConversionLines.
+	#Returns IdentifierTables of the Uniprot IDs and of the eggNOG protein IDs,
+	#each with one code per row kept, so the protein for a Uniprot ID has the
+	#same code. Either kind of ID may be in its table more than once.
+	print("Parsing ID conversion file %s. Lines read, in millions:" % filename)
+	upid_table = IdentifierTable()
+	protein_table = IdentifierTable()
+	linecount = 0
+	timer = run_report.stage("parse " + filename, os.path.getsize(filename))
+	for (upid_text, protein_text), line_count, compressed_position in parseBlocks(parseIDConversionLines, filename, 
+																			jobs, {"upids": upids, "taxids": taxids}):
+		row_count = 0
+		if upid_text:	#Interned a block at a time
+			block_upids = upid_text.split("\n")
+			row_count = len(block_upids)
+			upid_table.appendAll(block_upids)	#Later rows for the same Uniprot ID are sorted out by writeMapStore
+			protein_table.appendAll(protein_text.split("\n"))	#Found later through a HashIndex, not a dict
+		timer.advance(row_count, compressed_position)
+		sys.stdout.write(".")
+		if (linecount + line_count) // 1000000 > linecount // 1000000:
+			sys.stdout.write(str((linecount + line_count) // 1000000))
+		linecount = linecount + line_count
+	timer.finish()
+	return upid_table, protein_table
+
+def readNOGMembers(filename, protein_index, jobs=1, protein_ids=None):
+	#Streams one compressed NOG membership file.
+	#Blocks of lines are parsed across jobs processes (see parseBlocks),
+	#and merged in file order so the result is the same as reading in one process.
+	#protein_ids restricts the NOGs kept, as in parseNOGMemberLines.
+	#Memberships are only kept for the proteins in protein_index, a HashIndex
+	#of the protein table from readIDConversion, by their codes there.
+	#A protein in more than one NOG is kept with a range of NOG codes,
+	#in file order, rather than a combined string.
+	#Returns IdentifierTables of the NOG ids and taxids seen, a CodeRanges of 
+	#the taxid codes for each NOG code, a CodeRanges of the NOG codes for 
+	#each protein code, and the count of NOGs read.
+	print("Reading from %s" % filename)
+	og_table = IdentifierTable()
+	taxid_table = IdentifierTable()
+	og_taxids = CodeRanges()
+	member_proteins = array("i")	#Pairs of protein and NOG codes, for each membership
+	member_ogs = array("i")
+	nog_count = 0
+	timer = run_report.stage("parse " + filename, os.path.getsize(filename))
+	for parsed_nogs, line_count, compressed_position in parseBlocks(parseNOGMemberLines, filename, jobs, 
+														{"protein_index": protein_index, "protein_ids": protein_ids}):
+		nog_text, taxid_text, taxid_positions, taxid_counts, member_counts, member_codes = parsed_nogs
+		if not nog_text:
+			timer.advance(0, compressed_position)
+			continue
+		#Interned a block at a time, each taxid once
+		og_codes = og_table.codeAll(nog_text.split("\n"))
+		block_taxid_codes = taxid_table.codeAll(taxid_text.split("\n"))
+		taxid_codes = array("i", [block_taxid_codes[position] for position in taxid_positions])
+		taxid_position = 0
+		for og_code, taxid_count, member_count in zip(og_codes, taxid_counts, member_counts):
+			og_taxids.set(og_code, taxid_codes[taxid_position:taxid_position + taxid_count])
+			taxid_position = taxid_position + taxid_count
+			member_ogs.extend(array("i", [og_code]) * member_count)
+		member_proteins.extend(member_codes)
+		nog_count = nog_count + len(og_codes)
+		timer.advance(len(og_codes), compressed_position)
+	protein_ogs = groupCodes(member_proteins, member_ogs, len(protein_index.table))
+	og_table.dropIndex()	#Only the strings are needed from here on
+	taxid_table.dropIndex()
+	timer.finish()
+	return og_table, taxid_table, og_taxids, protein_ogs, nog_count
+
+def saveStage(stage_output, stage_file):
+	#Writes the output of a build stage (a tuple of IdentifierTables, 
+	#CodeRanges, arrays and plain values) to an open file with marshal.
+	marshal.dump(len(stage_output), stage_file)
+	for value in stage_output:
+		if isinstance(value, IdentifierTable):
+			marshal.dump(["table", str(value.blob), value.offsets.tostring()], stage_file)
+		elif isinstance(value, CodeRanges):
+			marshal.dump(["ranges", value.starts.tostring(), value.ends.tostring(), 
+						value.values.tostring()], stage_file)
+		elif isinstance(value, array):
+			marshal.dump(["array", value.tostring()], stage_file)
+		else:
+			marshal.dump(["value", value], stage_file)
+
+def loadStage(stage_file):
+	#Reads the output of a build stage written by saveStage.
+	#Returns it as a tuple.
 	
-	print("***Species comparison***")
-	component_con_file_name = name1 + "_component_conservation.txt"
-	cplx_con_file_name = name1 + "_complex_conservation.txt"
+	def int_array(data, typecode="i"):
+		this_array = array(typecode)
+		this_array.fromstring(data)
+		return this_array
 	
-	exp_complexes = {} #Complex names are keys, members are values
-	uniprot_to_og = {} #ALL available Uniprot IDs are keys, members are eggNOG OG IDs
-		#Can only include UPIDs mapped to eggNOG IDs
-	og_to_taxid = {} #All the taxids this OG has members in, as per the member files
-	unified_components = []		#All protein complex components, as UPIDs
-	component_ogs = {}	#Component UPIDs are keys, members are corresponding OGs
-	unmapped_components = []	#Any UPID not found in the eggNOG ID conversion file
-	og_list = []	#Just the unique OGs in use
-	all_taxids = [] #All taxids in use. Don't care about parents or children here.
-	all_cplx_taxids = [] #All taxids relevant to the complex components.
-	ready_to_map = False
+	stage_output = []
+	for i in range(marshal.load(stage_file)):
+		value = marshal.load(stage_file)
+		if value[0] == "table":
+			stage_output.append(IdentifierTable(bytearray(value[1]), int_array(value[2], "l")))
+		elif value[0] == "ranges":
+			stage_output.append(CodeRanges(*[int_array(data) for data in value[1:]]))
+		elif value[0] == "array":
+			stage_output.append(int_array(value[1]))
+		else:
+			stage_output.append(value[1])
+	return tuple(stage_output)
+
+def readBuildManifest():
+	#Loads the build manifest, which records for each map store the source
+	#files it was built from and the saved output of each build stage.
+	#Returns a dict with store names ("full" or a target name) as keys.
+	if not os.path.isfile(build_manifest_filename):
+		return {}
+	with open(build_manifest_filename) as manifest_file:
+		return json.load(manifest_file)
+
+def writeBuildManifest(build_manifest):
+	#Saves the build manifest under a temporary name, then renames it into place.
+	temp_filename = build_manifest_filename + ".tmp"
+	with open(temp_filename, "w") as manifest_file:
+		json.dump(build_manifest, manifest_file, indent=1, sort_keys=True)
+	os.rename(temp_filename, build_manifest_filename)
+
+def sourceStamp(filename):
+	#Returns the size and modification time of a file, to tell if it changed.
+	file_stat = os.stat(filename)
+	return [file_stat.st_size, file_stat.st_mtime]
+
+def filterKey(*filters):
+	#Returns a short key for the sets used to restrict a build stage.
+	#Stages without any restriction get "all".
+	if all(this_filter is None for this_filter in filters):
+		return "all"
+	filter_hash = hashlib.sha1()
+	for this_filter in filters:
+		if this_filter is None:
+			filter_hash.update("None\n")
+		else:
+			filter_hash.update("\t".join(sorted(this_filter)) + "\n")
+	return filter_hash.hexdigest()[:12]
+
+def runStage(store_entry, stage_name, source_filename, filter_key, stage_function):
+	#Runs one stage of a map store build, or reuses its saved output if the stage's
+	#source file and filter_key are the same as in the previous build.
+	#store_entry is this store's entry in the build manifest; it gets updated.
+	#Stage output is saved with saveStage in eggnog_stage_*.dat files.
+	#Returns the output of stage_function.
+	if os.path.isfile(source_filename + ".md5"):	#Already verified by checkFile
+		with open(source_filename + ".md5") as md5_file:
+			source_md5 = md5_file.read().strip()
+	else:
+		source_md5 = md5File(source_filename)
+	stage_key = "v%s_%s_%s" % (build_stage_version, source_md5, filter_key)
+	previous_stage = store_entry["stages"].get(stage_name)
+	if (previous_stage is not None and previous_stage["key"] == stage_key 
+		and os.path.isfile(previous_stage["output"])):
+		print("%s has not changed. Reusing the previous %s stage output." % (source_filename, stage_name))
+		timer = run_report.stage("reuse " + stage_name)
+		timer.hit()
+		with open(previous_stage["output"], "rb") as stage_file:
+			stage_output = loadStage(stage_file)
+		timer.finish()
+		return stage_output
+	stage_output = stage_function()
+	stage_filename = "eggnog_stage_%s_%s.dat" % (stage_name, stage_key)
+	with open(stage_filename + ".tmp", "wb") as stage_file:
+		saveStage(stage_output, stage_file)
+	os.rename(stage_filename + ".tmp", stage_filename)
+	if previous_stage is not None and previous_stage["output"] != stage_filename:
+		if os.path.isfile(previous_stage["output"]):
+			os.remove(previous_stage["output"])
+	store_entry["stages"][stage_name] = {"key": stage_key, "source": source_filename, 
+										"output": stage_filename}
+	return stage_output
+
+def get_eggnog_maps(jobs=1, upids=None, taxids=None, target_name=None, level=None): 
+	#Download the eggNOG ID conversion file and NOG membership files if needed,
+	#then build the map store from them in a single pass over each compressed file.
+	#The map store merges the levels in eggnog_levels. With a level (e.g. 
+	#"gproNOG"), builds a store for just that level instead: a shard,
+	#recorded in the build manifest with the merged store, which it 
+	#shares its saved stages with.
+	#With more than one job, parsing is split across that many processes.
+	#A targeted store only covers the Uniprot IDs in upids and/or the proteins
+	#of the taxids in taxids, plus the OGs they are in. It is named
+	#for target_name so it doesn't get mixed up with the full store, and 
+	#the build manifest records which targets it covers. There is one store
+	#for each target_name, which is rebuilt in place for other targets.
+	#Only Uniprot IDs are kept from the ID conversion file.
+	#One Uniprot ID may correspond to multiple OGs - e.g. COG1234,COG3810,COG9313. 
+	#these cases are considered OGs in their own right as this may indicate a pattern of conserved sequences on its own 
+	#The compressed files are kept, as they are the inputs for any rebuild.
+	#The build is incremental: each stage (the ID conversion file and each
+	#membership file) is only run again if its source file has changed since
+	#the last build, as recorded in the build manifest. The new store then
+	#replaces any older one.
+	convfilename = "eggnog4.protein_id_conversion.tsv.gz"	#File contains ALL database identifiers and corresponding proteins
+	member_levels = eggnog_levels
+	if level is not None:
+		member_levels = [level]
+	member_filenames = [member_level + ".members.tsv.gz" for member_level in member_levels]
+	all_locations = [[eggnog_url, convfilename]] + [[eggnog_url + "data/" + member_level + "/", member_filename]
+													for member_level, member_filename in zip(member_levels, member_filenames)]
+	
+	missing_locations = []	#Files to download, all at once
+	for location in all_locations:
+		if os.path.isfile(location[1]) and checkFile(location[1]):
+			print("Found compressed file on disk: %s" % location[1])
+		else:
+			if os.path.isfile(location[1]):
+				print("%s does not match its checksum. Downloading it again." % location[1])
+				os.remove(location[1])
+			print("Downloading %s - this may take some time." % location[1])
+			missing_locations.append([location[0] + location[1], location[1]])
+	if len(missing_locations) >0:
+		fetchFiles(missing_locations)
+	
+	if jobs > 1:
+		print("Parsing with %s processes." % jobs)
+	
+	store_key = "full"
+	if target_name is not None:
+		store_key = target_name
+	build_manifest = readBuildManifest()
+	store_entry = build_manifest.get(store_key, {"stages": {}})
+	
+	#All identifiers are interned (see IdentifierTable), so the maps are held
+	#as arrays of integer codes rather than dicts of strings.
+	upid_table, protein_table = runStage(store_entry, store_key + "_conversion", 
+						convfilename, filterKey(upids, taxids), 
+						lambda: readIDConversion(convfilename, jobs, upids, taxids))
+	protein_ids = None	#eggNOG proteins to keep from the membership files
+	if upids is not None or taxids is not None:
+		protein_ids = set(protein_table)
+	#Membership stages refer to proteins by their codes from the conversion stage
+	conversion_key = store_entry["stages"][store_key + "_conversion"]["key"]
+	protein_indexes = []	#The HashIndex of protein_table, built only if a membership stage runs
+	
+	def read_members(filename):
+		if len(protein_indexes) == 0:
+			protein_indexes.append(HashIndex(protein_table))
+		return readNOGMembers(filename, protein_indexes[0], jobs, protein_ids)
+	
+	#Use filtered ID conversion input to map to NOG members
+	print("\nReading NOG membership files.")
+	og_table = IdentifierTable()
+	taxid_table = IdentifierTable()
+	og_taxids = CodeRanges()	#Taxid codes each OG has members in
+	protein_ogs = CodeRanges()	#OG codes for each protein code in protein_table
+	nog_count = 0
+	for filename in member_filenames:
+		level_ogs, level_taxids, level_og_taxids, level_protein_ogs, level_nog_count = runStage(
+								store_entry, store_key + "_" + filename.split(".")[0], filename, 
+								filterKey(protein_ids, [conversion_key]), 
+								lambda: read_members(filename))
+		og_codes = og_table.codeAll(list(level_ogs))
+		taxid_codes = taxid_table.codeAll(list(level_taxids))
+		og_taxids.update(level_og_taxids, taxid_codes, og_codes)
+		protein_ogs.update(level_protein_ogs, og_codes)	#Later levels replace earlier ones
+		nog_count = nog_count + level_nog_count
+	del protein_indexes[:]
+	
+	print("Mapping %s Uniprot IDs to %s NOGs through %s eggNOG protein IDs:" % (len(upid_table), nog_count, len(protein_table)))
+	upid_ogs = array("i", [-1]) * len(upid_table)	#OG code for each UPID code, or -1
+	mapped_count = 0	#upids mapped to nogs.
+	timer = run_report.stage("map Uniprot IDs to OGs", len(upid_table))
+	og_starts = protein_ogs.starts	#The ranges are read directly, as this runs for every Uniprot ID
+	og_ends = protein_ogs.ends
+	protein_count = len(protein_ogs)
+	for upid_code in xrange(len(upid_table)):
+		if upid_code % 10000 == 0:
+			timer.advance(0, upid_code)
+		protein_code = upid_code	#Each row of the ID conversion file has the same code in both tables
+		if protein_code >= protein_count:
+			continue
+		start = og_starts[protein_code]
+		og_count = og_ends[protein_code] - start
+		if og_count == 0:
+			continue
+		elif og_count == 1:
+			upid_ogs[upid_code] = protein_ogs.values[start]
+		else:	#Combinations of OGs are considered OGs in their own right
+			upid_ogs[upid_code] = og_table.code(",".join(og_table[og] for og in protein_ogs.get(protein_code)))
+		mapped_count = mapped_count +1
+		if mapped_count % 100000 == 0:
+			sys.stdout.write(".")
+		if mapped_count % 1000000 == 0:
+			sys.stdout.write(str(mapped_count/1000000))
+	timer.advance(mapped_count, len(upid_table))
+	timer.finish()
+	protein_table = protein_ogs = level_protein_ogs = og_starts = og_ends = None	#Freed before the store is written
 	
-	while not ready_to_map:
+	#Use this mapping and the taxids of each OG to build the binary map store, named "eggnog_maps_*.bin"
+	print("\nWriting map store.")
+	nowstring = (date.today()).isoformat()
+	if level is not None:
+		nowstring = "level_" + level + "_" + nowstring
+	if target_name is not None:
+		nowstring = target_name + "_" + nowstring
+	timer = run_report.stage("write map store")
+	store_filename = writeMapStore("eggnog_maps_" + nowstring + ".bin", upid_table, upid_ogs, 
+									og_table, og_taxids, taxid_table)
+	timer.advance(mapped_count)
+	timer.finish()
+	
+	#Record the new store, then remove the stores it supersedes
+	store_record = store_entry	#Where the store is recorded: the entry itself, or its shard
+	if level is not None:
+		store_record = store_entry.setdefault("levels", {}).setdefault(level, {})
+	old_store_filename = store_record.get("store")
+	store_record["store"] = store_filename
+	store_record["sources"] = dict((location[1], sourceStamp(location[1])) for location in all_locations)
+	store_record["filter"] = filterKey(upids, taxids)
+	build_manifest[store_key] = store_entry
+	writeBuildManifest(build_manifest)
+	if old_store_filename not in [None, store_filename] and os.path.isfile(old_store_filename):
+		print("Removing superseded map store %s." % old_store_filename)
+		try:
+			os.remove(old_store_filename)
+		except OSError:	#Still open somewhere; the manifest points to the new one anyway
+			pass
+	return store_filename
+
+def mapsOutdated(store_key, level=None, filter_key=None):
+	#Checks whether any source file of a map store (or of its shard for
+	#level) has changed since it was built.
+	#Source files which have since been removed don't count as changes.
+	#With a filter_key (from filterKey), also checks that the store was
+	#built for the same Uniprot IDs and taxids. Stores recorded without 
+	#one were built before targets were recorded, and count as full stores.
+	store_entry = readBuildManifest().get(store_key)
+	if store_entry is not None and level is not None:
+		store_entry = store_entry.get("levels", {}).get(level)
+	if store_entry is None:
+		return False
+	if filter_key is not None and store_entry.get("filter", "all") != filter_key:
+		return True
+	for source_filename in store_entry["sources"]:
+		if (os.path.isfile(source_filename) and 
+			sourceStamp(source_filename) != store_entry["sources"][source_filename]):
+			return True
+	return False
+
+def mapStorePattern(target_name=None, level=None):
+	#Returns the build manifest key and the file name pattern of the map
+	#store for target_name (None for the full store), or of its shard for level.
+	store_key = "full"
+	store_prefix = "eggnog_maps_"
+	if target_name is not None:
+		store_key = target_name
+		store_prefix = store_prefix + target_name + "_"
+	if level is not None:
+		store_prefix = store_prefix + "level_" + level + "_"
+	return store_key, store_prefix + "????-??-??.bin"
+
+def mapStoreFilename(target_name=None, level=None):
+	#Returns the name of the map store to use for target_name (None for
+	#the full store), or of its shard for level: the one in the build
+	#manifest, or else the newest. Returns None if there isn't one on disk.
+	store_key, store_pattern = mapStorePattern(target_name, level)
+	store_file_list = sorted(glob.glob(store_pattern))
+	if len(store_file_list) == 0:
+		return None
+	store_filename = store_file_list[-1]	#Dates sort in order, so this is the newest
+	store_entry = readBuildManifest().get(store_key)
+	if store_entry is not None and level is not None:
+		store_entry = store_entry.get("levels", {}).get(level)
+	if store_entry is not None and store_entry.get("store") in store_file_list:
+		store_filename = store_entry["store"]
+	return store_filename
+
+def loadMapStore(jobs=1, upids=None, taxids=None, target_name=None, level=None):
+	#Opens the map store on disk, building it first if needed.
+	#Older text map files get converted to a map store instead.
+	#With a target_name, opens (or builds) the targeted store for
+	#the Uniprot IDs in upids and/or the taxids in taxids instead.
+	#With a level, opens (or builds) the shard of the store for just
+	#that eggNOG level.
+	#If more than one store is on disk, the one in the build manifest (or
+	#else the newest) is used. If the eggNOG source files have changed 
+	#since the store was built, or it was built for other targets, it 
+	#gets rebuilt first.
+	#Returns a MapStore.
+	store_key, store_pattern = mapStorePattern(target_name, level)
+	filter_key = filterKey(upids, taxids)
+	reused = True	#Whether the store was already on disk
+	while True:
+		store_file_list = sorted(glob.glob(store_pattern))
 		map_file_list = glob.glob("uniprot_og_maps_*.txt")
 		taxon_file_list = glob.glob("og_to_taxid_*.txt")
-		if len(map_file_list) >0 and len(taxon_file_list) >0:
-			if len(map_file_list) == 1:
-				print("Found map file %s on disk." % map_file_list[0])
-				print("Loading file...")
-				with open(map_file_list[0]) as id_map_file:
-					linecount = 0
-					for line in id_map_file:
-						linecount = linecount +1
-						if linecount % 10000 == 0:
-							sys.stdout.write(".")
-						line_content = (line.rstrip()).split("\t")
-						uniprot_to_og[line_content[0]] = line_content[1]
-			else:
-				sys.exit("Found more than one map file on disk. Please check for duplicates.")
-			if len(taxon_file_list) == 1:
-				print("\nFound OG vs taxon file %s on disk." % taxon_file_list[0])
-				print("Loading file...")
-				with open(taxon_file_list[0]) as taxon_file:
-					linecount = 0
-					for line in taxon_file:
-						linecount = linecount +1
-						if linecount % 10000 == 0:
-							sys.stdout.write(".")
-						line_content = (line.rstrip()).split("\t")
-						these_taxids = line_content[1].split(" ")
-						og_to_taxid[line_content[0]] = these_taxids
-						for taxid in these_taxids:
-							if taxid not in all_taxids:
-								all_taxids.append(taxid)
+		if len(store_file_list) >0 and mapsOutdated(store_key, level, filter_key):
+			print("eggNOG source files or targets have changed since the map store was built. Rebuilding it...")
+			get_eggnog_maps(jobs, upids, taxids, target_name, level)
+			reused = False
+		elif len(store_file_list) >0:
+			store_filename = mapStoreFilename(target_name, level)
+			if len(store_file_list) >1:
+				print("Found %s map stores on disk; using %s." % (len(store_file_list), store_filename))
 			else:
-				sys.exit("\nFound more than one OG vs taxon file on disk. Please check for duplicates.")
-			ready_to_map = True
+				print("Found map store %s on disk." % store_filename)
+			timer = run_report.stage("open map store")
+			if reused:
+				timer.hit()
+			map_store = MapStore(store_filename)
+			timer.finish()
+			return map_store
+		elif target_name is None and level is None and len(map_file_list) >0 and len(taxon_file_list) >0:
+			#Older text map files get converted to a map store once.
+			#Of several snapshots, the newest is used: the newest date with
+			#both files, or else the newest file of each kind.
+			map_filename, taxon_filename = textMapSnapshot(map_file_list, taxon_file_list)
+			stale_files = [filename for filename in sorted(map_file_list + taxon_file_list)
+							if filename not in [map_filename, taxon_filename]]
+			if len(stale_files) >0:
+				print("Found more than one snapshot of the text map files; using the newest. "
+						"These are stale and can be removed:\n%s" % "\n".join(stale_files))
+			print("Found text map files %s and %s on disk. Converting to a map store..." 
+					% (map_filename, taxon_filename))
+			text_maps = readTextMaps(map_filename, taxon_filename)
+			store_date = (os.path.basename(map_filename))[16:-4]
+			writeMapStore("eggnog_maps_" + store_date + ".bin", *internMaps(text_maps[0], text_maps[1]))
+			reused = False
+			print("")
 		else:
 			print("A protein map or a taxon file is missing. Rebuilding them...")
-			get_eggnog_maps()
+			get_eggnog_maps(jobs, upids, taxids, target_name, level)
+			reused = False
+
+def unknownLevels(levels):
+	#Returns the names in a list of eggNOG levels which aren't in eggnog_level_names.
+	#Level names go into file names and download URLs, so are checked first.
+	return [level for level in levels if level not in eggnog_level_names]
+
+def textMapSnapshot(map_file_list, taxon_file_list):
+	#Picks the newest snapshot of the older text map files from lists of
+	#uniprot_og_maps_*.txt and og_to_taxid_*.txt files: the newest date
+	#with both files, or else the newest of each, as dates sort in order.
+	#Returns the map file name and the taxon file name.
+	map_dates = dict((os.path.basename(filename)[16:-4], filename) for filename in map_file_list)
+	taxon_dates = dict((os.path.basename(filename)[12:-4], filename) for filename in taxon_file_list)
+	shared_dates = sorted(set(map_dates) & set(taxon_dates))
+	if len(shared_dates) >0:
+		return map_dates[shared_dates[-1]], taxon_dates[shared_dates[-1]]
+	return sorted(map_file_list)[-1], sorted(taxon_file_list)[-1]
+
+def compareSpecies(filename1, name1, id_conversion, jobs=1, target_name=None, target_taxids=None, 
+					locus_index=None, taxonomy=None, ranks=(), significance=None, cluster=False, levels=None):
+	#filename1 is the "experimental" file
+	#name1 is the short name of the set
+	#id_conversion is a dictionary with UniprotAC's as keys
+	#and values of two types. For E. coli those types are bcode and
+	#JW-code, in that order.
+	#locus_index is the inverted id_conversion, from indexLocusIDs;
+	#it gets built here if not provided.
+	#The rest are as for compareSpeciesMulti, which this runs for one set.
+	if locus_index is None:
+		locus_index = indexLocusIDs(id_conversion)
+	return compareSpeciesMulti([[filename1, name1, id_conversion, locus_index]], jobs, target_name, 
+								target_taxids, taxonomy, ranks, significance, cluster, levels=levels)
+
+def compareSpeciesMulti(datasets, jobs=1, target_name=None, target_taxids=None, taxonomy=None, ranks=(),
+						significance=None, cluster=False, combined_name="combined", levels=None):
+	#Compares any number of complex sets, e.g. from different organisms,
+	#across species, against one map store which is only loaded once.
+	#datasets is a list of [filename, name, id_conversion, locus_index]:
+	#each set's complex file, short name, ID conversion dictionary (as for
+	#compareSpecies, or empty) and its inverted index from indexLocusIDs.
+	#Components which are already Uniprot IDs in id_conversion are used as-is,
+	#as are all components if id_conversion is empty.
+	#jobs is the number of processes to use if the maps need rebuilding.
+	#With a target_name, uses a targeted map store covering just the
+	#Uniprot IDs in the id_conversion dictionaries (or, for sets without 
+	#any, their complex components) and/or the taxids in target_taxids.
+	#taxonomy, ranks and cluster are as for compareComplexSpecies.
+	#significance may be [permutations, seed] to also run testComplexSignificance,
+	#with the proteins in id_conversion (or else the complex components) as background.
+	#Writes each set's output files, and with more than one set, a combined
+	#complex conservation matrix (see writeCombinedMatrix).
+	#With levels (e.g. ["NOG", "gproNOG"]), all of this is done at each of
+	#those eggNOG levels in turn, with the store's shard for that level,
+	#instead of with the merged store. Output files get the level after
+	#the set name, e.g. exp_gproNOG_complex_conservation.txt.
+	#Returns the names of the output files, starting with the component and
+	#complex conservation matrices of the first set.
 	
-	with open(filename1) as file1:	#Open the input complex file
-		file1.readline()	#skip the header
-		for line in file1:
-			line_content = (line.rstrip()).split()
-			complex_name = name1 + "_" + line_content[1]
-			if complex_name in exp_complexes:	#Load each complex, though we don't know ID format
-				exp_complexes[complex_name].append(line_content[0])
-			else:
-				exp_complexes[complex_name] = [line_content[0]]
+	#This method requires the eggNOG map files and downloads them if needed
+	
+	print("***Species comparison***")
+	names = [dataset[1] for dataset in datasets]
+	if len(set(names)) < len(names):
+		sys.exit("Each complex set needs its own name.")
+	unified_sets = []	#Complexes with Uniprot component IDs and their components, for each set
+	target_upids = set()
+	for filename, name, id_conversion, locus_index in datasets:
+		exp_complexes = loadComplexes(filename, name)	#Load each complex, though we don't know ID format
+		unified = unifyComplexes(exp_complexes, id_conversion, locus_index)
+		unified_sets.append(unified)
+		if id_conversion:
+			target_upids.update(id_conversion)
+		else:
+			target_upids.update(unified[1])
 	
+	if target_name is None:	#The full store
+		target_upids = None
+		target_taxids = None
+	elif target_taxids is not None and not any(dataset[2] for dataset in datasets):
+		target_upids = None
+	
+	compared_file_names = []
+	for level in levels or [None]:	#Each level's shard is closed before the next is opened
+		level_suffix = ""
+		if level is not None:
+			print("\nComparing at the %s level." % level)
+			level_suffix = "_" + level
+		map_store = loadMapStore(jobs, target_upids, target_taxids, target_name, level)
+		for dataset, unified in zip(datasets, unified_sets):
+			compared_file_names.extend(compareComplexSpecies(unified[0], dataset[1] + level_suffix, map_store, 
+																unified[1], taxonomy, ranks, cluster))
+			if significance is not None:
+				background_upids = dataset[2] or unified[1]
+				compared_file_names.append(testComplexSignificance(unified[0], dataset[1] + level_suffix, map_store, 
+											background_upids, significance[0], significance[1], jobs))
+		if len(datasets) > 1:
+			compared_file_names.extend(writeCombinedMatrix(combined_name + level_suffix, names, unified_sets, 
+															map_store))
+		map_store.close()
+	return compared_file_names
+
+def writeCombinedMatrix(combined_name, names, unified_sets, map_store):
+	#Writes one complex conservation matrix for several complex sets, with
+	#the set each complex is from in a Dataset column after its name.
+	#The columns are all the taxids any of the sets have orthologs in, in
+	#the order they are first seen. names and unified_sets are the sets'
+	#names and, for each, its complexes with Uniprot component IDs and the
+	#components in order (as from unifyComplexes).
+	#Returns the names of the files written.
+	combined_file_name = combined_name + "_complex_conservation.txt"
+	uniprot_to_og = map_store.uniprot_to_og
+	print("\nPreparing combined complex conservation survey of %s sets..." % len(names))
+	timer = run_report.stage("write combined complex matrix")
+	og_list = []	#All the OGs in use, in order of appearance
+	og_set = set()
+	for exp_complexes, unified_components in unified_sets:
+		for component in unified_components:
+			og = uniprot_to_og.get(component)
+			if og is not None and og not in og_set:
+				og_set.add(og)
+				og_list.append(og)
+	taxid_matrix = TaxidMatrix(og_list, map_store.og_to_taxid)
+	npz_file_name = None
+	if matrix_npz:
+		npz_file_name = combined_name + "_complex_conservation.npz"
+	writer = MatrixWriter(combined_file_name, taxid_matrix.taxids, "%5.4f", "d", npz_file_name,
+						label_names=["", "Dataset"])
+	for name, unified in zip(names, unified_sets):
+		exp_complexes = unified[0]
+		cplx_names = list(exp_complexes)
+		membership = [[taxid_matrix.og_index[uniprot_to_og[component]] for component in exp_complexes[complex_name]
+						if component in uniprot_to_og] for complex_name in cplx_names]
+		cplx_counts = cachedProduct(taxid_matrix, membership, [exp_complexes[complex_name] for complex_name in cplx_names], 
+									map_store, timer)
+		for complex_name, conserv_counts in zip(cplx_names, cplx_counts):
+			timer.advance(1)
+			cplx_size = float(len(exp_complexes[complex_name]))
+			writer.addRow([complex_name, name], [conserv_total / cplx_size for conserv_total in conserv_counts])
+	timer.finish()
+	return writer.close()
+
+def unifyComplexes(exp_complexes, id_conversion, locus_index):
+	#Converts the components of loaded complexes to Uniprot IDs.
+	#id_conversion and locus_index are as for compareSpecies.
+	#Complexes without any components that could be converted are left
+	#out, as they have nothing to compare.
+	#Returns the complexes with Uniprot component IDs, and a list of
+	#all their components in the order the complexes were loaded.
 	exp_complexes_unified = {} #The experimental complexes, but with Uniprot component IDs
 	#The components may already have Uniprot IDs - in this case they won't change
-	
+	unified_components = []		#All protein complex components, as UPIDs
+	unconverted_components = []	#Components without a Uniprot ID
+	empty_complexes = []	#Complexes without any converted components
+	timer = run_report.stage("convert components to Uniprot IDs", len(exp_complexes))
 	for name in exp_complexes:
+		timer.advance(1)
 		these_components = []
 		for component in exp_complexes[name]:
-			for identifier in id_conversion:
-				expanded_ids = id_conversion[identifier]
-				if component in expanded_ids:
-					#print(component + "\t" + identifier)
+			if component in locus_index:
+				for identifier in locus_index[component]:
 					unified_components.append(identifier)
 					these_components.append(identifier)
+			elif component in id_conversion or not id_conversion:
+				unified_components.append(component)
+				these_components.append(component)
+			else:
+				unconverted_components.append(component)
+		if len(these_components) == 0:
+			empty_complexes.append(name)
+			continue
 		exp_complexes_unified[name] = these_components
-	exp_complexes = exp_complexes_unified
+	if len(unconverted_components) >0:
+		print("%s complex components could not be converted to Uniprot IDs and were skipped:" 
+				% len(unconverted_components))
+		print(" ".join(unconverted_components))
+	if len(empty_complexes) >0:
+		print("%s complexes had no components with Uniprot IDs and were left out:" % len(empty_complexes))
+		print(" ".join(empty_complexes))
+	timer.finish()
+	return exp_complexes_unified, unified_components
+
+def compareComplexSpecies(exp_complexes, name1, map_store, unified_components=None, taxonomy=None, ranks=(),
+						cluster=False):
+	#Writes the component and complex conservation matrices for complexes
+	#with Uniprot component IDs, using an open MapStore.
+	#unified_components sets the order of the components (and so of the OGs
+	#and taxids); by default it is the order of exp_complexes.
+	#With a Taxonomy, also writes a complex conservation matrix for each of
+	#ranks, with a column for each clade at that rank (e.g. each genus).
+	#If cluster is True, also clusters both matrices (see clusterConservation).
+	#Complex rows already counted with this map store are reused from the ResultCache.
+	#Returns the names of the output files, starting with the component
+	#and complex conservation matrices.
+	component_con_file_name = name1 + "_component_conservation.txt"
+	cplx_con_file_name = name1 + "_complex_conservation.txt"
+	
+	uniprot_to_og = map_store.uniprot_to_og #ALL available Uniprot IDs are keys, members are eggNOG OG IDs
+		#Can only include UPIDs mapped to eggNOG IDs
+	og_to_taxid = map_store.og_to_taxid #All the taxids this OG has members in, as per the member files
+	if unified_components is None:	#All protein complex components, as UPIDs
+		unified_components = [component for complex_name in exp_complexes 
+								for component in exp_complexes[complex_name]]
+	component_ogs = {}	#Component UPIDs are keys, members are corresponding OGs
+	unmapped_components = []	#Any UPID not found in the eggNOG ID conversion file
+	unmapped_set = set()	#The same, for membership tests
+	og_list = []	#Just the unique OGs in use, in order of appearance
+	og_set = set()	#The same, for membership tests
 	
 	print("\nSearching for conservation of %s unique proteins." % len(unified_components))
 	
+	timer = run_report.stage("map components to OGs", len(unified_components))
 	for component in unified_components:
+		timer.advance(1)
 		if component in uniprot_to_og:
 			new_og = uniprot_to_og[component]
 			component_ogs[component] = new_og
-			if new_og not in og_list:
+			if new_og not in og_set:
+				og_set.add(new_og)
 				og_list.append(new_og)
 		else:
 			component_ogs[component] = component
 			unmapped_components.append(component)
+			unmapped_set.add(component)
+	
+	taxid_matrix = TaxidMatrix(og_list, og_to_taxid)	#OG x taxid presence for the components
+	all_cplx_taxids = taxid_matrix.taxids #All taxids relevant to the complex components.
+	timer.finish()
 	
-	for og in og_list:
-		if og in og_to_taxid:
-			for taxid in og_to_taxid[og]:
-				if taxid not in all_cplx_taxids:
-					all_cplx_taxids.append(taxid)
-					
 	print("Mapped complex components to %s OGs." % len(og_list))
 	print("%s complex components did not map to OGs." % len(unmapped_components))
 	print("Orthologs of these components are found across %s taxids." % len(all_cplx_taxids)) 
 	
 	print("Preparing component conservation survey...")
-	with open(component_con_file_name, "w+b") as compared_file:
-		compared_file.write("\t" + "\t".join(all_cplx_taxids) + "\n")
-		linecount = 0
-		for og in og_list:
-			linecount = linecount +1
-			if linecount % 100 == 0:
-				sys.stdout.write(".")
-			compared_file.write(og + "\t")
-			i = 0
-			for taxid in all_cplx_taxids:
-				i = i +1
-				if taxid in og_to_taxid[og]:
-					compared_file.write("1")
-				else:
-					compared_file.write("0")
-				if i < len(all_cplx_taxids):
-					compared_file.write("\t")
-			compared_file.write("\n")
+	timer = run_report.stage("write component matrix", len(og_list))
+	npz_file_name = None
+	if matrix_npz:
+		npz_file_name = name1 + "_component_conservation.npz"
+	writer = MatrixWriter(component_con_file_name, all_cplx_taxids, "%d", "B", npz_file_name)
+	linecount = 0
+	for og in og_list:
+		timer.advance(1)
+		linecount = linecount +1
+		if linecount % 100 == 0:
+			sys.stdout.write(".")
+		writer.addRow(og, taxid_matrix.presence(og))
+	component_file_names = writer.close()
+	timer.finish()
 	sys.stdout.write("Done.")
 	
-	print("\nPreparing complex conservation survey...")	
-	with open(cplx_con_file_name, "w+b") as compared_file:
-		compared_file.write("\t" + "\t".join(all_cplx_taxids) + "\n")
-		linecount = 0
-		for complex_name in exp_complexes:
-			linecount = linecount +1
-			if linecount % 10 == 0:
-				sys.stdout.write(".")
-			compared_file.write(complex_name + "\t")
-			these_og_components = []
-			these_components = exp_complexes[complex_name]
-			#print(these_components)
-			for component in these_components:
-				if component in unmapped_components:
-					#We don't have an OG map for this protein
-					#so it gets set to zero so we don't try to
-					#search for it a few lines later
-					these_og_components.append("0")
-				else:
-					og_component = uniprot_to_og[component]
-					these_og_components.append(og_component)
-			i = 0
-			for taxid in all_cplx_taxids:
-				i = i +1
-				conserv_total = 0
-				conserv_fraction = 0
-				for og_component in these_og_components:
-					if og_component == "0":
-						continue
-					if taxid in og_to_taxid[og_component]:
-						conserv_total = conserv_total +1
-					else:
-						conserv_total = conserv_total
-				conserv_fraction = conserv_total / float(len(these_components))
-				compared_file.write("%5.4f" % conserv_fraction)
-				if i < len(all_cplx_taxids):
-						compared_file.write("\t")
-			compared_file.write("\n")
+	print("\nPreparing complex conservation survey...")
+	cplx_names = list(exp_complexes)
+	timer = run_report.stage("write complex matrix", len(cplx_names))
+	membership = []	#Complex x OG membership, as the matrix row numbers of each complex's OGs
+	for complex_name in cplx_names:
+		these_og_rows = []
+		for component in exp_complexes[complex_name]:
+			if component in unmapped_set:
+				#We don't have an OG map for this protein
+				#so it doesn't count towards any taxid
+				continue
+			these_og_rows.append(taxid_matrix.og_index[component_ogs[component]])
+		membership.append(these_og_rows)
+	cplx_counts = cachedProduct(taxid_matrix, membership, [exp_complexes[complex_name] for complex_name in cplx_names], 
+								map_store, timer)	#Complexes x taxids, as components present
+	
+	cplx_file_names = writeComplexMatrix(cplx_con_file_name, all_cplx_taxids, 
+											exp_complexes, cplx_names, cplx_counts, timer)
+	timer.finish()
 	sys.stdout.write("Done.")
-
-	compared_file_names = [component_con_file_name, cplx_con_file_name]
+	#The two text matrices come first
+	compared_file_names = ([component_file_names[0], cplx_file_names[0]] + 
+							component_file_names[1:] + cplx_file_names[1:])
+	
+	if cluster:
+		compared_file_names.extend(clusterConservation(name1, taxid_matrix, exp_complexes, cplx_names, cplx_counts))
+	
+	if taxonomy is not None:
+		for rank in ranks:
+			print("\nPreparing complex conservation survey by %s..." % rank)
+			timer = run_report.stage("write %s matrix" % rank, len(cplx_names))
+			column_clades = [taxonomy.cladeOf(taxid, rank) for taxid in all_cplx_taxids]
+			if None in column_clades:
+				print("%s taxids are not within any %s in the taxonomy and were left out." 
+						% (column_clades.count(None), rank))
+			clade_matrix = taxid_matrix.rollUp(column_clades)	#OG x clade presence, with the same rows
+			clade_con_file_name = name1 + "_complex_conservation_" + rank + ".txt"
+			compared_file_names.extend(writeComplexMatrix(clade_con_file_name, clade_matrix.taxids, 
+										exp_complexes, cplx_names, clade_matrix.product(membership), timer))
+			timer.finish()
+			sys.stdout.write("Done.")
+	
 	return compared_file_names	
 
-##Main
-print("Ready to compare protein complex sets.")
-mode = "default"
-is_this_ecoli = raw_input("Will you need to convert E. coli locus IDs? Y/N\n")
-if is_this_ecoli.lower() == "y":
-	id_conversion = getEcoliIDs()
-	mode = "ecoli"
-else:
-	print("OK.")
-	
-convert_choice = raw_input("Do you need to convert a file to long format? Y/N\n")
-if convert_choice.lower() == "y":
-	have_short_file = False
-	while not have_short_file:
-		short_file_name = raw_input("Name of the file to convert?\n")
-		if not os.path.isfile(short_file_name):
-			print("Couldn't find that file. Try again.")
-		else:
-			have_short_file = True
-	long_file_name = convertToLong(short_file_name)
-	print("Long format file is available: %s" % long_file_name)
-
-complex_file_list = glob.glob('complexes*.txt')	
-if len(complex_file_list) >2:
-	sys.exit("Found more than two complex files. Check for duplicates.")
-if len(complex_file_list) == 2:
-	filename1 = complex_file_list[0]
-	filename2 = complex_file_list[1]
-	print("Found two protein complex files:\n%s\n%s" % (filename1, filename2))
-	name1 = raw_input("Please provide a short name for the first (experimental) set.\n")
-if len(complex_file_list) <2:
-	print("Less than two protein complex files found. Provide their names, please.")
-	have_file_1 = False
-	have_file_2 = False
-	while not have_file_1:
-		filename1 = raw_input("Name of the experimental complex file?\n")
-		if not os.path.isfile(filename1):
-			print("Couldn't find that file. Try again.")
+def writeComplexMatrix(filename, column_labels, exp_complexes, cplx_names, cplx_counts, timer):
+	#Writes a complex conservation matrix: for each complex in cplx_names,
+	#the fraction of its components present in each column, from the 
+	#matching row of cplx_counts. Also writes it as .npz with --npz.
+	#Returns the names of the files written.
+	npz_file_name = None
+	if matrix_npz:
+		npz_file_name = filename[:-len(".txt")] + ".npz"
+	writer = MatrixWriter(filename, column_labels, "%5.4f", "d", npz_file_name)
+	for linecount, complex_name in enumerate(cplx_names, 1):
+		timer.advance(1)
+		if linecount % 10 == 0:
+			sys.stdout.write(".")
+		cplx_size = float(len(exp_complexes[complex_name]))
+		writer.addRow(complex_name, [conserv_total / cplx_size 
+									for conserv_total in cplx_counts[linecount -1]])
+	return writer.close()
+
+def cachedProduct(taxid_matrix, membership, members, map_store, timer):
+	#Returns taxid_matrix.product(membership), reusing the rows of complexes
+	#already counted with this build of map_store from the ResultCache and 
+	#caching the rest. members has the members of each complex, in the
+	#same order as membership.
+	#Rows are cached by taxid rather than by column number, so they stay
+	#valid when other complexes change the order of the columns.
+	cache = resultCache()
+	if cache is None:
+		return taxid_matrix.product(membership)
+	group, snapshot = map_store.snapshot()
+	cache.useSnapshot(group, snapshot)
+	taxids = taxid_matrix.taxids
+	cplx_counts = []
+	for row_numbers, these_members in zip(membership, members):
+		result_key = resultKey("counts", snapshot, these_members)
+		cached = cache.get(result_key)
+		if cached is not None:
+			timer.hit()
+			counts = [0] * len(taxids)
+			for taxid in cached:
+				counts[taxid_matrix.taxid_index[taxid]] = cached[taxid]
 		else:
-			name1 = raw_input("Please provide a short name for this set.\n")
-			have_file_1 = True
-	while not have_file_2:
-		filename2 = raw_input("Name of the model complex file?\n")
-		if not os.path.isfile(filename2):
-			print("Couldn't find that file. Try again.")
-		elif filename2 == filename1:
-			print("Can't compare set to itself. Try again.")
+			counts = taxid_matrix.columnCounts(row_numbers)
+			cache.put(result_key, dict((taxids[column], count) for column, count in enumerate(counts) if count > 0),
+						group, snapshot)
+		cplx_counts.append(counts)
+	cache.save()
+	return cplx_counts
+
+def pairIndex(n, i, j):
+	#Position of the pair i, j (i < j) in a condensed matrix of n items:
+	#the upper triangle, without the diagonal, row by row.
+	return n * i - i * (i +1) // 2 + j - i -1
+
+def jaccardDistances(item_columns, width):
+	#Jaccard distances (1 - shared / either) between each pair of items,
+	#given the sorted columns (from 0 to width - 1) present in each item.
+	#Two empty items are the same.
+	#The columns each pair shares are counted for a block of items at a time:
+	#each column is packed into one integer with a field per item in the 
+	#block that has it, so adding up one item's columns gives its shared 
+	#counts with the whole block at once, and the fields are read back as 
+	#an array. The distances go straight into the condensed matrix, and only
+	#one block is held apart from it.
+	#Returns a condensed matrix (see pairIndex) of single-precision floats.
+	n = len(item_columns)
+	sizes = [len(columns) for columns in item_columns]
+	field_type = "H" if width < 1 << 16 else "I"	#Fields wide enough for any count
+	field_digits = 2 * array(field_type).itemsize	#Hex digits per field
+	distances = array("f", [0.0]) * (n * (n -1) // 2)
+	for block_start in range(1, n, cluster_block_size):	#The first item is never after another
+		block_end = min(block_start + cluster_block_size, n)
+		column_fields = [0] * width
+		for item in range(block_start, block_end):
+			field = 1 << (4 * field_digits * (item - block_start))
+			for column in item_columns[item]:
+				column_fields[column] = column_fields[column] | field
+		for item in range(block_end -1):
+			packed_counts = sum([column_fields[column] for column in item_columns[item]])
+			shared_counts = array(field_type, 
+								binascii.unhexlify(("%x" % packed_counts).zfill(field_digits * (block_end - block_start))))
+			if sys.byteorder == "little":
+				shared_counts.byteswap()
+			shared_counts.reverse()	#The last item's field comes first
+			first = max(block_start, item +1)
+			size = sizes[item]
+			row = array("f", [1.0 - float(shared) / ((size + other_size - shared) or 1) 
+							for shared, other_size in zip(shared_counts[first - block_start:], sizes[first:block_end])])
+			position = pairIndex(n, item, first)
+			distances[position:position + len(row)] = row
+	return distances
+
+def profileDistances(cplx_counts, cplx_sizes):
+	#Euclidean distances between complex conservation profiles: the fraction
+	#of each complex's components present in each taxid. cplx_counts has the
+	#number of components present in each taxid and cplx_sizes the sizes.
+	#Each complex's counts are packed into one integer, with a field for
+	#each taxid wide enough to hold any complex's total, and split into bit
+	#planes, each masking the fields of the taxids with that bit set in its
+	#count. The dot product of two profiles is then the sum of the fields 
+	#each plane of one leaves of the other's counts (summed by a modulus: 
+	#each field's place value is 1 modulo the field mask), weighted by the 
+	#planes' place values, over the product of their sizes.
+	#Returns a condensed matrix of single-precision floats.
+	field_bits = max([sum(counts) for counts in cplx_counts] + [0]).bit_length() +1
+	field_mask = (1 << field_bits) -1
+	packed = []	#Each complex's counts, a field per taxid
+	planes = []	#(place value, field mask) of each complex's nonempty planes
+	for counts in cplx_counts:
+		packed_counts = 0
+		masks = {}
+		for column, count in enumerate(counts):
+			if count == 0:
+				continue
+			packed_counts = packed_counts | (count << (field_bits * column))
+			for plane in range(count.bit_length()):
+				if (count >> plane) & 1:
+					masks[plane] = masks.get(plane, 0) | (field_mask << (field_bits * column))
+		packed.append(packed_counts)
+		planes.append([(1 << plane, masks[plane]) for plane in sorted(masks)])
+	def dot(i, j):
+		if cplx_sizes[i] == 0 or cplx_sizes[j] == 0:
+			return 0.0
+		return (sum(value * ((packed[j] & mask) % field_mask) for value, mask in planes[i]) 
+				/ float(cplx_sizes[i] * cplx_sizes[j]))
+	n = len(cplx_counts)
+	self_dots = [dot(i, i) for i in range(n)]
+	distances = array("f", [0.0]) * (n * (n -1) // 2)
+	for i in range(n -1):
+		row = array("f", [max(self_dots[i] + self_dots[j] - 2 * dot(i, j), 0.0) ** 0.5 for j in range(i +1, n)])
+		position = pairIndex(n, i, i +1)
+		distances[position:position + len(row)] = row
+	return distances
+
+def averageLinkage(distances, n):
+	#Clusters n items by average linkage (UPGMA), given their condensed
+	#distance matrix, with the nearest-neighbour chain algorithm.
+	#distances is updated in place as clusters merge, so no other 
+	#matrix is needed.
+	#Returns the merges in order, as [cluster, cluster, distance]: items
+	#are clusters 0 to n-1 and each merge makes the next cluster from n on.
+	infinity = float("inf")
+	row_starts = [pairIndex(n, i, 0) for i in range(n)]	#pairIndex(n, i, j) is row_starts[i] + j
+	slot_clusters = list(range(n))	#The cluster in each row of the matrix
+	sizes = [1] * n
+	active = [True] * n
+	merges = []
+	chain = []
+	while len(merges) < n -1:
+		if not chain:
+			chain.append(active.index(True))
+		current = chain[-1]
+		#Merged rows hold infinity, so the nearest is the minimum over the rest
+		row = distances[row_starts[current] + current +1:row_starts[current] + n]
+		nearest, nearest_distance = -1, infinity
+		if len(row) > 0:
+			nearest_distance = min(row)
+			nearest = current +1 + row.index(nearest_distance)
+		column = [distances[row_starts[other] + current] for other in range(current)]
+		if column and min(column) < nearest_distance:
+			nearest_distance = min(column)
+			nearest = column.index(nearest_distance)
+		if len(chain) > 1:	#Ties go to the previous cluster in the chain, so the chain ends
+			previous = chain[-2]
+			if distances[row_starts[min(previous, current)] + max(previous, current)] <= nearest_distance:
+				nearest = previous
+		if len(chain) == 1 or nearest != chain[-2]:
+			chain.append(nearest)
+			continue
+		chain = chain[:-2]
+		kept, dropped = min(current, nearest), max(current, nearest)
+		merges.append([slot_clusters[current], slot_clusters[nearest], 
+						distances[row_starts[kept] + dropped]])
+		kept_size, dropped_size = sizes[kept], sizes[dropped]
+		merged_size = kept_size + dropped_size
+		#Pairs with the other clusters before dropped are in columns or in 
+		#kept's row; those after it are in both rows, so are done as slices
+		for other in range(dropped):
+			if not active[other] or other == kept:
+				continue
+			kept_index = row_starts[min(other, kept)] + max(other, kept)
+			dropped_index = row_starts[other] + dropped
+			distances[kept_index] = ((kept_size * distances[kept_index] + dropped_size * distances[dropped_index])
+									/ merged_size)
+			distances[dropped_index] = infinity
+		kept_start, dropped_start = row_starts[kept] + dropped +1, row_starts[dropped] + dropped +1
+		after_count = n - dropped -1
+		distances[kept_start:kept_start + after_count] = array("f", 
+			[(kept_size * kept_distance + dropped_size * dropped_distance) / merged_size	#Merged rows stay infinite
+			for kept_distance, dropped_distance in zip(distances[kept_start:kept_start + after_count], 
+														distances[dropped_start:dropped_start + after_count])])
+		distances[dropped_start:dropped_start + after_count] = array("f", [infinity]) * after_count
+		distances[row_starts[kept] + dropped] = infinity
+		active[dropped] = False
+		sizes[kept] = merged_size
+		slot_clusters[kept] = n + len(merges) -1
+	return merges
+
+def clusterTree(merges, labels):
+	#Builds the tree of an averageLinkage clustering of the items in labels.
+	#Branch lengths are half the merge distances, as in UPGMA.
+	#Returns the tree in Newick format and the order of the items along it.
+	if len(labels) == 0:
+		return ";", []
+	nodes = [newickLabel(label) for label in labels]	#Newick text of each cluster
+	heights = [0.0] * len(labels)
+	orders = [[item] for item in range(len(labels))]
+	for cluster1, cluster2, distance in merges:
+		height = max(distance / 2.0, heights[cluster1], heights[cluster2])
+		nodes.append("(%s:%.6g,%s:%.6g)" % (nodes[cluster1], height - heights[cluster1],
+											nodes[cluster2], height - heights[cluster2]))
+		heights.append(height)
+		orders.append(orders[cluster1] + orders[cluster2])
+		nodes[cluster1] = nodes[cluster2] = orders[cluster1] = orders[cluster2] = None	#Only the root is kept
+	return nodes[-1] + ";", orders[-1]
+
+def newickLabel(label):
+	#Quotes a label for Newick if it has any characters Newick uses.
+	if re.search(r"[\s(),:;'\[\]]", label):
+		return "'" + label.replace("'", "''") + "'"
+	return label
+
+def clusterConservation(name1, taxid_matrix, exp_complexes, cplx_names, cplx_counts):
+	#Clusters the OGs (rows of the component conservation matrix), the
+	#complexes (rows of the complex conservation matrix) and the taxids
+	#(columns of both) by their conservation profiles, with averageLinkage.
+	#OGs and taxids are compared by the Jaccard distance of their presence,
+	#and complexes by the Euclidean distance of their conservation fractions.
+	#All the distances come from counts added up in packed integers, and 
+	#each is held as a condensed single-precision matrix only while it is
+	#clustered.
+	#Writes a Newick tree for each, and both matrices reordered to match.
+	#Returns the names of the files written.
+	timer = run_report.stage("cluster conservation profiles", 3)
+	print("\nClustering %s OGs, %s complexes and %s taxids..." 
+			% (len(taxid_matrix.ogs), len(cplx_names), len(taxid_matrix.taxids)))
+	cplx_distances = profileDistances(cplx_counts, [len(exp_complexes[complex_name]) for complex_name in cplx_names])
+	cplx_tree, cplx_order = clusterTree(averageLinkage(cplx_distances, len(cplx_names)), cplx_names)
+	del cplx_distances
+	timer.advance(1)
+	og_distances = jaccardDistances(taxid_matrix.row_columns, len(taxid_matrix.taxids))
+	og_tree, og_order = clusterTree(averageLinkage(og_distances, len(taxid_matrix.ogs)), taxid_matrix.ogs)
+	del og_distances
+	timer.advance(1)
+	column_rows = [[] for taxid in taxid_matrix.taxids]	#OG rows each taxid is present in
+	for og_row, columns in enumerate(taxid_matrix.row_columns):
+		for column in columns:
+			column_rows[column].append(og_row)
+	taxid_distances = jaccardDistances(column_rows, len(taxid_matrix.ogs))
+	taxid_tree, taxid_order = clusterTree(averageLinkage(taxid_distances, len(column_rows)), 
+										taxid_matrix.taxids)
+	del taxid_distances
+	timer.advance(1)
+	
+	clustered_file_names = []
+	for tree_file_name, tree in [(name1 + "_component_tree.nwk", og_tree), (name1 + "_complex_tree.nwk", cplx_tree),
+								(name1 + "_taxid_tree.nwk", taxid_tree)]:
+		with open(tree_file_name, "w+b") as tree_file:
+			tree_file.write(tree + "\n")
+		clustered_file_names.append(tree_file_name)
+	taxid_labels = [taxid_matrix.taxids[column] for column in taxid_order]
+	npz_file_name = None
+	if matrix_npz:
+		npz_file_name = name1 + "_component_conservation_clustered.npz"
+	writer = MatrixWriter(name1 + "_component_conservation_clustered.txt", taxid_labels, "%d", "B", npz_file_name)
+	for og_row in og_order:
+		presence = taxid_matrix.presence(taxid_matrix.ogs[og_row])
+		writer.addRow(taxid_matrix.ogs[og_row], [presence[column] for column in taxid_order])
+	clustered_file_names.extend(writer.close())
+	timer.finish()
+	timer = run_report.stage("write clustered complex matrix", len(cplx_order))
+	clustered_file_names.extend(writeComplexMatrix(name1 + "_complex_conservation_clustered.txt", taxid_labels,
+								exp_complexes, [cplx_names[row] for row in cplx_order],
+								[[cplx_counts[row][column] for column in taxid_order] for row in cplx_order], timer))
+	timer.finish()
+	return clustered_file_names
+
+null_state = {}	#Background presence rows for permutation workers, which share them when forked
+
+def nullStatistics(task):
+	#Draws random complexes of one size from the background proteins in
+	#null_state and returns the co-conservation statistic of each.
+	#task is [complex size, chunk number, number of complexes, seed]. The
+	#random generator is seeded from all of these, so each chunk draws
+	#the same complexes however the chunks are spread across processes.
+	cplx_size, chunk, count, seed = task
+	rows = null_state["rows"]
+	rng = random.Random(int(hashlib.md5("%s_%s_%s" % (seed, cplx_size, chunk)).hexdigest(), 16))
+	background = xrange(len(rows))
+	picks = array("i")	#count x cplx_size matrix of background row indexes, row by row
+	for i in xrange(count):
+		picks.extend(rng.sample(background, cplx_size))
+	statistics = array("i", [0]) * count
+	for i in xrange(count):
+		present = -1	#All columns
+		for pick in picks[i * cplx_size:(i +1) * cplx_size]:
+			present = present & rows[pick]
+		statistics[i] = bin(present).count("1")
+	return statistics
+
+def testComplexSignificance(exp_complexes, name1, map_store, background_upids, permutations=1000, 
+							seed=1, jobs=1):
+	#Tests whether the components of each complex are conserved together
+	#across more taxids than random complexes of the same size.
+	#The statistic is the number of taxids which have all of a complex's 
+	#components with OGs: the AND of their presence bitmasks.
+	#Random complexes are drawn, permutations times for each size, from
+	#background_upids (e.g. the proteome the complexes come from); only
+	#proteins and components with OGs count, and sizes are their number.
+	#The random complexes of each size are drawn in chunks with fixed seeds,
+	#so the results only depend on seed, with any number of jobs.
+	#Writes, for each complex, its statistic, the mean and standard deviation
+	#of the statistic for random complexes, its z-score and its empirical
+	#p-value, (1 + random complexes scoring as high or higher) / (1 + permutations).
+	#Complexes with less than two components with OGs get NA.
+	#Returns the name of the output file.
+	significance_file_name = name1 + "_complex_significance.txt"
+	uniprot_to_og = map_store.uniprot_to_og
+	og_to_taxid = map_store.og_to_taxid
+	timer = run_report.stage("test complex significance", len(exp_complexes))
+	print("\nTesting complex co-conservation against %s random complexes of each size..." % permutations)
+	
+	background_ogs = []	#The OG of each background protein with one
+	for upid in sorted(set(background_upids)):
+		og = uniprot_to_og.get(upid)
+		if og is not None:
+			background_ogs.append(og)
+	cplx_ogs = {}	#Complex names are keys, OGs of their components are values
+	for complex_name in exp_complexes:
+		cplx_ogs[complex_name] = [uniprot_to_og[component] for component in exp_complexes[complex_name]
+								if component in uniprot_to_og]
+	all_ogs = background_ogs + [og for complex_name in sorted(cplx_ogs) for og in cplx_ogs[complex_name]]
+	taxid_matrix = TaxidMatrix(sorted(set(all_ogs)), og_to_taxid)
+	null_state["rows"] = [taxid_matrix.rows[taxid_matrix.og_index[og]] for og in background_ogs]
+	print("%s of %s background proteins have OGs, across %s taxids." 
+			% (len(background_ogs), len(set(background_upids)), len(taxid_matrix.taxids)))
+	
+	cplx_sizes = sorted(set(len(cplx_ogs[complex_name]) for complex_name in cplx_ogs
+						if 2 <= len(cplx_ogs[complex_name]) <= len(background_ogs)))
+	chunk_size = 1000	#Random complexes drawn in each task
+	tasks = []
+	for cplx_size in cplx_sizes:
+		for chunk, start in enumerate(range(0, permutations, chunk_size)):
+			tasks.append([cplx_size, chunk, min(chunk_size, permutations - start), seed])
+	if jobs > 1:
+		pool = multiprocessing.Pool(jobs)
+		chunk_statistics = pool.map(nullStatistics, tasks)
+		pool.close()
+		pool.join()
+	else:
+		chunk_statistics = [nullStatistics(task) for task in tasks]
+	null_statistics = {}	#Complex sizes are keys, statistics of their random complexes are values
+	for task, statistics in zip(tasks, chunk_statistics):
+		null_statistics.setdefault(task[0], array("i")).extend(statistics)
+	null_state.clear()
+	null_summaries = {}	#Complex sizes are keys, sorted statistics, mean and SD are values
+	for cplx_size in null_statistics:
+		statistics = sorted(null_statistics[cplx_size])
+		null_mean = sum(statistics) / float(len(statistics))
+		null_sd = (sum((statistic - null_mean) ** 2 for statistic in statistics) / len(statistics)) ** 0.5
+		null_summaries[cplx_size] = [statistics, null_mean, null_sd]
+	
+	with open(significance_file_name, "w+b") as significance_file:
+		significance_file.write(name1 + "_Complex\tSize\tWithOGs\tCoConserved\tNullMean\tNullSD\tZScore\tPValue\n")
+		for complex_name in exp_complexes:
+			timer.advance(1)
+			these_ogs = cplx_ogs[complex_name]
+			if len(these_ogs) not in null_summaries:
+				significance_file.write("%s\t%s\t%s\tNA\tNA\tNA\tNA\tNA\n" 
+										% (complex_name, len(exp_complexes[complex_name]), len(these_ogs)))
+				continue
+			present = -1
+			for og in these_ogs:
+				present = present & taxid_matrix.rows[taxid_matrix.og_index[og]]
+			observed = bin(present).count("1")
+			statistics, null_mean, null_sd = null_summaries[len(these_ogs)]
+			z_score = "NA"
+			if null_sd > 0:
+				z_score = "%5.4f" % ((observed - null_mean) / null_sd)
+			as_high = len(statistics) - bisect.bisect_left(statistics, observed)	#Random complexes scoring >= observed
+			p_value = (1 + as_high) / (1.0 + len(statistics))
+			significance_file.write("%s\t%s\t%s\t%s\t%5.4f\t%5.4f\t%s\t%.4g\n" 
+									% (complex_name, len(exp_complexes[complex_name]), len(these_ogs),
+									observed, null_mean, null_sd, z_score, p_value))
+	timer.finish()
+	return significance_file_name
+
+def readManifest(filename):
+	#Reads a batch manifest. Each line is one job, with tab-separated fields:
+	#experimental file, experimental set name, model file, model set name.
+	#The model fields may be left out for jobs which are only species comparisons.
+	#Empty lines and lines starting with # are skipped.
+	#Returns a list of [filename1, name1, filename2, name2] (the last two may be None).
+	batch_jobs = []
+	with open(filename) as manifest_file:
+		for line in manifest_file:
+			if not line.strip() or line.startswith("#"):
+				continue
+			line_content = (line.rstrip()).split("\t")
+			if len(line_content) not in [2, 4]:
+				sys.exit("Manifest lines need 2 or 4 tab-separated fields: %s" % line.rstrip())
+			for filename_field in line_content[0::2]:
+				if not os.path.isfile(filename_field):
+					sys.exit("Couldn't find complex file %s from the manifest." % filename_field)
+			if len(line_content) == 2:
+				line_content = line_content + [None, None]
+			batch_jobs.append(line_content)
+	return batch_jobs
+
+def readDatasets(filename):
+	#Reads a list of complex sets to compare across species together, with
+	#compareSpeciesMulti. Each line is one set, with tab-separated fields:
+	#complex file, set name and, optionally, how to convert its IDs to
+	#Uniprot IDs: "ecoli" for E. coli locus IDs (see getEcoliIDs), or the
+	#name of an ID conversion table (see parseIDTable). Without one, the
+	#components are used as they are.
+	#Empty lines and lines starting with # are skipped.
+	#Returns a list of [filename, name, id_conversion, locus_index].
+	datasets = []
+	conversions = {}	#Conversions are keys, loaded ID conversion dictionaries and indexes are values
+	with open(filename) as datasets_file:
+		for line in datasets_file:
+			if not line.strip() or line.startswith("#"):
+				continue
+			line_content = (line.rstrip()).split("\t")
+			if len(line_content) not in [2, 3]:
+				sys.exit("Dataset lines need 2 or 3 tab-separated fields: %s" % line.rstrip())
+			if not os.path.isfile(line_content[0]):
+				sys.exit("Couldn't find complex file %s from the dataset list." % line_content[0])
+			conversion = None
+			if len(line_content) == 3 and line_content[2] not in ["", "-"]:
+				conversion = line_content[2]
+			if conversion not in conversions:
+				if conversion is None:
+					conversions[conversion] = [{}, {}]
+				elif conversion == "ecoli":
+					conversions[conversion] = getEcoliIDs()
+				elif os.path.isfile(conversion):
+					conversions[conversion] = loadConversionTable(conversion, parseIDTable)
+				else:
+					sys.exit("Couldn't find ID conversion table %s from the dataset list." % conversion)
+			datasets.append(line_content[:2] + list(conversions[conversion]))
+	return datasets
+
+batch_state = {}	#Loaded inputs for batch workers, which share them when forked
+
+def runBatchComparison(batch_job):
+	#Runs one model comparison from the loaded batch inputs.
+	#Also writes the all-vs-all overlaps if they were requested.
+	#Returns the names of the output files.
+	exp_key = (batch_job[0], batch_job[1])
+	model_key = (batch_job[2], batch_job[3])
+	compared_file_names = [compareComplexSets(batch_state["complexes"][exp_key], batch_job[1], 
+								batch_state["complexes"][model_key], batch_job[3])]
+	if batch_state["overlaps"] is not None:
+		compared_file_names.append(overlapComplexSets(batch_state["complexes"][exp_key], batch_job[1], 
+								batch_state["complexes"][model_key], batch_job[3], 
+								batch_state["overlaps"][0], batch_state["overlaps"][1]))
+	return compared_file_names
+
+def runBatchSpecies(species_job):
+	#Runs one species comparison from the loaded batch inputs.
+	#species_job is the experimental set's key and the suffix for its
+	#output file names ("" or the eggNOG level, e.g. "_gproNOG").
+	exp_key, level_suffix = species_job
+	unified = batch_state["unified"][exp_key]
+	return compareComplexSpecies(unified[0], exp_key[1] + level_suffix, batch_state["map_store"], unified[1], 
+								batch_state["taxonomy"], batch_state["ranks"], batch_state["cluster"])
+
+def runReported(function, argument):
+	#Runs function(argument) in a pool worker. Returns its result and the
+	#stages it timed, to be added to the run report of the main process.
+	del run_report.stages[:]
+	return function(argument), run_report.stages
+
+def runBatch(manifest_filename, species=False, ecoli=False, jobs=1, target_name=None, target_taxids=None, 
+			overlaps=None, taxonomy=None, ranks=(), significance=None, cluster=False, levels=None):
+	#Runs all the jobs in a batch manifest (see readManifest) in one process.
+	#Each distinct complex file, the ID conversion table and the eggNOG maps
+	#are loaded only once. With more than one job, comparisons run across
+	#a pool of that many processes.
+	#Model comparisons run for every job with a model set; species comparisons
+	#run once for each distinct experimental set if species is True.
+	#overlaps may be [top_k, score] to also run overlapComplexSets for each model comparison.
+	#taxonomy, ranks and cluster are as for compareComplexSpecies, and
+	#significance as for compareSpecies.
+	#With levels, species comparisons are made at each of those eggNOG
+	#levels in turn, as for compareSpeciesMulti.
+	#Returns the names of all the output files.
+	batch_jobs = readManifest(manifest_filename)
+	print("Running %s jobs from %s." % (len(batch_jobs), manifest_filename))
+	batch_state["complexes"] = {}	#(filename, set name) pairs are keys, loaded complexes are values
+	batch_state["overlaps"] = overlaps
+	batch_state["taxonomy"] = taxonomy
+	batch_state["ranks"] = ranks
+	batch_state["cluster"] = cluster
+	for batch_job in batch_jobs:
+		for complex_key in [(batch_job[0], batch_job[1]), (batch_job[2], batch_job[3])]:
+			if complex_key[0] is not None and complex_key not in batch_state["complexes"]:
+				print("Loading %s as %s." % complex_key)
+				batch_state["complexes"][complex_key] = loadComplexes(complex_key[0], complex_key[1])
+	
+	exp_keys = []	#Distinct experimental sets, in manifest order
+	for batch_job in batch_jobs:
+		if (batch_job[0], batch_job[1]) not in exp_keys:
+			exp_keys.append((batch_job[0], batch_job[1]))
+	model_jobs = [batch_job for batch_job in batch_jobs if batch_job[2] is not None]
+	
+	if species:
+		id_conversion = {}
+		locus_index = {}
+		if ecoli:
+			id_conversion, locus_index = getEcoliIDs()
+		batch_state["unified"] = {}	#Experimental set keys are keys, unified complexes and components are values
+		all_components = set()
+		for exp_key in exp_keys:
+			unified = unifyComplexes(batch_state["complexes"][exp_key], id_conversion, locus_index)
+			batch_state["unified"][exp_key] = unified
+			all_components.update(unified[1])
+		target_upids = None
+		if target_name is None:	#The full store
+			target_taxids = None
 		else:
-			name2 = raw_input("Please provide a short name for this set.\n")
-			have_file_2 = True
-	
-model_comparison_choice = raw_input("Compare the experimental complex set to the model set? Y/N\n")
-if model_comparison_choice.lower() == "y":
-	name2 = raw_input("Please provide a short name for the second (model) set.\n")
-	compared_file_name = compareSets(filename1, name1, filename2, name2, mode)
-	print("Model comparison complete. See %s." % compared_file_name)
-else:
-	model_comparison = False
-
-taxon_comparison_choice = raw_input("Compare the experimental complex set across species? Y/N\n")
-if taxon_comparison_choice.lower() == "y":
-	taxcompare_file_names = compareSpecies(filename1, name1, id_conversion)
-	print("\nBroad taxonomic comparison complete.\n" + 
-		"See %s for component conservation and %s for complex conservation."
-		% (taxcompare_file_names[0], taxcompare_file_names[1]))
-else:
-	taxon_comparison = False
+			if id_conversion:
+				target_upids = set(id_conversion)
+			elif target_taxids is None:
+				target_upids = all_components
+		levels = levels or [None]
+		#The first level's store is loaded before any pool is started, so workers share it
+		batch_state["map_store"] = loadMapStore(jobs, target_upids, target_taxids, target_name, levels[0])
+	
+	output_file_names = []
+	pool = None
+	if jobs > 1:
+		pool = multiprocessing.Pool(jobs)
+		for compared_file_names, stages in pool.map(functools.partial(runReported, runBatchComparison), model_jobs):
+			output_file_names.extend(compared_file_names)
+			run_report.stages.extend(stages)
+	else:
+		for batch_job in model_jobs:
+			output_file_names.extend(runBatchComparison(batch_job))
+	if species:
+		for level_number, level in enumerate(levels):	#One level's store open at a time
+			level_suffix = ""
+			if level is not None:
+				print("\nComparing at the %s level." % level)
+				level_suffix = "_" + level
+			species_jobs = [(exp_key, level_suffix) for exp_key in exp_keys]
+			if level_number > 0:
+				batch_state["map_store"].close()
+				batch_state["map_store"] = loadMapStore(jobs, target_upids, target_taxids, target_name, level)
+				if pool is not None:	#Workers forked before this store was loaded can't see it
+					pool.close()
+					pool.join()
+					pool = multiprocessing.Pool(jobs)
+			if pool is not None:
+				for compared_file_names, stages in pool.map(functools.partial(runReported, runBatchSpecies), species_jobs):
+					output_file_names.extend(compared_file_names)
+					run_report.stages.extend(stages)
+			else:
+				for species_job in species_jobs:
+					output_file_names.extend(runBatchSpecies(species_job))
+			if significance is not None:
+				for exp_key in exp_keys:
+					unified = batch_state["unified"][exp_key]
+					output_file_names.append(testComplexSignificance(unified[0], exp_key[1] + level_suffix, 
+											batch_state["map_store"], id_conversion or unified[1], 
+											significance[0], significance[1], jobs))
+		batch_state["map_store"].close()
+	if pool is not None:
+		pool.close()
+		pool.join()
+	batch_state.clear()
+	return output_file_names
+
+def serveQueries(manifest_filename, port, ecoli=False, jobs=1, target_name=None, target_taxids=None, 
+				taxonomy=None):
+	#Loads the complex sets in a batch manifest (see readManifest) and the
+	#map store once, then answers queries about single complexes over HTTP
+	#on localhost:port until interrupted. Requests are handled concurrently.
+	#GET /complex?set=S&name=C gives, as JSON, complex C of set S: its members,
+	#its best match in each model set paired with S in the manifest
+	#(by Jaccard index, or by score=overlap or score=matching), and, for
+	#experimental sets, its Uniprot components, those without an OG and the
+	#fraction of components present in each taxid. With a taxonomy,
+	#rank=R adds the fraction present in each clade at rank R.
+	#levels=L1,L2 gives these fractions at each of those eggNOG levels 
+	#instead, from each level's shard of the map store, which is built the
+	#first time a query asks for it.
+	#GET /sets lists the loaded sets and their complexes; GET /status gives
+	#the open map store and request counts. The map store is reopened when 
+	#it is rebuilt on disk, checked every query_reload_interval seconds or
+	#on POST /reload.
+	batch_jobs = readManifest(manifest_filename)
+	id_conversion = {}
+	locus_index = {}
+	if ecoli:
+		id_conversion, locus_index = getEcoliIDs()
+	service = QueryService(batch_jobs, id_conversion, locus_index, target_name, taxonomy)
+	target_upids = None
+	if target_name is not None:
+		if id_conversion:
+			target_upids = set(id_conversion)
+		elif target_taxids is None:
+			target_upids = set(component for name in service.unified 
+								for components in service.unified[name].values() for component in components)
+	else:
+		target_taxids = None
+	service.store_arguments = [jobs, target_upids, target_taxids]
+	service.store_filter = filterKey(target_upids, target_taxids)
+	loadMapStore(jobs, target_upids, target_taxids, target_name).close()	#Builds the store if needed
+	service.reload()
+	watcher = threading.Thread(target=service.watch)
+	watcher.daemon = True
+	watcher.start()
+	server = QueryServer(("127.0.0.1", port), QueryHandler)
+	server.service = service
+	print("Serving complex queries on http://127.0.0.1:%s/ (Ctrl-C to stop)." % port)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		print("Stopped serving.")
+	server.server_close()
 
+##Main
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Compare sets of protein complexes. "
+									"Runs interactively unless a batch manifest is given.")
+	parser.add_argument("--batch", metavar="MANIFEST",
+						help="Run all the comparisons in a manifest file without prompting. "
+						"Each line is: experimental file, name, model file, name (tab-separated); "
+						"the model file and name may be left out.")
+	parser.add_argument("--species", action="store_true",
+						help="In batch mode, also compare each experimental set across species.")
+	parser.add_argument("--ecoli", action="store_true",
+						help="In batch mode, convert E. coli locus IDs to Uniprot IDs.")
+	parser.add_argument("--overlaps", type=int, metavar="K",
+						help="Also compare every experimental complex to every model complex and "
+						"write the top K matches for each (0 for all overlapping matches).")
+	parser.add_argument("--score", choices=["jaccard", "overlap", "matching"], default="jaccard",
+						help="Score used to rank the matches written by --overlaps.")
+	parser.add_argument("--jobs", type=int, default=1,
+						help="Number of processes to use for building the eggNOG maps and for batch comparisons.")
+	parser.add_argument("--targeted", action="store_true",
+						help="Build and use eggNOG maps covering only the proteins being compared.")
+	parser.add_argument("--taxids", 
+						help="Comma-separated taxids to restrict targeted eggNOG maps to.")
+	parser.add_argument("--report", metavar="FILE",
+						help="Write a JSON run report to FILE, with the time, rows processed, "
+						"peak memory and cache hits of each stage.")
+	parser.add_argument("--progress", action="store_true",
+						help="Show a progress bar with an ETA for each stage, on stderr.")
+	parser.add_argument("--npz", action="store_true",
+						help="Also write the species conservation matrices as NumPy .npz files, "
+						"with arrays matrix, rows and columns.")
+	parser.add_argument("--taxonomy", metavar="NODES",
+						help="NCBI taxonomy nodes.dmp file. Species comparisons then also write "
+						"complex conservation for each clade at each of --ranks.")
+	parser.add_argument("--ranks", default="genus,family,phylum",
+						help="Comma-separated taxonomic ranks to use with --taxonomy.")
+	parser.add_argument("--datasets", metavar="LIST",
+						help="Compare several complex sets (e.g. from different organisms) across species "
+						"against one map store, and write a combined complex matrix. Each line is: complex "
+						"file, name and optionally ecoli or an ID conversion table (tab-separated).")
+	parser.add_argument("--serve", metavar="MANIFEST",
+						help="Load the complex sets in a batch manifest and the eggNOG maps once, "
+						"then answer queries about single complexes over HTTP (see --port).")
+	parser.add_argument("--port", type=int, default=8000,
+						help="Port to serve queries on, on localhost.")
+	parser.add_argument("--permutations", type=int, default=0, metavar="N",
+						help="Also test each complex's co-conservation across taxids against N random "
+						"complexes of the same size, in species comparisons.")
+	parser.add_argument("--seed", type=int, default=1,
+						help="Seed for the random complexes drawn by --permutations.")
+	parser.add_argument("--cluster", action="store_true",
+						help="Also cluster the OGs, complexes and taxids of species comparisons by their "
+						"conservation profiles, writing Newick trees and reordered matrices.")
+	parser.add_argument("--levels",
+						help="Comma-separated eggNOG levels (e.g. NOG,bactNOG,gproNOG) to compare species at, "
+						"each from its own map store, instead of the merged NOG and bactNOG store. Any "
+						"eggNOG 4.5 level can be given.")
+	parser.add_argument("--layout", choices=["long", "short"],
+						help="Layout of every complex file, instead of detecting it from the header and first "
+						"lines of each. Needed for files which fit either layout.")
+	parser.add_argument("--cache-dir", metavar="DIR",
+						help="Keep per-complex results between runs in this directory, so later runs only "
+						"compute new or changed complexes. Off by default.")
+	parser.add_argument("--cache-size", type=int, default=result_cache_size, metavar="MB",
+						help="MB of per-complex results to keep with --cache-dir. 0 turns the cache off.")
+	args = parser.parse_args()
+	matrix_npz = args.npz
+	complex_layout = args.layout
+	result_cache_dir = args.cache_dir
+	result_cache_size = args.cache_size
+	run_report.progress = args.progress
+	if args.report:
+		atexit.register(run_report.write, args.report)	#Also written if the run exits early
+	target_taxids = None
+	if args.taxids:
+		target_taxids = set(args.taxids.split(","))
+	
+	taxonomy = None
+	ranks = args.ranks.split(",")
+	if args.taxonomy:
+		if not os.path.isfile(args.taxonomy):
+			sys.exit("Couldn't find taxonomy file %s." % args.taxonomy)
+		taxonomy = Taxonomy(args.taxonomy)
+	
+	levels = None
+	if args.levels:
+		levels = args.levels.split(",")
+		if len(unknownLevels(levels)) >0:
+			sys.exit("Unknown eggNOG level(s) in --levels: %s. Known levels are %s."
+					% (", ".join(unknownLevels(levels)), ", ".join(eggnog_level_names)))
+	
+	significance = None
+	if args.permutations > 0:
+		significance = [args.permutations, args.seed]
+	
+	overlaps = None
+	if args.overlaps is not None:
+		overlaps = [args.overlaps, args.score]
+	
+	if args.datasets:
+		datasets = readDatasets(args.datasets)
+		target_name = None
+		if args.targeted or target_taxids is not None:
+			target_name = "datasets"
+		output_file_names = compareSpeciesMulti(datasets, args.jobs, target_name, target_taxids, 
+												taxonomy, ranks, significance, args.cluster, levels=levels)
+		print("\nSpecies comparison complete. Wrote %s files:\n%s" % (len(output_file_names), "\n".join(output_file_names)))
+		sys.exit()
+	
+	if args.serve:
+		target_name = None
+		if args.targeted or target_taxids is not None:
+			target_name = "batch"
+			if args.ecoli:
+				target_name = "ecoli"
+		serveQueries(args.serve, args.port, args.ecoli, args.jobs, target_name, target_taxids, taxonomy)
+		sys.exit()
+	
+	if args.batch:
+		target_name = None
+		if args.targeted or target_taxids is not None:
+			target_name = "batch"
+			if args.ecoli:
+				target_name = "ecoli"
+		output_file_names = runBatch(args.batch, args.species, args.ecoli, args.jobs, 
+									target_name, target_taxids, overlaps, taxonomy, ranks, significance, 
+									args.cluster, levels)
+		print("\nBatch complete. Wrote %s files:\n%s" % (len(output_file_names), "\n".join(output_file_names)))
+		sys.exit()
+	
+	print("Ready to compare protein complex sets.")
+	mode = "default"
+	is_this_ecoli = raw_input("Will you need to convert E. coli locus IDs? Y/N\n")
+	if is_this_ecoli.lower() == "y":
+		id_conversion, locus_index = getEcoliIDs()
+		mode = "ecoli"
+	else:
+		id_conversion = {}	#Components are used as they are
+		locus_index = {}
+		print("OK.")
+	
+	complex_file_list = glob.glob('complexes*.txt') + glob.glob('complexes*.txt.gz')
+	if len(complex_file_list) >2:
+		sys.exit("Found more than two complex files. Check for duplicates.")
+	if len(complex_file_list) == 2:
+		filename1 = complex_file_list[0]
+		filename2 = complex_file_list[1]
+		print("Found two protein complex files:\n%s\n%s" % (filename1, filename2))
+		name1 = raw_input("Please provide a short name for the first (experimental) set.\n")
+	if len(complex_file_list) <2:
+		print("Less than two protein complex files found. Provide their names, please.")
+		have_file_1 = False
+		have_file_2 = False
+		while not have_file_1:
+			filename1 = raw_input("Name of the experimental complex file?\n")
+			if not os.path.isfile(filename1):
+				print("Couldn't find that file. Try again.")
+			else:
+				name1 = raw_input("Please provide a short name for this set.\n")
+				have_file_1 = True
+		while not have_file_2:
+			filename2 = raw_input("Name of the model complex file?\n")
+			if not os.path.isfile(filename2):
+				print("Couldn't find that file. Try again.")
+			elif filename2 == filename1:
+				print("Can't compare set to itself. Try again.")
+			else:
+				name2 = raw_input("Please provide a short name for this set.\n")
+				have_file_2 = True
+	
+	model_comparison_choice = raw_input("Compare the experimental complex set to the model set? Y/N\n")
+	if model_comparison_choice.lower() == "y":
+		name2 = raw_input("Please provide a short name for the second (model) set.\n")
+		compared_file_name = compareSets(filename1, name1, filename2, name2, mode)
+		print("Model comparison complete. See %s." % compared_file_name)
+		if overlaps is not None:
+			overlap_file_name = overlapComplexSets(loadComplexes(filename1, name1), name1, 
+								loadComplexes(filename2, name2), name2, overlaps[0], overlaps[1])
+			print("All-vs-all overlaps complete. See %s." % overlap_file_name)
+	else:
+		model_comparison = False
+
+	taxon_comparison_choice = raw_input("Compare the experimental complex set across species? Y/N\n")
+	if taxon_comparison_choice.lower() == "y":
+		target_name = None
+		if args.targeted or target_taxids is not None:
+			if mode == "default":
+				target_name = name1
+			else:
+				target_name = mode
+		taxcompare_file_names = compareSpecies(filename1, name1, id_conversion, args.jobs, 
+												target_name, target_taxids, locus_index, taxonomy, ranks, 
+												significance, args.cluster, levels)
+		print("\nBroad taxonomic comparison complete.\n" + 
+			"See %s for component conservation and %s for complex conservation."
+			% (taxcompare_file_names[0], taxcompare_file_names[1]))
+	else:
+		taxon_comparison = False
@@ -0,0 +1,222 @@
+#!/usr/bin/python
+#test_complexDissect.py
+'''
+Tests for complexDissect.py.
+
+The resumable downloader (fetchFile) is tested against a small HTTP
+server run in this process, which serves a file from memory with an
+ETag and honours Range and If-Range the way the eggNOG server does.
+Complex files are tested in both layouts, with and without headers
+naming their columns. Map stores are written and read back, and the
+query service's level shards are built with a stand-in build function.
+
+Usage:
+python test_complexDissect.py
+'''
+import BaseHTTPServer, gc, hashlib, os, shutil, tempfile, threading, unittest, weakref
+
+import complexDissect
+
+##Classes
+class FileHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	#Serves the server's content at any path, or the rest of it from a
+	#Range request if the If-Range validator (when sent) is its current ETag.
+	#If the server's cut_after is set, the next response stops after that
+	#many bytes of its body, as if the connection dropped.
+
+	def do_GET(self):
+		content = self.server.content
+		etag = '"%s"' % hashlib.md5(content).hexdigest()
+		self.server.requests.append({"Range": self.headers.getheader("Range"),
+									"If-Range": self.headers.getheader("If-Range")})
+		start = 0
+		range_header = self.headers.getheader("Range")	#e.g. bytes=100-
+		if range_header and self.headers.getheader("If-Range", etag) == etag:
+			start = int(range_header[len("bytes="):-1])
+		body = content[start:]
+		if start > 0:
+			self.send_response(206)
+			self.send_header("Content-Range", "bytes %s-%s/%s" % (start, len(content) -1, len(content)))
+		else:
+			self.send_response(200)
+		self.send_header("ETag", etag)
+		self.send_header("Content-Length", str(len(body)))
+		self.end_headers()
+		if self.server.cut_after is not None:
+			body = body[:self.server.cut_after]
+			self.server.cut_after = None
+		self.wfile.write(body)
+
+	def log_message(self, format, *args):
+		pass
+
+class FetchFileTest(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.temp_dir, "members.tsv")
+		self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), FileHandler)
+		self.server.content = "".join("NOG\tNOG%06d\t2\t2\tS\t1.a,2.b\n" % i for i in range(20000))
+		self.server.cut_after = None
+		self.server.requests = []
+		self.server_thread = threading.Thread(target=self.server.serve_forever)
+		self.server_thread.start()
+		self.url = "http://127.0.0.1:%s/members.tsv" % self.server.server_port
+		self.retries = complexDissect.download_retries
+
+	def tearDown(self):
+		complexDissect.download_retries = self.retries
+		self.server.shutdown()
+		self.server.server_close()
+		self.server_thread.join()
+		shutil.rmtree(self.temp_dir)
+
+	def readFile(self, filename):
+		with open(filename, "rb") as this_file:
+			return this_file.read()
+
+	def testInterruptedDownloadIsResumed(self):
+		self.server.cut_after = 100000
+		complexDissect.fetchFile(self.url, self.filename)
+		self.assertEqual(self.readFile(self.filename), self.server.content)
+		self.assertEqual(len(self.server.requests), 2)
+		self.assertEqual(self.server.requests[0]["Range"], None)
+		self.assertEqual(self.server.requests[1]["Range"], "bytes=100000-")
+		self.assertEqual(self.server.requests[1]["If-Range"], '"%s"' % hashlib.md5(self.server.content).hexdigest())
+		self.assertFalse(os.path.exists(self.filename + ".part"))
+		self.assertFalse(os.path.exists(self.filename + ".part.validator"))
+
+	def testChangedFileIsDownloadedAgain(self):
+		complexDissect.download_retries = 0	#Leave the partial download for the next run
+		self.server.cut_after = 100000
+		self.assertRaises(IOError, complexDissect.fetchFile, self.url, self.filename)
+		self.assertEqual(os.path.getsize(self.filename + ".part"), 100000)
+		self.server.content = self.server.content.replace("NOG", "COG")
+		complexDissect.fetchFile(self.url, self.filename)
+		self.assertEqual(self.readFile(self.filename), self.server.content)
+		self.assertEqual(self.server.requests[-1]["Range"], "bytes=100000-")
+		self.assertEqual(len(self.server.requests), 2)	#The server sent the whole new file at once
+
+	def testChecksumIsKept(self):
+		complexDissect.fetchFile(self.url, self.filename)
+		self.assertEqual(self.readFile(self.filename + ".md5").strip(), hashlib.md5(self.server.content).hexdigest())
+		self.assertTrue(complexDissect.checkFile(self.filename))
+		with open(self.filename, "r+b") as downloaded_file:
+			downloaded_file.write("X")
+		self.assertFalse(complexDissect.checkFile(self.filename))
+
+	def testChecksumMismatchIsDiscarded(self):
+		self.assertRaises(IOError, complexDissect.fetchFile, self.url, self.filename, "0" * 32)
+		self.assertFalse(os.path.exists(self.filename))
+		self.assertFalse(os.path.exists(self.filename + ".part"))
+
+class ComplexLayoutTest(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.layout = complexDissect.complex_layout
+
+	def tearDown(self):
+		complexDissect.complex_layout = self.layout
+		shutil.rmtree(self.temp_dir)
+
+	def writeComplexes(self, text):
+		filename = os.path.join(self.temp_dir, "complexes.txt")
+		with open(filename, "w") as complex_file:
+			complex_file.write(text)
+		return filename
+
+	def testLongFileWithExtraColumn(self):
+		filename = self.writeComplexes("ProteinID\tComplexMembership\tScore\n"
+									"P1\tA\t0.9\nP2\tA\t0.8\nP3\tB\t0.7\nP1\tB\t0.5\n")
+		self.assertEqual(complexDissect.loadComplexes(filename, "set"),
+						{"set_A": ["P1", "P2"], "set_B": ["P3", "P1"]})
+
+	def testLongFileWithExtraColumnWithoutHeaderNames(self):
+		filename = self.writeComplexes("a\tb\tc\nP1\tA\t0.9\nP2\tA\t0.8\nP3\tB\t0.7\nP1\tB\t0.5\n")
+		self.assertEqual(complexDissect.loadComplexes(filename, "set"),
+						{"set_A": ["P1", "P2"], "set_B": ["P3", "P1"]})
+
+	def testShortFile(self):
+		filename = self.writeComplexes("a\tb\n1\tP1\tP2\tP3\n2\tP4\tP5\n")
+		self.assertEqual(complexDissect.loadComplexes(filename, "set"),
+						{"set_1": ["P1", "P2", "P3"], "set_2": ["P4", "P5"]})
+
+	def testAmbiguousFileNeedsLayout(self):
+		filename = self.writeComplexes("a\tb\tc\nP1\tA\t0.9\nP2\tA\t0.8\n")
+		self.assertRaises(SystemExit, complexDissect.loadComplexes, filename, "set")
+		self.assertEqual(complexDissect.loadComplexes(filename, "set", "long"), {"set_A": ["P1", "P2"]})
+
+class MapStoreTest(unittest.TestCase):
+
+	def setUp(self):
+		self.temp_dir = tempfile.mkdtemp()
+		self.working_dir = os.getcwd()
+		os.chdir(self.temp_dir)
+		self.build_function = complexDissect.get_eggnog_maps
+
+	def tearDown(self):
+		complexDissect.get_eggnog_maps = self.build_function
+		os.chdir(self.working_dir)
+		shutil.rmtree(self.temp_dir)
+
+	def writeStore(self, filename):
+		complexDissect.writeMapStore(filename, *complexDissect.internMaps({"P1": "COG1", "P2": "COG2"},
+																		{"COG1": ["511145", "562"], "COG2": ["562"]}))
+		return filename
+
+	def testLookups(self):
+		map_store = complexDissect.MapStore(self.writeStore("eggnog_maps_2026-01-01.bin"))
+		self.assertEqual(map_store.uniprot_to_og["P2"], "COG2")
+		self.assertFalse("P3" in map_store.uniprot_to_og)
+		self.assertEqual(map_store.og_to_taxid.get("COG1"), ["511145", "562"])
+		map_store.close()
+
+	def testStoreIsFreedWithoutGarbageCollection(self):
+		gc.disable()
+		try:
+			map_store = complexDissect.MapStore(self.writeStore("eggnog_maps_2026-01-01.bin"))
+			store_ref = weakref.ref(map_store)
+			del map_store
+			self.assertEqual(store_ref(), None)
+		finally:
+			gc.enable()
+
+	def testNewestTextMapsAreConverted(self):
+		for store_date, og in [("2015-01-01", "COG1"), ("2016-01-01", "COG2")]:
+			with open("uniprot_og_maps_%s.txt" % store_date, "w") as map_file:
+				map_file.write("P1\t%s\n" % og)
+			with open("og_to_taxid_%s.txt" % store_date, "w") as taxon_file:
+				taxon_file.write("%s\t562 511145\n" % og)
+		map_store = complexDissect.loadMapStore()
+		self.assertEqual(map_store.filename, "eggnog_maps_2016-01-01.bin")
+		self.assertEqual(map_store.uniprot_to_og["P1"], "COG2")
+		map_store.close()
+
+	def testLevelBuildDoesNotBlockBuiltLevels(self):
+		self.writeStore("eggnog_maps_level_fastNOG_2026-01-01.bin")
+		started = threading.Event()
+		release = threading.Event()
+		def slow_build(jobs, upids, taxids, target_name, level):
+			started.set()
+			release.wait()
+			return self.writeStore("eggnog_maps_level_%s_2026-01-01.bin" % level)
+		complexDissect.get_eggnog_maps = slow_build
+		service = complexDissect.QueryService([], {}, {})
+		stores = []
+		builder = threading.Thread(target=lambda: stores.append(service.levelStore("slowNOG")))
+		builder.start()
+		started.wait()
+		fast_store = service.levelStore("fastNOG")	#Returns while the other level is still building
+		self.assertTrue(builder.is_alive())
+		self.assertEqual(fast_store.uniprot_to_og["P1"], "COG1")
+		release.set()
+		builder.join()
+		self.assertEqual(stores[0].uniprot_to_og["P1"], "COG1")
+
+	def testUnknownLevels(self):
+		self.assertEqual(complexDissect.unknownLevels(["NOG", "gproNOG", "gammaNOG", "../NOG"]), ["gammaNOG", "../NOG"])
+
+##Main
+if __name__ == "__main__":
+	unittest.main()